@@ -1,38 +1,187 @@
 import asyncio
-import io
+import itertools
+import logging
+import multiprocessing
 import os
 from datetime import datetime
+from typing import Dict, List, Optional
 
 from aiogram import Bot, Dispatcher, F, Router
-from aiogram.filters import Command
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import SimpleFilesPathWrapper, TelegramAPIServer
+from aiogram.exceptions import TelegramAPIError
+from aiogram.filters import Command, CommandObject
 from aiogram.types import Message, FSInputFile, Document, BufferedInputFile
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
 from dotenv import load_dotenv
 
-from app.processing.parser import parse_telegram_export_streams
-from app.processing.extractor import extract_entities
-from app.processing.excel import build_excel_workbook
+from app.processing.dedup import MessageIdIndex
+from app.processing.parser import is_account_export, list_zip_pages, zip_page_file
+from app.processing.pipeline import merge_summaries, summaries_overlap, summarize_upload, summarize_zip_page
+from app.processing.excel import build_excel_bytes
+from app.processing.export import EXPORT_FORMATS, build_export_bytes
 from app.processing.utils import is_valid
-from app.utils.temp import SessionAccumulator, InMemoryFile
+from app.utils import limits, metrics
+from app.utils.cache import SummaryCache, file_key
+from app.utils.pool import init_pool, map_in_pool, run_in_pool, shutdown_pool
+from app.utils.profiles import ProfileCache, ProfileEnricher
+from app.utils.scheduler import JobScheduler
+from app.utils.store import create_backend
+from app.utils.temp import BudgetExceeded, SessionAccumulator, SessionStore, InMemoryFile, LocalFiles
 
 load_dotenv()
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 MAX_FILES_HINT = int(os.getenv("MAX_FILES_HINT", "10"))
-
-bot = Bot(token=BOT_TOKEN)
+# Число процессов для разбора и формирования Excel (0 — без отдельных процессов)
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", str(os.cpu_count() or 1)))
+# Бюджеты памяти (МБ) на сессию пользователя и на весь процесс
+MAX_SESSION_MB = int(os.getenv("MAX_SESSION_MB", "300"))
+MAX_TOTAL_MB = int(os.getenv("MAX_TOTAL_MB", "1500"))
+# Через сколько секунд простоя сессия без /process удаляется, и как часто это проверять
+SESSION_TTL = int(os.getenv("SESSION_TTL", "3600"))
+SESSION_SWEEP_INTERVAL = int(os.getenv("SESSION_SWEEP_INTERVAL", "60"))
+# Порт HTTP-эндпоинта /metrics в формате Prometheus (0 — не поднимать)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+# Замер пиковой памяти заданий через tracemalloc (замедляет разбор в разы, только для отладки)
+METRICS_TRACEMALLOC = os.getenv("METRICS_TRACEMALLOC", "0") == "1"
+# Каталог для cProfile-профиля первого задания после запуска (пусто — не профилировать)
+PROFILE_DIR = os.getenv("PROFILE_DIR", "")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+# Кэш итогов разбора одинаковых файлов: объём (МБ, 0 — выключен), срок жизни (с) и число записей
+SUMMARY_CACHE_MB = int(os.getenv("SUMMARY_CACHE_MB", "64"))
+SUMMARY_CACHE_TTL = int(os.getenv("SUMMARY_CACHE_TTL", "3600"))
+SUMMARY_CACHE_ENTRIES = int(os.getenv("SUMMARY_CACHE_ENTRIES", "1000"))
+# Режим приёма обновлений: polling или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+# Публичный адрес бота (https://example.com), путь и секрет webhook, адрес и порт HTTP-сервера
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+# Число процессов webhook-сервера на одном порту (больше 1 — только с SESSION_STORE=redis)
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "1"))
+# Хранилище сессий: memory (в процессе) или redis (общее для нескольких процессов/контейнеров)
+SESSION_STORE = os.getenv("SESSION_STORE", "memory")
+REDIS_URL = os.getenv("REDIS_URL", "redis://127.0.0.1:6379/0")
+# Срок жизни блокировки сессии в общем хранилище (с) — должен превышать время разбора самого большого файла
+SESSION_LOCK_TTL = int(os.getenv("SESSION_LOCK_TTL", "900"))
+# Сколько /process выполняется одновременно, остальные ждут в очереди
+MAX_CONCURRENT_JOBS = int(os.getenv("MAX_CONCURRENT_JOBS", "2"))
+
+# Локальный сервер Bot API (telegram-bot-api --local): файлы до 2000 МБ и доступ к ним по пути на диске
+BOT_API_URL = os.getenv("BOT_API_URL", "")
+BOT_API_LOCAL = os.getenv("BOT_API_LOCAL", "0") == "1"
+# Если сервер в другом контейнере: его каталог файлов и путь, по которому этот каталог смонтирован у бота
+BOT_API_SERVER_DIR = os.getenv("BOT_API_SERVER_DIR", "")
+BOT_API_FILES_DIR = os.getenv("BOT_API_FILES_DIR", "")
+# Удалять файл из каталога сервера после разбора (сервер скачает его заново при необходимости).
+# Выключено по умолчанию: файл с тем же file_id может в это время читать другой процесс бота
+BOT_API_DELETE_FILES = os.getenv("BOT_API_DELETE_FILES", "0") == "1"
+# Дополнение Excel описанием профиля через getChat по @username (1 — включить)
+ENRICH_PROFILES = os.getenv("ENRICH_PROFILES", "0") == "1"
+# Одновременных запросов getChat на процесс и лимит запросов (не из кэша) на одно задание (0 — без лимита)
+ENRICH_CONCURRENCY = int(os.getenv("ENRICH_CONCURRENCY", "5"))
+ENRICH_MAX_LOOKUPS = int(os.getenv("ENRICH_MAX_LOOKUPS", "500"))
+# Кэш профилей, общий для всех заданий: срок жизни (с) и число записей
+ENRICH_CACHE_TTL = int(os.getenv("ENRICH_CACHE_TTL", "86400"))
+ENRICH_CACHE_ENTRIES = int(os.getenv("ENRICH_CACHE_ENTRIES", "100000"))
+# Формат результата по умолчанию: xlsx, csv или jsonl (csv/jsonl — сжатые gzip)
+OUTPUT_FORMAT = os.getenv("OUTPUT_FORMAT", "xlsx").lower()
+# Лимиты одного задания (разбор файла или /process, 0 — без ограничения): время (с),
+# распакованный объём архива (МБ) и число сообщений в одном вызове разбора
+JOB_MAX_SECONDS = float(os.getenv("JOB_MAX_SECONDS", "600"))
+JOB_MAX_UNPACKED_MB = int(os.getenv("JOB_MAX_UNPACKED_MB", "4096"))
+JOB_MAX_MESSAGES = int(os.getenv("JOB_MAX_MESSAGES", "20000000"))
+
+
+def _create_bot() -> Bot:
+    if not BOT_API_URL:
+        return Bot(token=BOT_TOKEN)
+    options = {"is_local": BOT_API_LOCAL}
+    if BOT_API_SERVER_DIR and BOT_API_FILES_DIR:
+        options["wrap_local_file"] = SimpleFilesPathWrapper(BOT_API_SERVER_DIR, BOT_API_FILES_DIR)
+    api = TelegramAPIServer.from_base(BOT_API_URL, **options)
+    return Bot(token=BOT_TOKEN, session=AiohttpSession(api=api))
+
+
+bot = _create_bot()
 dp = Dispatcher()
 router = Router()
 dp.include_router(router)
 
-# В памяти храним по user_id: список файлов, пока не вызовут /process
-sessions = {}
+# В памяти храним по user_id: накопленные сущности из разобранных файлов, пока не вызовут /process
+sessions = SessionStore(
+    user_budget=MAX_SESSION_MB * 1024 * 1024,
+    global_budget=MAX_TOTAL_MB * 1024 * 1024,
+    ttl=SESSION_TTL,
+    backend=create_backend(SESSION_STORE, REDIS_URL),
+    lock_ttl=SESSION_LOCK_TTL,
+)
+scheduler = JobScheduler(max_concurrent=MAX_CONCURRENT_JOBS)
+# Файлы локального Bot API, которые сейчас разбираются (удаляются после последнего разбора)
+local_files = LocalFiles()
+# Повторно присланный файл не разбираем: берём сущности из кэша по хэшу содержимого
+summary_cache = SummaryCache(
+    max_bytes=SUMMARY_CACHE_MB * 1024 * 1024,
+    ttl=SUMMARY_CACHE_TTL,
+    max_entries=SUMMARY_CACHE_ENTRIES,
+)
+metrics.register(summary_cache)
+# Профили по username запрашиваются у Bot API один раз на срок жизни записи, для всех заданий
+profile_cache = ProfileCache(ttl=ENRICH_CACHE_TTL, max_entries=ENRICH_CACHE_ENTRIES)
+profile_enricher = ProfileEnricher(bot, profile_cache, concurrency=ENRICH_CONCURRENCY)
+if ENRICH_PROFILES:
+    metrics.register(profile_cache)
+    metrics.register(profile_enricher)
+
+OUTPUT_FORMATS = ("xlsx",) + EXPORT_FORMATS
+
+
+async def _output_format(user_id: int) -> str:
+    # Выбор /format хранится в хранилище сессий: общий для всех процессов бота
+    fmt = await sessions.get_setting(user_id, "format")
+    return fmt if fmt in OUTPUT_FORMATS else OUTPUT_FORMAT
+
+# Выполняющиеся задания пользователей (разборы файлов и /process) и их лимиты — для /cancel
+_user_jobs: Dict[int, Dict[asyncio.Task, Optional[limits.JobLimits]]] = {}
+
+
+def _job_limits() -> limits.JobLimits:
+    return limits.JobLimits(
+        max_seconds=JOB_MAX_SECONDS,
+        max_messages=JOB_MAX_MESSAGES,
+        max_unpacked=JOB_MAX_UNPACKED_MB * 1024 * 1024,
+    )
+
+
+def _track_job(user_id: int, task: asyncio.Task, job: Optional[limits.JobLimits]):
+    jobs = _user_jobs.setdefault(user_id, {})
+    if task not in jobs:
+        def done(t: asyncio.Task):
+            jobs.pop(t, None)
+            if not jobs and _user_jobs.get(user_id) is jobs:
+                del _user_jobs[user_id]
+        task.add_done_callback(done)
+    jobs[task] = job
+
+
+def _cancelled_by_user() -> bool:
+    # Задание отменено через /cancel, а не остановка самого обработчика (завершение бота)
+    return not asyncio.current_task().cancelling()
+
 
 HELP_TEXT = (
     "Этот бот принимает экспорт истории чата из Telegram (JSON/HTML/ZIP) и извлекает участников.\n\n"
     "Как пользоваться:\n"
     "1) Выгрузите историю чата в Telegram Desktop (Настройки -> Advanced -> Export Telegram data).\n"
     "2) Отправьте файл(ы) экспорта сюда (рекомендуем не более {max_files} за одну отправку).\n"
-    "3) После загрузки отправьте команду /process.\n\n"
+    "3) После загрузки отправьте команду /process.\n"
+    "Остановить обработку и очистить загруженное: /cancel.\n"
+    "Формат результата: /format xlsx|csv|jsonl или разово /process csv (CSV/JSONL сжаты gzip).\n\n"
     "Результат:\n"
     "- Если < 50 участников: получите список @username в чате.\n"
     "- Если ≥ 51: получите Excel с вкладками: Участники, Упоминания, Каналы.\n\n"
@@ -52,6 +201,89 @@ async def cmd_help(message: Message):
     await message.answer(HELP_TEXT)
 
 
+async def _summarize_upload(f: InMemoryFile, seen: MessageIdIndex):
+    """
+    Разбор файла в пуле. Страницы ZIP-архива (messages*.html) разбираются
+    параллельно в нескольких рабочих процессах и сводятся в исходном порядке.
+    Чаты выгрузки всего аккаунта делятся между рабочими процессами: каждый
+    читает файл потоково и разбирает только свои чаты. Если части содержат
+    одни и те же сообщения, файл разбирается заново последовательно: итог
+    не зависит от числа рабочих процессов.
+    """
+    if WORKER_PROCESSES > 1:
+        parts = None
+        if f.name.lower().endswith(".zip"):
+            pages = await asyncio.to_thread(list_zip_pages, f)
+            if len(pages) > 1:
+                # Из архива в памяти члены вырезаются по мере запуска, а не все сразу
+                calls = (zip_page_file(f, info) + (seen,) for info in pages)
+                parts = await map_in_pool(summarize_zip_page, calls, WORKER_PROCESSES)
+        if parts is None and f.name.lower().endswith((".json", ".zip")) and await asyncio.to_thread(is_account_export, f):
+            calls = ((f, seen, (i, WORKER_PROCESSES)) for i in range(WORKER_PROCESSES))
+            parts = await map_in_pool(summarize_upload, calls, WORKER_PROCESSES)
+        if parts is not None:
+            if not summaries_overlap(parts):
+                return merge_summaries(parts)
+            logging.info("Части файла %s пересекаются по сообщениям, разбираем последовательно", f.name)
+    return await run_in_pool(summarize_upload, f, seen)
+
+
+def _cached_summary(cached, seen: MessageIdIndex):
+    """
+    Итог файла из кэша, если его можно добавить без разбора: ни одно сообщение
+    файла ещё не учтено в сессии — итог целиком; учтены все — пустой итог
+    (0 новых сообщений). При частичном пересечении файл надо разбирать с dedup.
+    """
+    if cached is None:
+        return None
+    entities, message_ids = cached
+    if not seen.overlaps(message_ids):
+        return entities, message_ids, 0
+    if seen.covers(message_ids):
+        return {}, MessageIdIndex(), sum(r.count() for r in message_ids.chats.values())
+    return None
+
+
+async def _parse_upload(user_id: int, f: InMemoryFile, epoch: int) -> int:
+    """
+    Разбирает файл и добавляет итог в сессию. Возвращает число файлов в сессии.
+    epoch — sessions.cancel_epoch до скачивания файла (см. SessionStore.check_cancelled).
+
+    Блокировка сессии берётся только на снимок индекса id и на слияние итога:
+    файлы одной сессии разбираются параллельно. Если к слиянию сессия изменилась
+    так, что итог по снимку неверен (другой файл добавил те же сообщения, сессию
+    очистили), файл разбирается заново уже под блокировкой.
+    """
+    key = None
+    cached = None
+    if summary_cache.enabled:
+        with metrics.stage("hash", bytes_in=f.size):
+            key = await asyncio.to_thread(file_key, f)
+        cached = summary_cache.get(key)
+    # Время задания считается с начала разбора, а не с ожидания пула или блокировки
+    job = _job_limits()
+    _track_job(user_id, asyncio.current_task(), job)
+    with limits.job(job):
+        async with sessions.lock(user_id):
+            # /cancel, пришедший во время скачивания, отменяет и этот файл
+            await sessions.check_cancelled(user_id, epoch)
+            seen = (await sessions.load(user_id)).message_ids.copy()
+        summary = _cached_summary(cached, seen) or await _summarize_upload(f, seen)
+        async with sessions.lock(user_id):
+            await sessions.check_cancelled(user_id, epoch)
+            acc = await sessions.load(user_id)
+            if not acc.message_ids.covers(seen) or acc.message_ids.overlaps(summary[1]):
+                summary = _cached_summary(cached, acc.message_ids) or await _summarize_upload(f, acc.message_ids)
+            entities, message_ids, skipped = summary
+            acc.add_entities(entities, message_ids)
+            acc.uploaded_bytes += f.size
+            files_count = acc.count()
+            await sessions.save(user_id, acc, epoch)
+    if cached is None and key is not None and not skipped:
+        summary_cache.put(key, entities, message_ids)
+    return files_count
+
+
 @router.message(F.document)
 async def handle_document(message: Message):
     doc: Document = message.document
@@ -64,51 +296,232 @@ async def handle_document(message: Message):
         await message.answer("Пожалуйста, отправьте файл экспорта Telegram: .json, .html или .zip")
         return
 
-    # Скачиваем файл в память
-    file = await bot.get_file(doc.file_id)
-    file_bytes = await bot.download_file(file.file_path)
-    data = file_bytes.read()
-
     user_id = message.from_user.id if message.from_user else message.chat.id
+    with metrics.job("upload", user_id):
+        await _handle_upload(message, doc, user_id, file_name, mime_type)
+
+
+async def _fetch_upload(doc: Document, file_name: str, mime_type: str) -> InMemoryFile:
+    """
+    Получает содержимое документа. С локальным сервером Bot API файл уже лежит
+    на диске: возвращаем путь к нему (разбор читает его через mmap), иначе скачиваем в память.
+    """
+    with metrics.stage("download") as st:
+        file = await bot.get_file(doc.file_id)
+        if bot.session.api.is_local:
+            path = str(bot.session.api.wrap_local_file.to_local(file.file_path))
+            upload = InMemoryFile(name=file_name, mime=mime_type, path=path)
+        else:
+            file_bytes = await bot.download_file(file.file_path)
+            upload = InMemoryFile(name=file_name, mime=mime_type, data=file_bytes.read())
+            del file_bytes
+        st.bytes_in = upload.size
+    return upload
 
-    acc: SessionAccumulator = sessions.get(user_id) or SessionAccumulator()
-    acc.add_file(InMemoryFile(name=file_name, mime=mime_type, data=data))
-    sessions[user_id] = acc
+
+async def _handle_upload(message: Message, doc: Document, user_id: int, file_name: str, mime_type: str):
+    # Резервируем память заранее по заявленному размеру, чтобы не скачивать лишнего.
+    # Файл локального сервера Bot API в память не копируется — резервировать нечего
+    reserved = 0 if bot.session.api.is_local else doc.file_size or 0
+    try:
+        acc: SessionAccumulator = sessions.reserve(user_id, reserved)
+    except BudgetExceeded as e:
+        metrics.mark_failed("rejected")
+        await message.answer(str(e))
+        return
+
+    upload: Optional[InMemoryFile] = None
+    try:
+        # До скачивания: /cancel, отправленный после файла, отменяет и его
+        epoch = await sessions.cancel_epoch(user_id)
+        # Скачивание — тоже задание пользователя: /cancel прерывает его
+        fetch = asyncio.ensure_future(_fetch_upload(doc, file_name, mime_type))
+        _track_job(user_id, fetch, None)
+        upload = await fetch
+        if upload.path is not None:
+            local_files.acquire(upload.path)
+        if upload.path is None and upload.size > reserved:
+            sessions.reserve(user_id, upload.size - reserved)
+            reserved = upload.size
+
+        # Разбираем файл сразу: в сессии остаются только сущности, байты освобождаются.
+        # Лимиты задания задаются в _parse_upload, когда подойдёт очередь файла
+        task = asyncio.ensure_future(_parse_upload(user_id, upload, epoch))
+        acc.track(task)
+        _track_job(user_id, task, None)
+        files_count = await task
+    except BudgetExceeded as e:
+        metrics.mark_failed("rejected")
+        await message.answer(str(e))
+        return
+    except limits.JobAborted as e:
+        metrics.mark_failed("aborted")
+        await message.answer(f"Файл '{file_name}' не обработан: {e}.")
+        return
+    except asyncio.CancelledError:
+        if not _cancelled_by_user():
+            raise
+        # Ответ пользователю отправляет /cancel
+        metrics.mark_failed("cancelled")
+        return
+    except Exception as e:
+        metrics.mark_failed()
+        await message.answer(f"Ошибка при разборе файла '{file_name}': {e}")
+        return
+    finally:
+        sessions.release(acc, reserved, user_id)
+        if upload is not None and upload.path is not None:
+            # Файл удаляется после последнего разбора: тот же документ мог прийти дважды
+            local_files.release(upload.path, BOT_API_DELETE_FILES)
+        upload = None
 
     await message.answer(
-        f"Файл '{file_name}' принят. Всего загружено: {acc.count()}.\n"
+        f"Файл '{file_name}' принят. Всего загружено: {files_count}.\n"
         f"Отправьте /process для обработки. Рекомендуем загружать не более {MAX_FILES_HINT} файлов за раз."
     )
 
 
+@router.message(Command("format"))
+async def cmd_format(message: Message, command: CommandObject):
+    user_id = message.from_user.id if message.from_user else message.chat.id
+    fmt = (command.args or "").strip().lower()
+    if fmt not in OUTPUT_FORMATS:
+        current = await _output_format(user_id)
+        await message.answer(f"Текущий формат результата: {current}. Укажите один из: {', '.join(OUTPUT_FORMATS)}.")
+        return
+    await sessions.set_setting(user_id, "format", fmt)
+    await message.answer(f"Формат результата: {fmt}.")
+
+
 @router.message(Command("process"))
-async def cmd_process(message: Message):
+async def cmd_process(message: Message, command: Optional[CommandObject] = None):
     user_id = message.from_user.id if message.from_user else message.chat.id
-    acc: SessionAccumulator = sessions.get(user_id)
-    if not acc or acc.count() == 0:
+    # Формат можно указать разово: /process csv
+    fmt = (command and command.args or "").strip().lower() or await _output_format(user_id)
+    if fmt not in OUTPUT_FORMATS:
+        await message.answer(f"Неизвестный формат результата: {fmt}. Доступны: {', '.join(OUTPUT_FORMATS)}.")
+        return
+    files_count, uploaded_bytes = await sessions.summary(user_id)
+    if not files_count:
         await message.answer("Нет загруженных файлов. Сначала отправьте экспорт истории чата.")
         return
 
-    await message.answer("Обработка начата, пожалуйста, подождите...")
+    if scheduler.is_active(user_id):
+        await message.answer("Ваш запрос уже в очереди на обработку, дождитесь результата.")
+        return
 
-    # Парсинг экспортов
+    # Пока запрос в очереди, сессию нельзя вытеснять по простою
+    acc = sessions.get_or_create(user_id)
+    acc.processing = True
     try:
-        parsed_items = parse_telegram_export_streams(acc.files)
-    except Exception as e:
-        await message.answer(f"Ошибка при разборе файлов: {e}")
-        acc.clear()
+        with metrics.job("process", user_id):
+            task = asyncio.ensure_future(_run_process(message, acc, user_id, uploaded_bytes, fmt))
+            _track_job(user_id, task, None)
+            await task
+    except asyncio.CancelledError:
+        if not _cancelled_by_user():
+            raise
+        metrics.mark_failed("cancelled")
+    finally:
+        acc.processing = False
+
+
+async def _run_process(message: Message, acc: SessionAccumulator, user_id: int, uploaded_bytes: int, fmt: str):
+    status: Optional[Message] = None
+    status_text = ""
+
+    async def on_wait(position: int, eta: Optional[float]):
+        # Одно сообщение о статусе, редактируемое по мере движения очереди
+        nonlocal status, status_text
+        text = _queue_text(position, eta)
+        if text == status_text:
+            return
+        status_text = text
+        try:
+            if status is None:
+                status = await message.answer(text)
+            else:
+                await status.edit_text(text)
+        except TelegramAPIError:
+            pass
+
+    async with scheduler.slot(user_id, uploaded_bytes, on_wait):
+        started_text = "Обработка начата, пожалуйста, подождите... Отменить: /cancel"
+        if status is None:
+            await message.answer(started_text)
+        else:
+            try:
+                await status.edit_text(started_text)
+            except TelegramAPIError:
+                pass
+        # Время задания считается с получения слота, а не с постановки в очередь
+        job = _job_limits()
+        _track_job(user_id, asyncio.current_task(), job)
+        with limits.job(job):
+            # Файлы уже разобраны при загрузке, дожидаемся только незавершённых
+            await acc.wait_pending()
+            async with sessions.lock(user_id):
+                acc = await sessions.load(user_id)
+                acc.processing = True
+                try:
+                    await _process_session(message, acc, fmt)
+                finally:
+                    await sessions.drop(user_id)
+
+
+@router.message(Command("cancel"))
+async def cmd_cancel(message: Message):
+    """
+    Останавливает разборы файлов и /process пользователя и очищает сессию.
+    Вызовы в пуле останавливаются на ближайшей проверке лимитов, а если
+    не остановились за JOB_KILL_GRACE — пул процессов убивается и пересоздаётся.
+    """
+    user_id = message.from_user.id if message.from_user else message.chat.id
+    # Копия: завершившиеся задачи удаляют себя из словаря
+    jobs = list(_user_jobs.pop(user_id, {}).items())
+    for task, job in jobs:
+        if job is not None:
+            limits.cancel(job.job_id)
+        task.cancel()
+    if jobs:
+        # Отвечаем, когда задания действительно остановлены и память освобождена
+        await asyncio.gather(*(task for task, _ in jobs), return_exceptions=True)
+    files_count, _ = await sessions.summary(user_id)
+    # Задания этого пользователя в других процессах бота не сохранят сессию (см. SessionStore.cancel)
+    await sessions.cancel(user_id)
+    if not jobs and not files_count:
+        await message.answer("Нечего отменять: нет загруженных файлов и выполняющихся обработок.")
         return
+    await message.answer("Обработка отменена, загруженные файлы удалены. Можно отправить экспорт заново.")
+
+
+def _queue_text(position: int, eta: Optional[float]) -> str:
+    text = f"Сейчас обрабатываются запросы других пользователей. Ваша позиция в очереди: {position}."
+    if eta is not None:
+        # Округляем, чтобы сообщение не редактировалось из-за каждой секунды
+        if eta < 60:
+            text += f"\nПримерное ожидание: ~{max(10, round(eta / 10) * 10)} с."
+        else:
+            text += f"\nПримерное ожидание: ~{round(eta / 60)} мин."
+    return text
 
-    # Извлечение сущностей
-    entities = extract_entities(parsed_items)
+
+async def _process_session(message: Message, acc: SessionAccumulator, fmt: str = "xlsx"):
+    if acc.count() == 0:
+        await message.answer("Не удалось разобрать ни одного файла. Отправьте экспорт заново.")
+        return
+
+    entities = acc.result()
 
     # Фильтрация дублей и удалённых
     participants = entities["participants"]
     mentions = entities["mentions"]
     channels = entities["channels"]
+    # Сущности по чатам есть только у выгрузки всего аккаунта
+    chats = entities.get("chats")
 
-    # Решение по отправке
-    if len(participants) < 50:
+    # Решение по отправке; CSV/JSONL нужны для внешних инструментов — их отправляем всегда
+    if fmt == "xlsx" and len(participants) < 50:
         # Список в чат
         usernames = sorted({p.get("username") for p in mentions if p.get("username") and is_valid(p.get("username"))})
         names = sorted({p.get("name") for p in participants if p.get("name")})
@@ -120,45 +533,125 @@ async def cmd_process(message: Message):
             nam_chunk = "\n".join(f"{u}" if not u.startswith("@") else u for u in names)
             await message.answer("Участники (<50):\nУпомянутые пользователи:\n" + chunk + "\nУчастники чата:\n" + nam_chunk)
     else:
-        # Excel
+        # Excel или CSV/JSONL
         try:
-            # Создаём Excel в памяти
-            buf = io.BytesIO()
+            # Создаём файл в памяти (в процессе пула)
             export_date = datetime.utcnow()
 
-            wb = build_excel_workbook(
-                participants=participants,
-                mentions=mentions,
-                channels=channels,
-                export_date=export_date,
-            )
-
-            wb.save(buf)
-            buf.seek(0)
+            if ENRICH_PROFILES:
+                # Описание профиля — только для строк с известным username
+                with metrics.stage("enrich"):
+                    await profile_enricher.enrich(itertools.chain(participants, mentions), ENRICH_MAX_LOOKUPS)
+                limits.check()
+
+            if fmt == "xlsx":
+                data = await run_in_pool(
+                    build_excel_bytes, participants, mentions, channels, export_date, chats
+                )
+                filename = f"chat_members_{export_date.date()}.xlsx"
+                caption = "Excel с участниками, упоминаниями и каналами." + (
+                    " Отдельный лист — на каждый чат." if chats else ""
+                )
+            else:
+                # Строки пишутся потоково прямо в сжатый буфер: память не растёт с числом строк
+                data = await run_in_pool(build_export_bytes, fmt, participants, mentions, channels, chats)
+                filename = f"chat_members_{export_date.date()}.{fmt}.gz"
+                caption = f"{fmt.upper()} (gzip) с участниками, упоминаниями и каналами: тип строки — в поле type." + (
+                    " Сущности отдельных чатов — с названием чата в поле chat." if chats else ""
+                )
 
             # ВАЖНО: BufferedInputFile, а не FSInputFile
-            input_file = BufferedInputFile(
-                buf.getvalue(),
-                filename=f"chat_members_{export_date.date()}.xlsx"
-            )
+            input_file = BufferedInputFile(data, filename=filename)
 
             # Отправка файла
-            await message.answer_document(
-                document=input_file,
-                caption="Excel с участниками, упоминаниями и каналами."
-            )
+            with metrics.stage("send", bytes_in=len(data)):
+                await message.answer_document(document=input_file, caption=caption)
 
+        except limits.JobAborted as e:
+            metrics.mark_failed("aborted")
+            await message.answer(f"Формирование файла остановлено: {e}.")
         except Exception as e:
-            await message.answer(f"Ошибка при формировании Excel: {e}")
-
-    # Очистка сессии
-    acc.clear()
-    sessions.pop(user_id, None)
+            metrics.mark_failed()
+            await message.answer(f"Ошибка при формировании файла: {e}")
+
+
+# Фоновые задачи и ресурсы процесса бота (создаются при старте в on_startup)
+_background: List[asyncio.Task] = []
+_metrics_runner = None
+
+
+@dp.startup()
+async def on_startup(bot: Bot, worker_index: int = 0):
+    global _metrics_runner
+    # Настройки метрик задаём до создания пула: рабочие процессы их наследуют
+    metrics.configure(trace_memory=METRICS_TRACEMALLOC, profile_dir=PROFILE_DIR or None)
+    init_pool(WORKER_PROCESSES)
+    _background.append(asyncio.create_task(sessions.run_sweeper(SESSION_SWEEP_INTERVAL)))
+    _background.append(asyncio.create_task(summary_cache.run_expirer(SESSION_SWEEP_INTERVAL)))
+    if ENRICH_PROFILES:
+        _background.append(asyncio.create_task(profile_cache.run_expirer(SESSION_SWEEP_INTERVAL)))
+    if METRICS_PORT:
+        # У каждого процесса webhook-сервера свой порт метрик
+        _metrics_runner = await metrics.start_metrics_server(METRICS_HOST, METRICS_PORT + worker_index)
+    if BOT_MODE == "webhook" and worker_index == 0:
+        await bot.set_webhook(
+            WEBHOOK_BASE_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET or None,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+
+
+@dp.shutdown()
+async def on_shutdown():
+    global _metrics_runner
+    for task in _background:
+        task.cancel()
+    _background.clear()
+    if _metrics_runner is not None:
+        await _metrics_runner.cleanup()
+        _metrics_runner = None
+    shutdown_pool()
+    await sessions.backend.close()
 
 
 async def main():
     await dp.start_polling(bot)
 
 
+def run_webhook(worker_index: int = 0):
+    """
+    Приём обновлений через webhook. Несколько процессов слушают один порт
+    (SO_REUSEPORT), ядро распределяет между ними соединения.
+    """
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET or None).register(
+        app, path=WEBHOOK_PATH
+    )
+    setup_application(app, dp, bot=bot, worker_index=worker_index)
+    web.run_app(app, host=WEBHOOK_HOST, port=WEBHOOK_PORT, reuse_port=WEBHOOK_WORKERS > 1, print=None)
+
+
+def run():
+    logging.basicConfig(level=LOG_LEVEL, format="%(asctime)s %(levelname)s %(name)s %(message)s")
+    if BOT_MODE == "polling":
+        asyncio.run(main())
+        return
+    if BOT_MODE != "webhook":
+        raise SystemExit(f"Неизвестный BOT_MODE: {BOT_MODE} (ожидается polling или webhook)")
+    if not WEBHOOK_BASE_URL:
+        raise SystemExit("Для BOT_MODE=webhook нужен WEBHOOK_BASE_URL")
+    if WEBHOOK_WORKERS <= 1:
+        run_webhook()
+        return
+    if not sessions.backend.shared:
+        # Загрузка и /process могут попасть в разные процессы — сессии должны быть общими
+        raise SystemExit("WEBHOOK_WORKERS > 1 требует общего хранилища сессий (SESSION_STORE=redis)")
+    workers = [multiprocessing.Process(target=run_webhook, args=(i,)) for i in range(WEBHOOK_WORKERS)]
+    for p in workers:
+        p.start()
+    for p in workers:
+        p.join()
+
+
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    run()
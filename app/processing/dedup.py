@@ -0,0 +1,190 @@
+from bisect import bisect_right
+from typing import Dict, List, Optional
+
+# Грубая оценка памяти на один диапазон id (два int в списках), байт
+_RANGE_BYTES = 64
+
+
+class IdRanges:
+    """
+    Множество id сообщений в виде отсортированных непересекающихся диапазонов
+    [start, end]. id в экспорте идут подряд, поэтому на весь чат обычно
+    приходится несколько диапазонов, а не по записи на сообщение.
+    """
+
+    __slots__ = ("starts", "ends")
+
+    def __init__(self):
+        self.starts: List[int] = []
+        self.ends: List[int] = []
+
+    def __contains__(self, msg_id: int) -> bool:
+        i = bisect_right(self.starts, msg_id) - 1
+        return i >= 0 and msg_id <= self.ends[i]
+
+    def add(self, msg_id: int):
+        starts, ends = self.starts, self.ends
+        # Частый случай: id растут по порядку
+        if ends and ends[-1] + 1 == msg_id:
+            ends[-1] = msg_id
+            return
+        i = bisect_right(starts, msg_id) - 1
+        if i >= 0 and msg_id <= ends[i]:
+            return
+        joins_left = i >= 0 and ends[i] + 1 == msg_id
+        joins_right = i + 1 < len(starts) and starts[i + 1] - 1 == msg_id
+        if joins_left and joins_right:
+            ends[i] = ends[i + 1]
+            del starts[i + 1], ends[i + 1]
+        elif joins_left:
+            ends[i] = msg_id
+        elif joins_right:
+            starts[i + 1] = msg_id
+        else:
+            starts.insert(i + 1, msg_id)
+            ends.insert(i + 1, msg_id)
+
+    def add_range(self, start: int, end: int):
+        starts, ends = self.starts, self.ends
+        # Все диапазоны, пересекающиеся или соседствующие с [start, end], сливаются в один
+        lo = bisect_right(ends, start - 2)
+        hi = bisect_right(starts, end + 1)
+        if lo < hi:
+            start = min(start, starts[lo])
+            end = max(end, ends[hi - 1])
+        starts[lo:hi] = [start]
+        ends[lo:hi] = [end]
+
+    def update(self, other: "IdRanges"):
+        for start, end in zip(other.starts, other.ends):
+            self.add_range(start, end)
+
+    def overlaps(self, other: "IdRanges") -> bool:
+        """
+        Есть ли общие id: оба списка отсортированы, проход слиянием.
+        """
+        i = j = 0
+        while i < len(self.starts) and j < len(other.starts):
+            if self.ends[i] < other.starts[j]:
+                i += 1
+            elif other.ends[j] < self.starts[i]:
+                j += 1
+            else:
+                return True
+        return False
+
+    def covers(self, other: "IdRanges") -> bool:
+        """
+        Все ли id other есть здесь: соседние диапазоны слиты, поэтому каждый
+        диапазон other должен целиком лежать в одном из наших.
+        """
+        for start, end in zip(other.starts, other.ends):
+            i = bisect_right(self.starts, start) - 1
+            if i < 0 or end > self.ends[i]:
+                return False
+        return True
+
+    def count(self) -> int:
+        return sum(e - s + 1 for s, e in zip(self.starts, self.ends))
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+
+class MessageIdIndex:
+    """
+    Индекс уже учтённых сообщений по чатам. id сообщений уникальны только
+    внутри чата. Чат JSON-выгрузки определяется по id ("id:<id>"): названия
+    разных чатов могут совпадать. В HTML-экспорте id чата нет — там ключ
+    название (и с JSON-выгрузкой того же чата он не совпадает).
+    """
+
+    def __init__(self):
+        self.chats: Dict[str, IdRanges] = {}
+
+    def contains(self, chat: str, msg_id: int) -> bool:
+        ranges = self.chats.get(chat)
+        return ranges is not None and msg_id in ranges
+
+    def add(self, chat: str, msg_id: int):
+        ranges = self.chats.get(chat)
+        if ranges is None:
+            ranges = self.chats[chat] = IdRanges()
+        ranges.add(msg_id)
+
+    def update(self, other: "MessageIdIndex"):
+        for chat, ranges in other.chats.items():
+            mine = self.chats.get(chat)
+            if mine is None:
+                mine = self.chats[chat] = IdRanges()
+            mine.update(ranges)
+
+    def overlaps(self, other: "MessageIdIndex") -> bool:
+        for chat, ranges in other.chats.items():
+            mine = self.chats.get(chat)
+            if mine is not None and mine.overlaps(ranges):
+                return True
+        return False
+
+    def covers(self, other: "MessageIdIndex") -> bool:
+        for chat, ranges in other.chats.items():
+            mine = self.chats.get(chat)
+            if ranges and (mine is None or not mine.covers(ranges)):
+                return False
+        return True
+
+    def copy(self) -> "MessageIdIndex":
+        return MessageIdIndex.from_state(self.to_state())
+
+    def approx_size(self) -> int:
+        return sum(len(r) for r in self.chats.values()) * _RANGE_BYTES
+
+    def to_state(self) -> Dict[str, List[List[int]]]:
+        """
+        Состояние для сериализации (JSON): {чат: [starts, ends]}.
+        """
+        return {chat: [list(r.starts), list(r.ends)] for chat, r in self.chats.items()}
+
+    @classmethod
+    def from_state(cls, state: Dict[str, List[List[int]]]) -> "MessageIdIndex":
+        index = cls()
+        for chat, (starts, ends) in state.items():
+            ranges = index.chats[chat] = IdRanges()
+            ranges.starts = list(starts)
+            ranges.ends = list(ends)
+        return index
+
+    def __bool__(self) -> bool:
+        return bool(self.chats)
+
+
+class MessageIdFilter:
+    """
+    Пропускает сообщения, уже учтённые в seen (предыдущие файлы сессии)
+    или встреченные ранее в этом же разборе. Новые id копятся в new —
+    их потом добавляют в индекс сессии.
+    """
+
+    def __init__(self, seen: Optional[MessageIdIndex] = None):
+        self.seen = seen
+        self.new = MessageIdIndex()
+        self.skipped = 0
+
+    def contains(self, chat: Optional[str], msg_id: Optional[int]) -> bool:
+        """
+        Уже учтено ли сообщение — без учёта его в skipped и без добавления в new.
+        """
+        if msg_id is None:
+            return False
+        chat = chat or ""
+        return (self.seen is not None and self.seen.contains(chat, msg_id)) or self.new.contains(chat, msg_id)
+
+    def accept(self, chat: Optional[str], msg_id: Optional[int]) -> bool:
+        if msg_id is None:
+            return True
+        chat = chat or ""
+        if (self.seen is not None and self.seen.contains(chat, msg_id)) or self.new.contains(chat, msg_id):
+            self.skipped += 1
+            return False
+        self.new.add(chat, msg_id)
+        return True
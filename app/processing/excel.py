@@ -1,8 +1,261 @@
-from datetime import datetime
-from typing import List, Dict, Any
+import io
+import itertools
+import re
+import zipfile
+from datetime import datetime, timezone
+from typing import List, Dict, Any, BinaryIO, Iterable, Iterator, Optional, Sequence, Set
 from openpyxl import Workbook
 from openpyxl.styles import Font
 
+from app.utils import limits, metrics
+
+PARTICIPANT_HEADERS = [
+    "Дата экспорта", "Username", "Имя и фамилия", "Описание", "Дата регистрации", "Наличие канала в профиле",
+    "Сообщений", "Первое сообщение", "Последнее сообщение", "Упоминаний сделано", "Упомянут раз", "Упомянули (чел.)",
+]
+MENTION_HEADERS = ["Username", "Упоминаний", "Упомянули (чел.)", "Первое упоминание", "Последнее упоминание", "Описание"]
+CHANNEL_HEADERS = ["Name", "Username"]
+# Лист отдельного чата (выгрузка аккаунта): все сущности чата одной таблицей с типом
+CHAT_HEADERS = ["Тип", "Username", "Имя и фамилия", "Наличие канала в профиле", "Сообщений / упоминаний"]
+
+# Ограничения Excel на имя листа: до 31 символа, без []:*?/\ и апострофа по краям
+_SHEET_TITLE_MAX = 31
+_SHEET_TITLE_BAD_RE = re.compile(r"[\[\]:*?/\\]")
+
+# Предел строк на листе Excel (вместе с заголовком); дальше строки идут на лист «<имя> (2)»
+_SHEET_MAX_ROWS = 1_048_576
+
+# Строки буферизуются пачками перед сжатием
+_ROWS_PER_WRITE = 1000
+
+# Символы, запрещённые в XML 1.0 (openpyxl на них падает, мы их вырезаем)
+_ILLEGAL_XML_RE = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+_NS_MAIN = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+_NS_REL = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+_NS_PKG_REL = "http://schemas.openxmlformats.org/package/2006/relationships"
+_XML_DECL = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+
+# Два стиля ячеек: 0 — обычный, 1 — жирный (заголовки)
+_STYLES_XML = (
+    _XML_DECL
+    + f'<styleSheet xmlns="{_NS_MAIN}">'
+    '<fonts count="2"><font><sz val="11"/><name val="Calibri"/></font>'
+    '<font><b/><sz val="11"/><name val="Calibri"/></font></fonts>'
+    '<fills count="2"><fill><patternFill patternType="none"/></fill>'
+    '<fill><patternFill patternType="gray125"/></fill></fills>'
+    '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+    '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+    '<cellXfs count="2"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>'
+    '<xf numFmtId="0" fontId="1" fillId="0" borderId="0" xfId="0" applyFont="1"/></cellXfs>'
+    '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>'
+    "</styleSheet>"
+)
+
+
+def _username_cell(uname: str) -> str:
+    return f"@{uname}" if uname and not uname.startswith("@") else uname
+
+
+def _ts_cell(ts: Optional[int]) -> str:
+    # Время в результатах — unixtime; в таблицу пишем UTC
+    if not ts:
+        return ""
+    return datetime.fromtimestamp(ts, timezone.utc).strftime("%Y-%m-%d %H:%M")
+
+
+def _participant_rows(
+    participants: Iterable[Dict[str, Any]],
+    export_date: datetime,
+    mentions: Optional[Iterable[Dict[str, Any]]] = None,
+) -> Iterator[List[Any]]:
+    # Дата одинакова для всех строк — форматируем один раз
+    date_str = export_date.strftime("%Y-%m-%d")
+    # Сколько раз упомянут участник — известно только если в экспорте есть его username
+    mentioned = {m["username"].lstrip("@").lower(): m for m in mentions or () if m.get("username")}
+    for p in participants:
+        get = p.get
+        uname = get("username") or ""
+        m = mentioned.get(uname.lstrip("@").lower()) if uname else None
+        yield [
+            date_str,
+            uname,
+            get("name") or "",
+            get("bio") or "",
+            get("registered_at") or "",
+            "Да" if get("has_channel") else "Нет",
+            get("messages", 0),
+            _ts_cell(get("first_seen")),
+            _ts_cell(get("last_seen")),
+            get("mentions_made", 0),
+            m.get("count", 0) if m else "",
+            m.get("mentioners", 0) if m else "",
+        ]
+
+
+def _mention_rows(mentions: Iterable[Dict[str, Any]]) -> Iterator[List[Any]]:
+    for m in mentions:
+        uname = m.get("username")
+        if uname:
+            yield [
+                _username_cell(uname),
+                m.get("count", 0),
+                m.get("mentioners", 0),
+                _ts_cell(m.get("first_seen")),
+                _ts_cell(m.get("last_seen")),
+                m.get("bio") or "",
+            ]
+
+
+def _channel_rows(channels: Iterable[Dict[str, Any]]) -> Iterator[List[str]]:
+    for c in channels:
+        yield [c.get("name") or "", _username_cell(c.get("username") or "")]
+
+
+def _chat_rows(chat: Dict[str, Any]) -> Iterator[List[Any]]:
+    for p in chat.get("participants", []):
+        yield ["Участник", _username_cell(p.get("username") or ""), p.get("name") or "",
+               "Да" if p.get("has_channel") else "Нет", p.get("messages", 0)]
+    for m in _mention_rows(chat.get("mentions", [])):
+        yield ["Упоминание", m[0], "", "", m[1]]
+    for c in chat.get("channels", []):
+        yield ["Канал", _username_cell(c.get("username") or ""), c.get("name") or "", "", ""]
+
+
+def _sheet_title(title: str, used: Set[str]) -> str:
+    """
+    Допустимое и уникальное (без учёта регистра) имя листа.
+    """
+    base = _ILLEGAL_XML_RE.sub("", _SHEET_TITLE_BAD_RE.sub("_", title)).strip().strip("'").strip()
+    base = base[:_SHEET_TITLE_MAX] or "Лист"
+    candidate = base
+    n = 1
+    while candidate.lower() in used:
+        n += 1
+        suffix = f" ({n})"
+        candidate = base[:_SHEET_TITLE_MAX - len(suffix)].rstrip() + suffix
+    used.add(candidate.lower())
+    return candidate
+
+
+def _xml_text(value: Any) -> str:
+    text = _ILLEGAL_XML_RE.sub("", str(value))
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace('"', "&quot;")
+
+
+def _xml_cell(v: Any, s: str) -> str:
+    if v is None or v == "":
+        return "<c/>"
+    # Счётчики — числовые ячейки, чтобы по ним работали сортировка и формулы
+    if type(v) is int:
+        return f"<c{s}><v>{v}</v></c>"
+    return f'<c t="inlineStr"{s}><is><t xml:space="preserve">{_xml_text(v)}</t></is></c>'
+
+
+def _xml_row(row_idx: int, values: Sequence[Any], style: int = 0) -> str:
+    s = f' s="{style}"' if style else ""
+    cells = "".join(_xml_cell(v, s) for v in values)
+    return f'<row r="{row_idx}">{cells}</row>'
+
+
+class XlsxStreamWriter:
+    """
+    Потоковая запись xlsx прямо в бинарный поток (обычно BytesIO).
+    Строки пишутся из генераторов и сразу сжимаются: объекты ячеек не создаются,
+    временные файлы на диске не используются (в отличие от write-only режима openpyxl).
+    Листы записываются по одному, close() дописывает служебные части книги.
+    """
+
+    def __init__(self, out: BinaryIO):
+        self._zf = zipfile.ZipFile(out, "w", compression=zipfile.ZIP_DEFLATED)
+        self._titles: List[str] = []
+        # «History» Excel резервирует для себя
+        self._used_titles: Set[str] = {"history"}
+
+    def add_sheet(self, title: str, headers: Sequence[str], rows: Iterable[Sequence[Any]]):
+        """
+        Лист с заголовками и строками из rows. Строки сверх предела Excel
+        переносятся на следующие листы с тем же заголовком: «Участники (2)» и т. д.
+        """
+        rows = iter(rows)
+        while True:
+            # Имя листа приводится к ограничениям Excel (длина, символы, уникальность)
+            self._titles.append(_sheet_title(title, self._used_titles))
+            name = f"xl/worksheets/sheet{len(self._titles)}.xml"
+            # force_zip64: размер листа заранее неизвестен и может превысить 2 ГБ
+            with self._zf.open(name, "w", force_zip64=True) as f:
+                f.write((_XML_DECL + f'<worksheet xmlns="{_NS_MAIN}"><sheetData>').encode("utf-8"))
+                batch = [_xml_row(1, headers, style=1)]
+                row_idx = 1
+                for row in rows:
+                    row_idx += 1
+                    batch.append(_xml_row(row_idx, row))
+                    if len(batch) >= _ROWS_PER_WRITE:
+                        f.write("".join(batch).encode("utf-8"))
+                        batch.clear()
+                        limits.check()
+                    if row_idx >= _SHEET_MAX_ROWS:
+                        break
+                batch.append("</sheetData></worksheet>")
+                f.write("".join(batch).encode("utf-8"))
+            if row_idx < _SHEET_MAX_ROWS:
+                return
+            # Лист заполнен: следующий создаём, только если строки ещё остались
+            row = next(rows, None)
+            if row is None:
+                return
+            rows = itertools.chain((row,), rows)
+
+    def close(self):
+        n = len(self._titles)
+        overrides = "".join(
+            f'<Override PartName="/xl/worksheets/sheet{i}.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+            for i in range(1, n + 1)
+        )
+        self._zf.writestr(
+            "[Content_Types].xml",
+            _XML_DECL
+            + '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/xl/workbook.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+            '<Override PartName="/xl/styles.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+            + overrides
+            + "</Types>",
+        )
+        self._zf.writestr(
+            "_rels/.rels",
+            _XML_DECL
+            + f'<Relationships xmlns="{_NS_PKG_REL}">'
+            f'<Relationship Id="rId1" Type="{_NS_REL}/officeDocument" Target="xl/workbook.xml"/>'
+            "</Relationships>",
+        )
+        sheets = "".join(
+            f'<sheet name="{_xml_text(t)}" sheetId="{i}" r:id="rId{i}"/>'
+            for i, t in enumerate(self._titles, start=1)
+        )
+        self._zf.writestr(
+            "xl/workbook.xml",
+            _XML_DECL
+            + f'<workbook xmlns="{_NS_MAIN}" xmlns:r="{_NS_REL}"><sheets>{sheets}</sheets></workbook>',
+        )
+        rels = "".join(
+            f'<Relationship Id="rId{i}" Type="{_NS_REL}/worksheet" Target="worksheets/sheet{i}.xml"/>'
+            for i in range(1, n + 1)
+        )
+        self._zf.writestr(
+            "xl/_rels/workbook.xml.rels",
+            _XML_DECL
+            + f'<Relationships xmlns="{_NS_PKG_REL}">{rels}'
+            f'<Relationship Id="rId{n + 1}" Type="{_NS_REL}/styles" Target="styles.xml"/>'
+            "</Relationships>",
+        )
+        self._zf.writestr("xl/styles.xml", _STYLES_XML)
+        self._zf.close()
+
 
 def build_excel_workbook(
     participants: List[Dict[str, Any]],
@@ -23,46 +276,79 @@ def build_excel_workbook(
     - Описание (Bio/About)
     - Дата регистрации
     - Наличие канала в профиле
+    - Сообщений, первое/последнее сообщение (UTC), упоминаний сделано
+    - Упомянут раз и число упомянувших (если известен username)
+
+    Книга openpyxl целиком в памяти; для больших выгрузок используйте write_excel_stream.
     """
     wb = Workbook()
 
     # Участники
     ws_part = wb.active
     ws_part.title = "Участники"
-    headers = ["Дата экспорта", "Username", "Имя и фамилия", "Описание", "Дата регистрации", "Наличие канала в профиле"]
-    ws_part.append(headers)
+    ws_part.append(PARTICIPANT_HEADERS)
     for cell in ws_part[1]:
         cell.font = Font(bold=True)
-
-    for p in participants:
-        ws_part.append(
-            [
-                export_date.strftime("%Y-%m-%d"),
-                (p.get("username") or "") if p.get("username") else "",
-                (p.get("name") or "") if p.get("name") else "",
-                (p.get("bio") or "") if p.get("bio") else "",
-                (p.get("registered_at") or "") if p.get("registered_at") else "",
-                "Да" if p.get("has_channel") else "Нет",
-            ]
-        )
+    for row in _participant_rows(participants, export_date, mentions):
+        ws_part.append(row)
 
     # Упоминания
     ws_mentions = wb.create_sheet(title="Упоминания")
-    ws_mentions.append(["Username"])
-    ws_mentions["A1"].font = Font(bold=True)
-    for m in mentions:
-        uname = m.get("username")
-        if uname:
-            ws_mentions.append([f"@{uname}" if not uname.startswith("@") else uname])
+    ws_mentions.append(MENTION_HEADERS)
+    for cell in ws_mentions[1]:
+        cell.font = Font(bold=True)
+    for row in _mention_rows(mentions):
+        ws_mentions.append(row)
 
     # Каналы
     ws_channels = wb.create_sheet(title="Каналы")
-    ws_channels.append(["Name", "Username"])
+    ws_channels.append(CHANNEL_HEADERS)
     ws_channels["A1"].font = Font(bold=True)
     ws_channels["B1"].font = Font(bold=True)
-    for c in channels:
-        name = c.get("name") or ""
-        uname = c.get("username") or ""
-        ws_channels.append([name, f"@{uname}" if uname and not uname.startswith("@") else uname])
+    for row in _channel_rows(channels):
+        ws_channels.append(row)
+
+    return wb
+
+
+def write_excel_stream(
+    out: BinaryIO,
+    participants: Iterable[Dict[str, Any]],
+    mentions: Sequence[Dict[str, Any]],
+    channels: Iterable[Dict[str, Any]],
+    export_date: datetime,
+    chats: Optional[Iterable[Dict[str, Any]]] = None,
+):
+    """
+    Те же вкладки, что и build_excel_workbook, но с потоковой записью строк в out:
+    память не растёт с числом ячеек. chats — сущности по чатам выгрузки аккаунта:
+    после общих вкладок идёт по листу на каждый чат.
+    """
+    writer = XlsxStreamWriter(out)
+    writer.add_sheet("Участники", PARTICIPANT_HEADERS, _participant_rows(participants, export_date, mentions))
+    writer.add_sheet("Упоминания", MENTION_HEADERS, _mention_rows(mentions))
+    writer.add_sheet("Каналы", CHANNEL_HEADERS, _channel_rows(channels))
+    for chat in chats or ():
+        writer.add_sheet(chat.get("chat") or "Чат", CHAT_HEADERS, _chat_rows(chat))
+    writer.close()
+
 
-    return wb
\ No newline at end of file
+def build_excel_bytes(
+    participants: List[Dict[str, Any]],
+    mentions: List[Dict[str, Any]],
+    channels: List[Dict[str, Any]],
+    export_date: datetime,
+    chats: Optional[List[Dict[str, Any]]] = None,
+) -> bytes:
+    """
+    Формирует Excel потоково и возвращает готовый xlsx в виде байтов
+    (удобно для выполнения в рабочем процессе пула). Байты передаются
+    в BufferedInputFile как есть, без повторного копирования.
+    """
+    with metrics.stage("excel") as st:
+        buf = io.BytesIO()
+        write_excel_stream(buf, participants, mentions, channels, export_date, chats)
+        data = buf.getvalue()
+        buf.close()
+        st.messages = len(participants) + len(mentions) + len(channels)
+    return data
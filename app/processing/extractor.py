@@ -1,4 +1,13 @@
-from typing import Dict, Any, List, Set
+from array import array
+from typing import Dict, Any, Iterable, List, Optional, Set, Union
+
+from app.processing.normalize import MessageRecord
+
+# Грубая оценка памяти на одну сущность (dict/строка + ключ в словаре + счётчики), байт
+_ENTITY_BYTES = 256
+# Оценка памяти на одну пару (автор, username) в множестве упомянувших, байт
+_PAIR_BYTES = 72
+_PAIR_MASK = (1 << 32) - 1
 
 
 def _is_deleted_account(name: str | None, username: str | None) -> bool:
@@ -12,57 +21,268 @@ def _is_deleted_account(name: str | None, username: str | None) -> bool:
     return False
 
 
-def extract_entities(parsed: Dict[str, Any]) -> Dict[str, List[Dict[str, Any]]]:
-    """
-    Извлекает:
-    - participants: авторы сообщений (уникальные по имени, т.к. username в экспорте отсутствует)
-    - mentions: упомянутые @username
-    - channels: каналы (определяются по is_channel)
+def _widen(first: array, last: array, i: int, ts: int):
+    # Время 0 — неизвестно; первое/последнее расширяются известными значениями
+    if ts:
+        if not first[i] or ts < first[i]:
+            first[i] = ts
+        if ts > last[i]:
+            last[i] = ts
+
+
+class EntityAccumulator:
     """
+    Накопитель сущностей. Пополняется сообщениями (add_message) или готовыми
+    результатами extract_entities (add_entities) — так результаты отдельных
+    файлов, разобранных параллельно, сливаются в один.
+
+    Вместе с сущностями за тот же проход считается активность: у автора —
+    число сообщений, первое/последнее сообщение и число сделанных упоминаний,
+    у упомянутого username — число упоминаний, первое/последнее упоминание и
+    число разных упомянувших авторов. Авторам и username выдаются целые id,
+    счётчики и время хранятся в типизированных массивах (array), а не в dict на строку.
 
-    messages = parsed.get("messages", [])
+    Сообщения выгрузки всего аккаунта помечены названием и id чата: для них
+    дополнительно ведутся сущности по каждому чату (chats, ключ — id чата,
+    а без id — название; одноимённые чаты не сливаются).
+    """
 
-    participants_map: Dict[str, Dict[str, Any]] = {}
-    channels_map: Dict[str, Dict[str, Any]] = {}
-    mentions_set: Set[str] = set()
+    def __init__(self):
+        # Авторы: имя -> id, по id — username, признак канала и счётчики
+        self.author_ids: Dict[str, int] = {}
+        self.author_usernames: List[Optional[str]] = []
+        self.author_channel = array("b")
+        self.author_messages = array("q")
+        self.author_first = array("q")
+        self.author_last = array("q")
+        self.author_mentions = array("q")
+        # Упомянутые username: username -> id и счётчики по id
+        self.mention_ids: Dict[str, int] = {}
+        self.mention_counts = array("q")
+        self.mention_first = array("q")
+        self.mention_last = array("q")
+        self.mention_authors = array("q")
+        # Пары (автор, username) для подсчёта разных упомянувших: author_id << 32 | mention_id
+        self.mention_pairs: Set[int] = set()
+        self.channels_map: Dict[str, Dict[str, Any]] = {}
+        self.chats: Dict[Any, "EntityAccumulator"] = {}
+        self.chat_names: Dict[Any, str] = {}
 
-    for m in messages:
+    def add_message(self, m: Dict[str, Any]):
         frm = m.get("from") or {}
-        name = frm.get("name") or None
-        username = frm.get("username")  # всегда None, оставим для совместимости
-        is_channel = frm.get("is_channel", False)
+        args = (
+            frm.get("name") or None,
+            frm.get("username"),  # всегда None, оставим для совместимости
+            frm.get("is_channel", False),
+            m.get("mentions", []),
+            m.get("ts") or 0,
+        )
+        self._add(*args)
+        if m.get("chat") is not None:
+            self._chat(m["chat"], m.get("chat_id"))._add(*args)
+
+    def add_record(self, r: MessageRecord):
+        self._add(r.name or None, r.username, r.is_channel, r.mentions, r.ts or 0)
+        if r.chat is not None:
+            self._chat(r.chat, r.chat_id)._add(r.name or None, r.username, r.is_channel, r.mentions, r.ts or 0)
 
+    def _chat(self, name: str, chat_id: Optional[int] = None) -> "EntityAccumulator":
+        key = name if chat_id is None else chat_id
+        acc = self.chats.get(key)
+        if acc is None:
+            acc = self.chats[key] = EntityAccumulator()
+            self.chat_names[key] = name
+        return acc
+
+    def _add(self, name: str | None, username: str | None, is_channel: bool, mentions: Iterable[str], ts: int):
+        # Горячий путь: вызывается на каждое сообщение, поэтому без вспомогательных методов
         # ---- КАНАЛЫ ----
         if is_channel:
-            key = username or name or "unknown_channel"
-            if key not in channels_map:
-                channels_map[key] = {
-                    "name": name,
-                    "username": username
-                }
+            self._add_channel(name, username)
 
         # ---- УЧАСТНИКИ ----
         # В Telegram Desktop username отсутствует, поэтому различаем по имени
+        aid = -1
         if name:
-            if name not in participants_map:
-                participants_map[name] = {
-                    "name": name,
-                    "username": username,   # всегда None, но пусть поле будет
-                    "has_channel": is_channel,
-                }
-            else:
-                # обновляем флаг: если хоть раз писал как канал
-                participants_map[name]["has_channel"] = (
-                    participants_map[name]["has_channel"] or is_channel
-                )
+            aid = self.author_ids.get(name)
+            if aid is None or is_channel:
+                aid = self._author(name, username, is_channel)
+            self.author_messages[aid] += 1
+            if ts:
+                first = self.author_first
+                if not first[aid] or ts < first[aid]:
+                    first[aid] = ts
+                if ts > self.author_last[aid]:
+                    self.author_last[aid] = ts
 
         # ---- УПОМИНАНИЯ ----
-        for u in m.get("mentions", []):
-            if u:
-                mentions_set.add(u)
-
-    return {
-        "participants": list(participants_map.values()),
-        "mentions": [{"username": u} for u in sorted(list(mentions_set))],
-        "channels": list(channels_map.values()),
-    }
+        if not mentions:
+            return
+        mention_ids = self.mention_ids
+        for u in mentions:
+            if not u:
+                continue
+            mid = mention_ids.get(u)
+            if mid is None:
+                mid = self._mention(u)
+            self.mention_counts[mid] += 1
+            _widen(self.mention_first, self.mention_last, mid, ts)
+            if aid >= 0:
+                self.author_mentions[aid] += 1
+                self._add_pair(aid, mid)
+
+    def _author(self, name: str, username: str | None, is_channel: bool) -> int:
+        aid = self.author_ids.get(name)
+        if aid is None:
+            aid = self.author_ids[name] = len(self.author_usernames)
+            self.author_usernames.append(username)  # всегда None, но пусть поле будет
+            self.author_channel.append(1 if is_channel else 0)
+            for counters in (self.author_messages, self.author_first, self.author_last, self.author_mentions):
+                counters.append(0)
+        elif is_channel:
+            # обновляем флаг: если хоть раз писал как канал
+            self.author_channel[aid] = 1
+        return aid
+
+    def _mention(self, username: str) -> int:
+        mid = self.mention_ids.get(username)
+        if mid is None:
+            mid = self.mention_ids[username] = len(self.mention_counts)
+            for counters in (self.mention_counts, self.mention_first, self.mention_last, self.mention_authors):
+                counters.append(0)
+        return mid
+
+    def _add_pair(self, aid: int, mid: int):
+        pair = aid << 32 | mid
+        if pair not in self.mention_pairs:
+            self.mention_pairs.add(pair)
+            self.mention_authors[mid] += 1
+
+    def add_entities(self, entities: Dict[str, List[Dict[str, Any]]]):
+        for c in entities.get("channels", []):
+            self._add_channel(c.get("name"), c.get("username"))
+        # Индекс автора в списке participants -> id в этом накопителе (для mentioned_by)
+        local_ids = []
+        for p in entities.get("participants", []):
+            aid = self._author(p["name"], p.get("username"), p.get("has_channel", False))
+            local_ids.append(aid)
+            self.author_messages[aid] += p.get("messages", 0)
+            self.author_mentions[aid] += p.get("mentions_made", 0)
+            _widen(self.author_first, self.author_last, aid, p.get("first_seen") or 0)
+            _widen(self.author_first, self.author_last, aid, p.get("last_seen") or 0)
+        for m in entities.get("mentions", []):
+            if not m.get("username"):
+                continue
+            mid = self._mention(m["username"])
+            self.mention_counts[mid] += m.get("count", 0)
+            _widen(self.mention_first, self.mention_last, mid, m.get("first_seen") or 0)
+            _widen(self.mention_first, self.mention_last, mid, m.get("last_seen") or 0)
+            for idx in m.get("mentioned_by", ()):
+                self._add_pair(local_ids[idx], mid)
+        for chat in entities.get("chats", []):
+            self._chat(chat["chat"], chat.get("chat_id")).add_entities(chat)
+
+    def _add_channel(self, name: str | None, username: str | None):
+        key = username or name or "unknown_channel"
+        if key not in self.channels_map:
+            self.channels_map[key] = {
+                "name": name,
+                "username": username
+            }
+
+    def approx_size(self) -> int:
+        """
+        Приблизительный объём памяти, занимаемый накопленными сущностями.
+        """
+        count = len(self.author_ids) + len(self.channels_map) + len(self.mention_ids)
+        size = count * _ENTITY_BYTES + len(self.mention_pairs) * _PAIR_BYTES
+        return size + sum(acc.approx_size() for acc in self.chats.values())
+
+    def result(self) -> Dict[str, List[Dict[str, Any]]]:
+        """
+        Сущности со счётчиками активности (время — unixtime, None если неизвестно).
+        mentioned_by упоминания — индексы упомянувших авторов в participants:
+        по ним результаты разных файлов сливаются без двойного счёта.
+        При наличии чатов — ещё "chats": список {"chat": название, "chat_id": id
+        (None, если неизвестен), "participants", "mentions", "channels"} в порядке появления.
+        """
+        participants = [
+            {
+                "name": name,
+                "username": self.author_usernames[aid],
+                "has_channel": bool(self.author_channel[aid]),
+                "messages": self.author_messages[aid],
+                "first_seen": self.author_first[aid] or None,
+                "last_seen": self.author_last[aid] or None,
+                "mentions_made": self.author_mentions[aid],
+            }
+            for name, aid in self.author_ids.items()
+        ]
+        mentioned_by: Dict[int, List[int]] = {}
+        for pair in sorted(self.mention_pairs):
+            mentioned_by.setdefault(pair & _PAIR_MASK, []).append(pair >> 32)
+        mentions = [
+            {
+                "username": u,
+                "count": self.mention_counts[mid],
+                "mentioners": self.mention_authors[mid],
+                "first_seen": self.mention_first[mid] or None,
+                "last_seen": self.mention_last[mid] or None,
+                "mentioned_by": mentioned_by.get(mid, []),
+            }
+            for u, mid in sorted(self.mention_ids.items())
+        ]
+        out = {
+            "participants": participants,
+            "mentions": mentions,
+            "channels": [dict(c) for c in self.channels_map.values()],
+        }
+        if self.chats:
+            out["chats"] = [
+                {"chat": self.chat_names[key], "chat_id": key if isinstance(key, int) else None, **acc.result()}
+                for key, acc in self.chats.items()
+            ]
+        return out
+
+
+def approx_entities_size(entities: Dict[str, List[Dict[str, Any]]]) -> int:
+    """
+    Та же оценка памяти, что и EntityAccumulator.approx_size, для готового результата.
+    """
+    size = sum(len(rows) for key, rows in entities.items() if key not in ("chat", "chat_id", "chats")) * _ENTITY_BYTES
+    size += sum(len(m.get("mentioned_by", ())) for m in entities.get("mentions", ())) * _PAIR_BYTES
+    return size + sum(approx_entities_size(chat) for chat in entities.get("chats", []))
+
+
+def extract_entities(
+    parsed: Union[Dict[str, Any], Iterable[MessageRecord]],
+) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    Извлекает:
+    - participants: авторы сообщений (уникальные по имени, т.к. username в экспорте отсутствует)
+    - mentions: упомянутые @username
+    - channels: каналы (определяются по is_channel)
+
+    parsed — результат parse_telegram_export_streams ({"messages": [...]}, список
+    или генератор) либо поток MessageRecord из iter_message_records: тогда
+    сообщения сразу сводятся к сущностям и общий список не строится.
+    """
+
+    acc = EntityAccumulator()
+    messages = parsed.get("messages", []) if isinstance(parsed, dict) else parsed
+    for m in messages:
+        if isinstance(m, MessageRecord):
+            acc.add_record(m)
+        else:
+            acc.add_message(m)
+    return acc.result()
+
+
+def merge_entities(parts: List[Dict[str, List[Dict[str, Any]]]]) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    Объединяет результаты extract_entities по нескольким файлам (в порядке файлов).
+    """
+    acc = EntityAccumulator()
+    for entities in parts:
+        acc.add_entities(entities)
+    return acc.result()
@@ -0,0 +1,256 @@
+import calendar
+import re
+import sys
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+# Username в Telegram: латиница, цифры и «_», начинается с буквы, до 32 символов
+# (4-символьные — коллекционные username с Fragment). Слева не должно быть
+# буквы/цифры или «@» (иначе это e-mail или продолжение слова), справа — продолжения username.
+_USERNAME_RE = re.compile(r"(?<![\w@])@([A-Za-z][A-Za-z0-9_]{3,31})(?![A-Za-z0-9_])")
+
+# Ссылки вида https://t.me/<username>[/...]
+_TME_LINK_RE = re.compile(
+    r"(?:https?://)?(?:www\.)?(?:t|telegram)\.me/([A-Za-z][A-Za-z0-9_]{3,31})(?:[/?#]|$)",
+    re.IGNORECASE,
+)
+
+# Служебные пути t.me, которые не являются username
+_TME_RESERVED = frozenset({
+    "addemoji", "addlist", "addstickers", "addtheme", "boost", "confirmphone",
+    "invoice", "joinchat", "login", "proxy", "setlanguage", "share", "socks",
+})
+
+
+def username_from_link(url: str) -> Optional[str]:
+    """
+    Username из ссылки на t.me (None для служебных и невалидных ссылок).
+    """
+    m = _TME_LINK_RE.match(url)
+    if m is None:
+        return None
+    uname = m.group(1)
+    if uname.lower() in _TME_RESERVED:
+        return None
+    return uname
+
+
+def collect_mentions(text: str, links: Iterable[str] = (), explicit: Iterable[str] = ()) -> List[str]:
+    """
+    Упоминания сообщения без повторов (без учёта регистра, порядок первого появления):
+    сначала из ссылок, затем из явных сущностей-упоминаний, затем @username в тексте.
+    """
+    seen = set()
+    mentions = []
+
+    def add(uname: Optional[str]):
+        if uname:
+            key = uname.lower()
+            if key not in seen:
+                seen.add(key)
+                mentions.append(uname)
+
+    for url in links:
+        add(username_from_link(url))
+    for uname in explicit:
+        add(uname)
+    for uname in _USERNAME_RE.findall(text):
+        add(uname)
+    return mentions
+
+
+def flatten_text(value: Any) -> Tuple[str, List[str], List[str]]:
+    """
+    Один проход по полю text из result.json (строка или массив строк/сущностей).
+    Возвращает (текст, ссылки из сущностей, username из сущностей-упоминаний).
+    """
+    if isinstance(value, str):
+        return value, [], []
+    if not isinstance(value, list):
+        return "", [], []
+
+    parts = []
+    links = []
+    explicit = []
+    for t in value:
+        if isinstance(t, str):
+            parts.append(t)
+        elif isinstance(t, dict):
+            piece = t.get("text")
+            if isinstance(piece, str):
+                parts.append(piece)
+            kind = t.get("type")
+            if kind == "mention" and isinstance(piece, str):
+                m = _USERNAME_RE.match(piece)
+                if m:
+                    explicit.append(m.group(1))
+            elif kind == "text_link":
+                links.append(t.get("href") or "")
+            elif kind == "link" and isinstance(piece, str):
+                links.append(piece)
+    return "".join(parts), links, explicit
+
+
+def make_message(
+    name: Optional[str],
+    username: Optional[str],
+    is_channel: bool,
+    text: str,
+    mentions: List[str],
+    msg_id: Optional[int] = None,
+    chat: Optional[str] = None,
+    ts: Optional[int] = None,
+    chat_id: Optional[int] = None,
+) -> Dict[str, Any]:
+    """
+    Единый формат нормализованного сообщения для всех источников (JSON/ZIP/HTML).
+    id — идентификатор сообщения в чате (None, если в экспорте его нет);
+    chat — название чата в выгрузке всего аккаунта (None для выгрузки одного чата);
+    ts — время отправки, unixtime (None, если неизвестно);
+    chat_id — id чата в выгрузке аккаунта: по нему различаются одноимённые чаты.
+    """
+    return {
+        "id": msg_id,
+        "chat": chat,
+        "chat_id": chat_id,
+        "ts": ts,
+        "from": {"name": name, "username": username, "is_channel": is_channel},
+        "text": text,
+        "mentions": mentions,
+    }
+
+
+class MessageRecord:
+    """
+    Компактная проекция сообщения: только поля, которые читает extract_entities.
+    Текст не хранится, имена и username интернируются (повторяются у тысяч сообщений).
+    """
+
+    __slots__ = ("name", "username", "is_channel", "mentions", "msg_id", "chat", "ts", "chat_id")
+
+    def __init__(
+        self,
+        name: Optional[str],
+        username: Optional[str],
+        is_channel: bool,
+        mentions: Tuple[str, ...],
+        msg_id: Optional[int] = None,
+        chat: Optional[str] = None,
+        ts: Optional[int] = None,
+        chat_id: Optional[int] = None,
+    ):
+        self.name = name
+        self.username = username
+        self.is_channel = is_channel
+        self.mentions = mentions
+        self.msg_id = msg_id
+        self.chat = chat
+        self.ts = ts
+        self.chat_id = chat_id
+
+    def __repr__(self) -> str:
+        return (
+            f"MessageRecord({self.name!r}, {self.username!r}, {self.is_channel!r}, "
+            f"{self.mentions!r}, {self.msg_id!r}, {self.chat!r}, {self.ts!r}, {self.chat_id!r})"
+        )
+
+
+def make_record(
+    name: Optional[str],
+    username: Optional[str],
+    is_channel: bool,
+    text: str,
+    mentions: List[str],
+    msg_id: Optional[int] = None,
+    chat: Optional[str] = None,
+    ts: Optional[int] = None,
+    chat_id: Optional[int] = None,
+) -> MessageRecord:
+    """
+    То же, что make_message, но в режиме проекции: text отбрасывается.
+    """
+    return MessageRecord(
+        sys.intern(name) if name else name,
+        sys.intern(username) if username else username,
+        is_channel,
+        tuple(sys.intern(u) for u in mentions),
+        msg_id,
+        chat,
+        ts,
+        chat_id,
+    )
+
+
+# Сборщик нормализованного сообщения: make_message (полный dict) или make_record (проекция)
+MessageBuilder = Callable[..., Any]
+
+
+def json_timestamp(m: Dict[str, Any]) -> Optional[int]:
+    """
+    Время сообщения result.json: date_unixtime, а в старых выгрузках — date
+    (локальное время экспортировавшего, считаем его UTC).
+    """
+    unixtime = m.get("date_unixtime")
+    if isinstance(unixtime, str) and unixtime.isdigit():
+        return int(unixtime)
+    date = m.get("date")
+    if isinstance(date, str):
+        try:
+            return int(datetime.fromisoformat(date).replace(tzinfo=timezone.utc).timestamp())
+        except ValueError:
+            return None
+    return None
+
+
+_HTML_DATE_RE = re.compile(r"(\d{2})\.(\d{2})\.(\d{4}) (\d{2}):(\d{2}):(\d{2})(?: UTC([+-])(\d{2}):(\d{2}))?")
+
+
+def html_timestamp(title: Optional[str]) -> Optional[int]:
+    """
+    Время сообщения из title блока даты HTML-экспорта:
+    "31.12.2023 23:59:59 UTC+03:00" (без смещения в старых выгрузках — считаем UTC).
+    """
+    if not title:
+        return None
+    m = _HTML_DATE_RE.match(title.strip())
+    if m is None:
+        return None
+    day, month, year, hour, minute, second = (int(g) for g in m.groups()[:6])
+    try:
+        ts = calendar.timegm((year, month, day, hour, minute, second))
+    except ValueError:
+        return None
+    if m.group(7):
+        offset = int(m.group(8)) * 3600 + int(m.group(9)) * 60
+        ts -= offset if m.group(7) == "+" else -offset
+    return ts
+
+
+def normalize_json_message(
+    m: Dict[str, Any],
+    build: MessageBuilder = make_message,
+    chat: Optional[str] = None,
+    chat_id: Optional[int] = None,
+) -> Any:
+    """
+    Нормализация сообщения из result.json (загруженного напрямую или из ZIP).
+    """
+    from_id = m.get("from_id") or ""
+    # В экспорте Telegram Desktop username автора отсутствует; поля оставлены для совместимости
+    username = m.get("from_username") or m.get("author_username")
+    # Канал определяется по идентификатору автора: channel<id>
+    is_channel = isinstance(from_id, str) and from_id.startswith("channel")
+
+    text, links, explicit = flatten_text(m.get("text"))
+    # Старый формат сущностей: {"url": "https://t.me/..."}
+    for e in m.get("entities") or []:
+        if isinstance(e, dict) and e.get("url"):
+            links.append(e["url"])
+
+    msg_id = m.get("id")
+    if not isinstance(msg_id, int) or isinstance(msg_id, bool):
+        msg_id = None
+    return build(
+        m.get("from"), username, is_channel, text, collect_mentions(text, links, explicit), msg_id, chat,
+        json_timestamp(m), chat_id,
+    )
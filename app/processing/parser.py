@@ -1,239 +1,1046 @@
+import codecs
+import copy
 import io
 import json
+import logging
+import os
+import re
+import struct
+import time
 import zipfile
-from typing import List, Dict, Any
+from html.parser import HTMLParser
+from typing import List, Dict, Any, BinaryIO, Iterable, Iterator, Optional, Tuple
 from bs4 import BeautifulSoup
 import chardet
 
+from app.processing.dedup import MessageIdFilter
+from app.processing.normalize import (
+    MessageBuilder,
+    MessageRecord,
+    collect_mentions,
+    html_timestamp,
+    make_message,
+    make_record,
+    normalize_json_message,
+    username_from_link,
+)
+from app.utils import limits, metrics
 from app.utils.temp import InMemoryFile
 
+logger = logging.getLogger(__name__)
 
-def _decode_bytes_auto(data: bytes) -> str:
+# Движок разбора HTML: "fast" (потоковый html.parser) или "bs4" (BeautifulSoup + html5lib)
+HTML_ENGINE = os.getenv("HTML_ENGINE", "fast").lower()
+
+# Размер порции при потоковом чтении файлов экспорта
+_CHUNK_SIZE = 64 * 1024
+
+# Сколько байт из начала файла используется для определения кодировки
+_DETECT_SAMPLE_SIZE = 64 * 1024
+# BOM -> кодировка (UTF-32 проверяется раньше UTF-16: их BOM начинаются одинаково)
+_BOMS = [
+    (codecs.BOM_UTF32_LE, "utf-32"),
+    (codecs.BOM_UTF32_BE, "utf-32"),
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+]
+_NON_ASCII_RE = re.compile(rb"[\x80-\xff]")
+
+_JSON_WS = " \t\r\n"
+# Ближайший «структурный» символ JSON: скобка или начало строки
+_JSON_STRUCT_RE = re.compile(r'[\[\]{}"]')
+# Строка JSON целиком (с учётом экранирования)
+_JSON_STRING_RE = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"', re.S)
+# Строка с ключом перед значением: "key": (для skip_indented_array)
+_JSON_KEY_LINE_RE = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"[ \t]*:[ \t]*')
+# Начало объекта сообщения: Telegram Desktop пишет id первым полем
+_JSON_MSG_ID_RE = re.compile(r'\{\s*"id"\s*:\s*(-?\d+)\s*[,}]')
+# Сколько символов заведомо хватает, чтобы увидеть первое поле объекта
+_JSON_ID_LOOKAHEAD = 64
+# Списки чатов в выгрузке всего аккаунта («Export Telegram data»)
+_JSON_CHAT_LISTS = ("chats", "left_chats")
+
+
+def _detect_encoding(sample: bytes, complete: bool = False) -> str:
     """
-    Автоопределение кодировки и декодирование.
+    Многоступенчатое определение кодировки по началу файла:
+    1) BOM; 2) строгий UTF-8 (экспорт Telegram почти всегда в нём);
+    3) chardet по ограниченной выборке; 4) UTF-8 по умолчанию.
+    complete=True — sample содержит файл целиком.
     """
-    res = chardet.detect(data)
-    enc = res.get("encoding") or "utf-8"
+    for bom, enc in _BOMS:
+        if sample.startswith(bom):
+            return enc
     try:
-        return data.decode(enc, errors="replace")
-    except Exception:
-        return data.decode("utf-8", errors="replace")
+        # final=False: многобайтовый символ на границе выборки не считается ошибкой
+        codecs.getincrementaldecoder("utf-8")("strict").decode(sample, final=complete)
+        return "utf-8"
+    except UnicodeDecodeError:
+        pass
+    enc = chardet.detect(sample[:_DETECT_SAMPLE_SIZE]).get("encoding") or "utf-8"
+    try:
+        codecs.lookup(enc)
+    except LookupError:
+        return "utf-8"
+    return enc
+
+
+def _iter_text_chunks(
+    raw: BinaryIO,
+    encoding: str = "utf-8-sig",
+    errors: str = "strict",
+    head: bytes = b"",
+) -> Iterator[str]:
+    """
+    Инкрементальное декодирование бинарного потока порциями по _CHUNK_SIZE.
+    Полная декодированная копия файла в памяти не создаётся.
+    head — уже прочитанное начало потока.
+    """
+    decoder = codecs.getincrementaldecoder(encoding)(errors=errors)
+    chunk = head or raw.read(_CHUNK_SIZE)
+    while chunk:
+        # Кооперативная проверка лимитов задания: срок и /cancel (на порцию, не на сообщение —
+        # страница без сообщений, например с глубокой вложенностью, тоже прерывается)
+        limits.check()
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+        chunk = raw.read(_CHUNK_SIZE)
+    tail = decoder.decode(b"", final=True)
+    if tail:
+        yield tail
 
 
-def _parse_json_text(text: str) -> Dict[str, Any]:
+def _iter_decoded(raw: BinaryIO) -> Iterator[str]:
     """
-    Ожидаемый формат Telegram Desktop: result.json с messages и profile/participants.
+    Определяет кодировку по первым _DETECT_SAMPLE_SIZE байтам и декодирует поток
+    инкрементально (ошибочные байты заменяются, а не роняют разбор).
+    Время этапа decode включает чтение из raw (для ZIP — и распаковку).
     """
-    return json.loads(text)
+    started = time.perf_counter()
+    head = raw.read(_DETECT_SAMPLE_SIZE)
+    complete = len(head) < _DETECT_SAMPLE_SIZE
+    enc = _detect_encoding(head, complete)
+    metrics.record("detect_encoding", time.perf_counter() - started, bytes_in=len(head))
+    if enc == "utf-8" and not complete and head.isascii():
+        return metrics.timed_iter(_iter_ascii_prefixed(raw, head), "decode", count_messages=False)
+    if enc == "utf-8":
+        # utf-8-sig прозрачно съедает BOM, если он есть
+        enc = "utf-8-sig"
+    return metrics.timed_iter(_iter_text_chunks(raw, enc, errors="replace", head=head), "decode", count_messages=False)
+
+
+def _iter_ascii_prefixed(raw: BinaryIO, head: bytes) -> Iterator[str]:
+    """
+    Начало файла — чистый ASCII (типично для HTML-шапки), по нему кодировку не понять.
+    ASCII одинаково декодируется всеми поддерживаемыми кодировками, поэтому
+    окончательное решение принимается по первому фрагменту с не-ASCII байтами.
+    """
+    yield head.decode("ascii")
+    while True:
+        limits.check()
+        chunk = raw.read(_CHUNK_SIZE)
+        if not chunk:
+            return
+        if chunk.isascii():
+            yield chunk.decode("ascii")
+            continue
+        sample = chunk + raw.read(_DETECT_SAMPLE_SIZE)
+        # Выборку для определения начинаем с первого не-ASCII байта
+        first = _NON_ASCII_RE.search(sample).start()
+        enc = _detect_encoding(sample[first:first + _DETECT_SAMPLE_SIZE], complete=False)
+        if enc == "utf-8":
+            enc = "utf-8-sig"
+        yield from _iter_text_chunks(raw, enc, errors="replace", head=sample)
+        return
+
+
+class _JsonStream:
+    """
+    Потоковый читатель JSON поверх порций текста.
+    В памяти держится только текущий буфер (порядка одного значения + одна порция),
+    а не весь документ.
+    """
+
+    def __init__(self, chunks: Iterator[str]):
+        self._chunks = chunks
+        self._buf = ""
+        self._pos = 0
+        self._eof = False
+        self._decoder = json.JSONDecoder()
+
+    def _fill(self) -> bool:
+        if self._eof:
+            return False
+        chunk = next(self._chunks, None)
+        if chunk is None:
+            self._eof = True
+            return False
+        # Отбрасываем уже разобранную часть буфера
+        self._buf = self._buf[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def _peek(self) -> str:
+        """
+        Пропускает пробелы и возвращает следующий символ ("" в конце потока).
+        """
+        while True:
+            buf = self._buf
+            pos = self._pos
+            n = len(buf)
+            while pos < n and buf[pos] in _JSON_WS:
+                pos += 1
+            self._pos = pos
+            if pos < n:
+                return buf[pos]
+            if not self._fill():
+                return ""
+
+    def _expect(self, ch: str):
+        if self._peek() != ch:
+            raise ValueError(f"Некорректный JSON: ожидался символ {ch!r}")
+        self._pos += 1
+
+    def read_value(self) -> Any:
+        """
+        Разбирает одно значение целиком (объект сообщения, строку, число и т.п.).
+        """
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+            except json.JSONDecodeError:
+                # Значение не поместилось в буфер — дочитываем
+                if not self._fill():
+                    raise
+                continue
+            # Число на границе буфера могло оборваться — проверяем продолжение
+            if end == len(self._buf) and self._fill():
+                continue
+            self._pos = end
+            return value
+
+    def skip_value(self):
+        """
+        Пропускает значение, не строя объекты Python (для больших ненужных полей).
+        """
+        if self._peek() not in ("[", "{"):
+            self.read_value()
+            return
+        depth = 0
+        while True:
+            m = _JSON_STRUCT_RE.search(self._buf, self._pos)
+            if m is None:
+                self._pos = len(self._buf)
+                if not self._fill():
+                    raise ValueError("Некорректный JSON: неожиданный конец файла")
+                continue
+            c = m.group()
+            if c == '"':
+                s = _JSON_STRING_RE.match(self._buf, m.start())
+                if s is None:
+                    self._pos = m.start()
+                    if not self._fill():
+                        raise ValueError("Некорректный JSON: незакрытая строка")
+                    continue
+                self._pos = s.end()
+                continue
+            self._pos = m.end()
+            if c in "[{":
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    return
+
+    def skip_indented_array(self) -> bool:
+        """
+        Быстрый пропуск массива в JSON с отступами (так пишет Telegram Desktop): перевод
+        строки внутри JSON-строки экранируется, поэтому закрывающая скобка — первая
+        строка из отступа строки с ключом и "]", и её находит str.find без разбора.
+        Ключ должен стоять в начале своей строки, а массив — начинаться переводом строки.
+        Если разметка другая, ничего не пропускается и возвращается False.
+        """
+        if self._peek() != "[":
+            return False
+        buf = self._buf
+        pos = self._pos
+        line = buf.rfind("\n", 0, pos) + 1
+        if not line:
+            # Начало строки с ключом уже вытеснено из буфера
+            return False
+        head = buf[line:pos]
+        indent = head[:len(head) - len(head.lstrip(" \t"))]
+        if not _JSON_KEY_LINE_RE.fullmatch(head, len(indent)):
+            return False
+        while len(buf) - pos < 2 and self._fill():
+            buf = self._buf
+            pos = self._pos
+        if buf[pos + 1:pos + 2] not in ("\n", "\r"):
+            # Пустой или записанный в одну строку массив
+            return False
+        end = "\n" + indent + "]"
+        pos += 1
+        while True:
+            found = buf.find(end, pos)
+            if found >= 0:
+                self._pos = found + len(end)
+                return True
+            # Конец массива может прийтись на границу порций
+            self._pos = max(pos, len(buf) - len(end) + 1)
+            if not self._fill():
+                raise ValueError("Некорректный JSON: неожиданный конец файла")
+            buf = self._buf
+            pos = self._pos
+
+    def peek_message_id(self) -> Optional[int]:
+        """
+        id следующего объекта, если это его первое поле. Позиция не сдвигается:
+        объект затем читается (read_value) или пропускается (skip_value) целиком.
+        """
+        if self._peek() != "{":
+            return None
+        while True:
+            m = _JSON_MSG_ID_RE.match(self._buf, self._pos)
+            if m is not None:
+                return int(m.group(1))
+            # Начало объекта могло не поместиться в буфер
+            if len(self._buf) - self._pos >= _JSON_ID_LOOKAHEAD or not self._fill():
+                return None
+
+    def iter_object(self) -> Iterator[str]:
+        """
+        Перебирает ключи объекта. После каждого ключа вызывающий код обязан
+        прочитать или пропустить значение (read_value/skip_value/iter_*).
+        """
+        self._expect("{")
+        if self._peek() == "}":
+            self._pos += 1
+            return
+        while True:
+            key = self.read_value()
+            self._expect(":")
+            yield key
+            ch = self._peek()
+            self._pos += 1
+            if ch == "}":
+                return
+            if ch != ",":
+                raise ValueError("Некорректный JSON: ожидалась ',' или '}'")
+
+    def iter_array(self) -> Iterator[None]:
+        """
+        Перебирает элементы массива. На каждой итерации вызывающий код обязан
+        прочитать или пропустить очередной элемент.
+        """
+        self._expect("[")
+        if self._peek() == "]":
+            self._pos += 1
+            return
+        while True:
+            yield None
+            ch = self._peek()
+            self._pos += 1
+            if ch == "]":
+                return
+            if ch != ",":
+                raise ValueError("Некорректный JSON: ожидалась ',' или ']'")
+
+
+def _iter_chat_messages(
+    stream: _JsonStream,
+    chat: Optional[str],
+    tag: Optional[str],
+    build: MessageBuilder,
+    dedup: Optional[MessageIdFilter],
+    chat_id: Optional[int] = None,
+) -> Iterator[Any]:
+    """
+    Нормализованные сообщения массива messages одного чата.
+    chat — ключ чата для dedup; tag и chat_id — название и id чата для сообщений
+    (только в выгрузке аккаунта).
+    """
+    for _ in stream.iter_array():
+        msg_id = stream.peek_message_id() if dedup is not None else None
+        if msg_id is not None and not dedup.accept(chat, msg_id):
+            # raw_decode на C быстрее посимвольного skip_value для небольших объектов
+            stream.read_value()
+            continue
+        m = stream.read_value()
+        if not isinstance(m, dict):
+            continue
+        if dedup is not None and msg_id is None:
+            # id не первым полем — проверяем уже по разобранному объекту
+            other_id = m.get("id")
+            if isinstance(other_id, int) and not dedup.accept(chat, other_id):
+                continue
+        yield normalize_json_message(m, build, tag, chat_id)
+
+
+def _json_chat_id(value: Any) -> Optional[int]:
+    # id чата из JSON: только целое число (bool в Python — тоже int)
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    return None
+
+
+def _json_chat_key(chat_id: Optional[int], name: Optional[str]) -> Optional[str]:
+    """
+    Ключ чата для dedup в JSON-выгрузках: по id ("id:<id>"), а без id — по названию.
+    Одноимённые разные чаты так не сливаются; название как ключ остаётся только у HTML.
+    """
+    return f"id:{chat_id}" if chat_id is not None else name
+
+
+def _drain_array(stream: _JsonStream):
+    # Пропуск массива сообщений чужого шарда: в выгрузке Telegram Desktop (с отступами) —
+    # поиском закрывающей строки, иначе raw_decode по элементам (быстрее skip_value целиком)
+    if stream.skip_indented_array():
+        return
+    for _ in stream.iter_array():
+        stream.read_value()
+
+
+def _iter_account_chat(
+    stream: _JsonStream,
+    build: MessageBuilder,
+    dedup: Optional[MessageIdFilter],
+    skip: bool,
+) -> Iterator[Any]:
+    """
+    Один чат из chats.list выгрузки аккаунта: {"name", "type", "id", "messages"}.
+    Чаты различаются по id (названия могут совпадать), название — только для вывода.
+    skip — чат разбирает другой рабочий процесс, сообщения только пропускаются.
+    """
+    name = None
+    chat_id = None
+    for key in stream.iter_object():
+        ch = stream._peek()
+        if key == "name" and ch == '"':
+            name = stream.read_value()
+        elif key == "id" and ch not in ("[", "{"):
+            chat_id = stream.read_value()
+        elif key == "messages" and ch == "[":
+            if skip:
+                _drain_array(stream)
+                continue
+            # У «Избранного» и удалённых собеседников названия нет
+            title = name or (f"Чат {chat_id}" if chat_id is not None else "Без названия")
+            chat_id = _json_chat_id(chat_id)
+            yield from _iter_chat_messages(stream, _json_chat_key(chat_id, title), title, build, dedup, chat_id)
+        else:
+            stream.skip_value()
+
+
+def _iter_json_messages(
+    chunks: Iterator[str],
+    build: MessageBuilder = make_message,
+    dedup: Optional[MessageIdFilter] = None,
+    shard: Optional[Tuple[int, int]] = None,
+) -> Iterator[Any]:
+    """
+    Потоково перебирает сообщения result.json по одному объекту за раз и
+    отдаёт их нормализованными. Поддерживаются выгрузка одного чата
+    (верхнеуровневый messages) и выгрузка всего аккаунта (chats.list[*].messages,
+    left_chats.list[*].messages) — там сообщения помечаются названием чата.
+    Остальные поля пропускаются; в памяти одновременно одно сообщение.
+
+    dedup — фильтр повторов по id: у уже учтённых сообщений не выполняется
+    нормализация и поиск упоминаний. id берётся до разбора объекта, если он
+    стоит первым полем (как у Telegram Desktop). Чат для dedup — его id
+    (см. _json_chat_key), поэтому одноимённые выгрузки разных чатов не сливаются.
+
+    shard=(i, n) — разбор выгрузки аккаунта в n процессов: здесь обрабатываются
+    только чаты с порядковым номером i по модулю n (сообщения одного чата
+    в несколько процессов не попадают, поэтому dedup остаётся точным).
+    """
+    stream = _JsonStream(chunks)
+    chat = None
+    chat_id = None
+    ordinal = 0
+    for key in stream.iter_object():
+        ch = stream._peek()
+        if key == "name" and ch == '"':
+            chat = stream.read_value()
+        elif key == "id" and ch not in ("[", "{"):
+            chat_id = _json_chat_id(stream.read_value())
+        elif key == "messages" and ch == "[":
+            if shard is not None and shard[0] != 0:
+                _drain_array(stream)
+                continue
+            yield from _iter_chat_messages(stream, _json_chat_key(chat_id, chat), None, build, dedup)
+        elif key in _JSON_CHAT_LISTS and ch == "{":
+            for list_key in stream.iter_object():
+                if list_key != "list" or stream._peek() != "[":
+                    stream.skip_value()
+                    continue
+                for _ in stream.iter_array():
+                    skip = shard is not None and ordinal % shard[1] != shard[0]
+                    ordinal += 1
+                    if stream._peek() != "{":
+                        stream.skip_value()
+                        continue
+                    yield from _iter_account_chat(stream, build, dedup, skip)
+        else:
+            stream.skip_value()
+
+
+def _is_account_json(raw: BinaryIO) -> bool:
+    stream = _JsonStream(_iter_decoded(raw))
+    if stream._peek() != "{":
+        return False
+    for key in stream.iter_object():
+        if key == "messages":
+            return False
+        if key in _JSON_CHAT_LISTS:
+            return True
+        stream.skip_value()
+    return False
+
+
+def is_account_export(f: InMemoryFile) -> bool:
+    """
+    Выгрузка всего аккаунта (chats.list), а не одного чата. Читаются только
+    верхнеуровневые ключи до messages или chats.
+    """
+    with f.open() as raw:
+        if not f.name.lower().endswith(".zip"):
+            return _is_account_json(raw)
+        with zipfile.ZipFile(raw) as zf:
+            results = [i for i in zip_message_members(zf) if i.filename.lower().endswith(".json")]
+            if not results:
+                return False
+            with zf.open(results[0]) as member:
+                return _is_account_json(member)
+
+
+def _html_message(
+    from_name: Optional[str],
+    first_href: Optional[str],
+    classes: List[str],
+    text_content: str,
+    hrefs: List[str],
+    build: MessageBuilder = make_message,
+    msg_id: Optional[int] = None,
+    ts: Optional[int] = None,
+) -> Any:
+    """
+    Собирает нормализованное сообщение из полей, извлечённых любым HTML-движком.
+    """
+    from_username = None
+    is_channel = False
+
+    # Telegram экспорт иногда содержит ссылку на профиль/канал
+    # Попробуем найти username по ссылке
+    if first_href is not None:
+        from_username = username_from_link(first_href)
+        # Эвристика: сообщение помечено классом channel и есть ссылка на автора
+        if from_username and "channel" in classes:
+            is_channel = True
+
+    return build(from_name, from_username, is_channel, text_content, collect_mentions(text_content, hrefs), msg_id, None, ts)
+
+
+class _HtmlMessageState:
+    """
+    Состояние одного открытого div.message в потоковом HTML-парсере.
+    """
+
+    __slots__ = (
+        "depth", "classes", "msg_id", "first_href", "hrefs", "date",
+        "from_depth", "from_parts", "text_depth", "text_parts", "from_name", "done",
+    )
+
+    def __init__(self, depth: int, classes: List[str], msg_id: Optional[int]):
+        self.depth = depth
+        self.classes = classes
+        self.msg_id = msg_id
+        self.first_href: Optional[str] = None
+        self.hrefs: List[str] = []
+        # title блока даты: "31.12.2023 23:59:59 UTC+03:00"
+        self.date: Optional[str] = None
+        # 0 — блок ещё не встречался, >0 — открыт на этой глубине, -1 — уже закрыт
+        self.from_depth = 0
+        self.from_parts: List[str] = []
+        self.text_depth = 0
+        self.text_parts: List[str] = []
+        self.from_name: Optional[str] = None
+        self.done: Any = None
+
+    def finish(self, build: MessageBuilder, prev_from: Optional[str]):
+        from_name = "".join(self.from_parts) if self.from_depth else None
+        if from_name is None and "joined" in self.classes:
+            # Подряд идущие сообщения автора («joined») выводятся без его имени
+            from_name = prev_from
+        self.from_name = from_name
+        text_content = "\n".join(self.text_parts) if self.text_depth else ""
+        self.done = _html_message(
+            from_name, self.first_href, self.classes, text_content, self.hrefs, build, self.msg_id,
+            html_timestamp(self.date),
+        )
+
+
+# Отметка повтора в порядке сообщений потокового парсера
+_DUPLICATE = object()
 
 
-def _parse_html_text(text: str) -> Dict[str, Any]:
+def _html_message_id(div_id: Optional[str]) -> Optional[int]:
     """
-    Парсинг messages.html: извлекаем авторов, текст сообщений, упоминания и отметки каналов.
-    Возвращаем унифицированную структуру:
-    {
-      "messages": [
-         {
-           "from": {"name": "...", "username": "...", "is_channel": False},
-           "text": "message text",
-           "mentions": ["username1", "username2"]
-         },
-         ...
-      ]
-    }
+    id сообщения из атрибута id div-а: "message123" -> 123.
+    """
+    if div_id and div_id.startswith("message"):
+        tail = div_id[len("message"):]
+        if tail.isdigit():
+            return int(tail)
+    return None
+
+
+class _TelegramHTMLParser(HTMLParser):
+    """
+    Событийный (SAX-подобный) разбор messages.html без построения DOM.
+    Из каждого div.message берутся только from_name, ссылки и div.text —
+    результат совпадает с разбором через BeautifulSoup. Название чата
+    берётся из шапки страницы (div.page_header) — для фильтра повторов dedup.
+
+    Повтор определяется уже по открывающему тегу (содержимое не собирается),
+    но в dedup сообщение учитывается только при выдаче из drain: если разбор
+    упадёт, ещё не выданные сообщения разберёт запасной движок (см. _iter_html_stream).
+    consumed — сколько div.message (выданных и пропущенных) уже пройдено по порядку документа.
+    """
+
+    def __init__(self, build: MessageBuilder = make_message, dedup: Optional[MessageIdFilter] = None):
+        super().__init__(convert_charrefs=True)
+        self._build = build
+        self._dedup = dedup
+        self.chat: Optional[str] = None
+        # Те же отметки глубины, что и у блоков сообщения: 0 — не было, >0 — открыт, -1 — закрыт
+        self._header_depth = 0
+        self._chat_depth = 0
+        self._chat_parts: List[str] = []
+        self._div_depth = 0
+        self._open: List[_HtmlMessageState] = []
+        # Сообщения в порядке открывающих тегов (как у find_all)
+        self._order: List[_HtmlMessageState] = []
+        self._data: List[str] = []
+        # Автор предыдущего сообщения — для сообщений «joined»
+        self._last_from: Optional[str] = None
+        self.consumed = 0
+
+    def _flush_text(self):
+        if not self._data:
+            return
+        node = "".join(self._data).strip()
+        self._data.clear()
+        if not node:
+            return
+        if self._chat_depth > 0:
+            self._chat_parts.append(node)
+        for st in self._open:
+            if st.from_depth > 0:
+                st.from_parts.append(node)
+            if st.text_depth > 0:
+                st.text_parts.append(node)
+
+    def handle_data(self, data):
+        self._data.append(data)
+
+    def handle_comment(self, data):
+        self._flush_text()
+
+    def handle_decl(self, decl):
+        self._flush_text()
+
+    def handle_pi(self, data):
+        self._flush_text()
+
+    def handle_starttag(self, tag, attrs):
+        self._flush_text()
+        if tag == "div":
+            self._div_depth += 1
+            classes: List[str] = []
+            div_id = None
+            title = None
+            for k, v in attrs:
+                if k == "class":
+                    classes = (v or "").split()
+                elif k == "id":
+                    div_id = v
+                elif k == "title":
+                    title = v
+            if not classes:
+                return
+            if title and "date" in classes and self._open and self._open[-1].date is None:
+                self._open[-1].date = title
+            if self._header_depth == 0 and "page_header" in classes:
+                self._header_depth = self._div_depth
+            elif self._header_depth > 0 and self._chat_depth == 0 and "text" in classes:
+                self._chat_depth = self._div_depth
+            for st in self._open:
+                if st.from_depth == 0 and "from_name" in classes:
+                    st.from_depth = self._div_depth
+                if st.text_depth == 0 and "text" in classes:
+                    st.text_depth = self._div_depth
+            if "message" in classes:
+                msg_id = _html_message_id(div_id)
+                if self._dedup is not None and self._dedup.contains(self.chat, msg_id):
+                    # Повтор: содержимое сообщения не собираем, место в порядке документа сохраняем
+                    st = _HtmlMessageState(self._div_depth, classes, msg_id)
+                    st.done = _DUPLICATE
+                    self._order.append(st)
+                    return
+                st = _HtmlMessageState(self._div_depth, classes, msg_id)
+                self._open.append(st)
+                self._order.append(st)
+        elif tag == "a" and self._open:
+            for k, v in attrs:
+                if k == "href":
+                    href = v or ""
+                    for st in self._open:
+                        st.hrefs.append(href)
+                        if st.first_href is None:
+                            st.first_href = href
+                    break
+
+    def handle_endtag(self, tag):
+        self._flush_text()
+        if tag != "div" or self._div_depth == 0:
+            return
+        depth = self._div_depth
+        if self._chat_depth == depth:
+            self._chat_depth = -1
+            self.chat = "".join(self._chat_parts)
+        if self._header_depth == depth:
+            self._header_depth = -1
+        for st in self._open:
+            if st.from_depth == depth:
+                st.from_depth = -1
+            if st.text_depth == depth:
+                st.text_depth = -1
+        if self._open and self._open[-1].depth == depth:
+            self._finish(self._open.pop())
+        self._div_depth -= 1
+
+    def _finish(self, st: _HtmlMessageState):
+        st.finish(self._build, self._last_from)
+        if "service" not in st.classes:
+            self._last_from = st.from_name
+
+    def close(self):
+        super().close()
+        self._flush_text()
+        # Незакрытые в конце документа div.message закрываем неявно
+        while self._open:
+            self._finish(self._open.pop())
+
+    def drain(self) -> Iterator[Any]:
+        """
+        Отдаёт готовые сообщения, сохраняя порядок документа.
+        """
+        order = self._order
+        dedup = self._dedup
+        i = 0
+        while i < len(order) and order[i].done is not None:
+            st = order[i]
+            i += 1
+            self.consumed += 1
+            # Повторы внутри страницы видны только здесь: первый экземпляр учтён при выдаче
+            if dedup is not None and not dedup.accept(self.chat, st.msg_id):
+                continue
+            yield st.done
+        if i:
+            del order[:i]
+
+
+def _iter_html_messages(
+    chunks: Iterable[str],
+    build: MessageBuilder = make_message,
+    dedup: Optional[MessageIdFilter] = None,
+    parser: Optional[_TelegramHTMLParser] = None,
+) -> Iterator[Any]:
+    """
+    Потоковый разбор messages.html: сообщения отдаются по мере закрытия div.message.
+    """
+    if parser is None:
+        parser = _TelegramHTMLParser(build, dedup)
+    for chunk in chunks:
+        parser.feed(chunk)
+        yield from parser.drain()
+    parser.close()
+    yield from parser.drain()
+
+
+def _parse_html_text_bs4(
+    text: str,
+    build: MessageBuilder = make_message,
+    dedup: Optional[MessageIdFilter] = None,
+    skip: int = 0,
+) -> Dict[str, Any]:
+    """
+    Разбор messages.html через BeautifulSoup + html5lib (полный DOM).
+    Медленный, но максимально терпимый к «битой» разметке вариант.
+    skip — сколько первых div.message уже обработано потоковым движком.
     """
     soup = BeautifulSoup(text, "html5lib")
+    chat = None
+    header = soup.find("div", class_="page_header")
+    chat_div = header.find("div", class_="text") if header else None
+    if chat_div:
+        chat = chat_div.get_text(strip=True)
     messages = []
-    for msg_div in soup.find_all("div", class_="message"):
-        # Автор
-        from_name = None
-        from_username = None
-        is_channel = False
+    last_from = None
+    for i, msg_div in enumerate(soup.find_all("div", class_="message")):
+        classes = msg_div.get("class", [])
+        if i < skip:
+            # Уже выдано потоковым движком; автор нужен для следующих сообщений «joined»
+            from_div = msg_div.find("div", class_="from_name")
+            if "service" not in classes and (from_div or "joined" not in classes):
+                last_from = from_div.get_text(strip=True) if from_div else None
+            continue
+        msg_id = _html_message_id(msg_div.get("id"))
+        if dedup is not None and not dedup.accept(chat, msg_id):
+            continue
 
+        # Автор; у подряд идущих сообщений («joined») имя не выводится
+        from_name = None
         from_div = msg_div.find("div", class_="from_name")
         if from_div:
             from_name = from_div.get_text(strip=True)
+        elif "joined" in classes:
+            from_name = last_from
+        if "service" not in classes:
+            last_from = from_name
+        date_div = msg_div.find("div", class_="date", title=True)
 
-        # Telegram экспорт иногда содержит ссылку на профиль/канал
-        # Попробуем найти username по ссылке
         link = msg_div.find("a", href=True)
-        if link and link["href"].startswith("https://t.me/"):
-            uname = link["href"].split("/")[-1]
-            if uname:
-                from_username = uname
-                # Эвристика: если from_name выглядит как имя канала и нет явного пользователя
-                if "channel" in msg_div.get("class", []):
-                    is_channel = True
 
         # Текст сообщения
         text_div = msg_div.find("div", class_="text")
         text_content = text_div.get_text("\n", strip=True) if text_div else ""
 
-        # Упоминания
-        mentions = []
-        for a in msg_div.find_all("a", href=True):
-            href = a["href"]
-            if href.startswith("https://t.me/"):
-                uname = href.split("/")[-1]
-                if uname and uname not in mentions:
-                    mentions.append(uname)
-            # Также ищем явные @username в тексте
-        for t in text_content.split():
-            if t.startswith("@") and len(t) > 1:
-                uname = t[1:].strip().strip(",.;:!?()[]{}\"'")
-                if uname and uname not in mentions:
-                    mentions.append(uname)
-
         messages.append(
-            {
-                "from": {
-                    "name": from_name,
-                    "username": from_username,
-                    "is_channel": is_channel,
-                },
-                "text": text_content,
-                "mentions": mentions,
-            }
+            _html_message(
+                from_name,
+                link["href"] if link else None,
+                classes,
+                text_content,
+                [a["href"] for a in msg_div.find_all("a", href=True)],
+                build,
+                msg_id,
+                html_timestamp(date_div["title"]) if date_div else None,
+            )
         )
 
     return {"messages": messages}
 
 
-def _parse_zip(data: bytes) -> Dict[str, Any]:
-    """
-    Распаковка ZIP: ищем result.json или messages.html. Если оба — объединяем.
-    """
-    result: Dict[str, Any] = {"messages": []}
-    with zipfile.ZipFile(io.BytesIO(data)) as zf:
-        # Попробуем стандартные имена
-        json_candidates = [n for n in zf.namelist() if n.endswith("result.json")]
-        html_candidates = [n for n in zf.namelist() if n.endswith("messages.html")]
-
-        # JSON
-        for name in json_candidates:
-            with zf.open(name, "r") as f:
-                txt = _decode_bytes_auto(f.read())
-                j = _parse_json_text(txt)
-                # Нормализуем из JSON
-                msgs = []
-                for m in j.get("messages", []):
-                    from_obj = {}
-                    # Telegram JSON формат может иметь поля 'from', 'from_id', 'from_user', 'forwarded_from', т.п.
-                    author_name = m.get("from")
-                    author_username = m.get("from_username") or m.get("author_username")
-                    is_channel = m.get("type") == "channel" or m.get("from_id", "").startswith("channel")
-                    from_obj = {"name": author_name, "username": author_username, "is_channel": is_channel}
-
-                    text_content = ""
-                    if isinstance(m.get("text"), str):
-                        text_content = m.get("text")
-                    elif isinstance(m.get("text"), list):
-                        # Telegram экспорт может представлять текст как массив объектов/строк
-                        parts = []
-                        for t in m["text"]:
-                            if isinstance(t, str):
-                                parts.append(t)
-                            elif isinstance(t, dict) and "text" in t:
-                                parts.append(t["text"])
-                        text_content = " ".join(parts)
-
-                    mentions = []
-                    # Извлекаем упоминания из entities, если есть
-                    for e in m.get("entities", []):
-                        if isinstance(e, dict):
-                            url = e.get("url") or ""
-                            if url.startswith("https://t.me/"):
-                                uname = url.split("/")[-1]
-                                if uname and uname not in mentions:
-                                    mentions.append(uname)
-                    # А также из текста напрямую
-                    for token in text_content.split():
-                        if token.startswith("@") and len(token) > 1:
-                            uname = token[1:].strip(",.;:!?()[]{}\"'")
-                            if uname and uname not in mentions:
-                                mentions.append(uname)
-
-                    msgs.append({"from": from_obj, "text": text_content, "mentions": mentions})
-                result["messages"].extend(msgs)
-
-        # HTML
-        for name in html_candidates:
-            with zf.open(name, "r") as f:
-                txt = _decode_bytes_auto(f.read())
-                parsed_html = _parse_html_text(txt)
-                result["messages"].extend(parsed_html.get("messages", []))
-
-    return result
+def _iter_html_stream(
+    raw: BinaryIO,
+    build: MessageBuilder = make_message,
+    dedup: Optional[MessageIdFilter] = None,
+) -> Iterator[Any]:
+    """
+    Разбор messages.html из бинарного потока с автоопределением кодировки.
+    Если потоковый движок упал, страница перечитывается с начала и доразбирается
+    BeautifulSoup: уже выданные сообщения пропускаются, остальные идут как обычно.
+    """
+    if HTML_ENGINE == "bs4":
+        yield from _parse_html_text_bs4("".join(_iter_decoded(raw)), build, dedup).get("messages", [])
+        return
+    start = raw.tell() if raw.seekable() else None
+    parser = _TelegramHTMLParser(build, dedup)
+    try:
+        yield from _iter_html_messages(_iter_decoded(raw), build, dedup, parser)
+    except limits.JobAborted:
+        raise
+    except Exception as e:
+        if start is None:
+            raise
+        logger.warning("Fast HTML engine failed after %d messages, falling back to BeautifulSoup: %s",
+                       parser.consumed, e)
+        raw.seek(start)
+        text = "".join(_iter_decoded(raw))
+        yield from _parse_html_text_bs4(text, build, dedup, parser.consumed).get("messages", [])
 
 
-def parse_telegram_export_streams(files: List[InMemoryFile]) -> Dict[str, Any]:
+_ZIP_RESULT_RE = re.compile(r"(?:^|/)result\.json$", re.IGNORECASE)
+# HTML-экспорт разбит на страницы: messages.html, messages2.html, ... messagesN.html
+_ZIP_PAGE_RE = re.compile(r"(?:^|/)messages(\d*)\.html$", re.IGNORECASE)
+# Локальный заголовок члена ZIP: сигнатура и фиксированная часть (30 байт)
+_ZIP_LOCAL_HEADER = b"PK\x03\x04"
+_ZIP_LOCAL_HEADER_SIZE = 30
+
+
+def _natural_key(text: str) -> List[Any]:
+    # chat_2 < chat_10: числа в имени сравниваются как числа
+    return [int(part) if part.isdigit() else part.lower() for part in re.split(r"(\d+)", text)]
+
+
+def zip_message_members(zf: zipfile.ZipFile) -> List[zipfile.ZipInfo]:
     """
-    Принимает несколько файлов экспорта, возвращает объединённую структуру:
-    {"messages": [...]}.
+    Члены архива с сообщениями в исходном порядке: result.json, затем страницы
+    messages*.html по каталогам (в каждом — по номеру страницы). Выбор идёт
+    только по центральному каталогу: медиа и прочие файлы не читаются.
+    Каталог с выгрузкой в обоих форматах (result.json и messages*.html) — один
+    и тот же чат: берётся только result.json, иначе при параллельном разборе
+    страниц (каждая сверяется лишь с сессией) сообщения учлись бы дважды.
+    Если их распакованный объём больше лимита задания — LimitExceeded.
+    """
+    results = []
+    pages = []
+    for info in zf.infolist():
+        if info.is_dir():
+            continue
+        name = info.filename
+        m = _ZIP_RESULT_RE.search(name)
+        if m:
+            results.append((name[:m.start()], info))
+            continue
+        m = _ZIP_PAGE_RE.search(name)
+        if m:
+            pages.append((name[:m.start()], int(m.group(1) or 1), info))
+    json_dirs = {folder for folder, _ in results}
+    results.sort(key=lambda result: _natural_key(result[1].filename))
+    pages = [page for page in pages if page[0] not in json_dirs]
+    pages.sort(key=lambda page: (_natural_key(page[0]), page[1]))
+    members = [info for _, info in results] + [info for _, _, info in pages]
+    # Защита от ZIP-бомб: распакованный объём известен из каталога, zipfile не читает сверх него
+    limits.check_unpacked(sum(info.file_size for info in members))
+    return members
 
-    Обработка «на лету», без записи на диск.
+
+def _iter_member_messages(
+    stream: BinaryIO,
+    member: str,
+    build: MessageBuilder,
+    dedup: Optional[MessageIdFilter],
+    shard: Optional[Tuple[int, int]] = None,
+) -> Iterator[Any]:
+    # Член архива читается потоково, без распаковки целиком
+    if member.lower().endswith(".json"):
+        yield from _iter_json_messages(_iter_decoded(stream), build, dedup, shard)
+    elif shard is None or shard[0] == 0:
+        yield from _iter_html_stream(stream, build, dedup)
+
+
+def _iter_zip_messages(
+    raw: BinaryIO,
+    build: MessageBuilder = make_message,
+    dedup: Optional[MessageIdFilter] = None,
+    shard: Optional[Tuple[int, int]] = None,
+) -> Iterator[Any]:
+    """
+    Распаковка ZIP: result.json и все страницы messages*.html по порядку.
+    raw — поток с произвольным доступом (BytesIO или mmap): центральный каталог
+    читается с конца архива, без копирования архива целиком.
+    """
+    with zipfile.ZipFile(raw) as zf:
+        for info in zip_message_members(zf):
+            with zf.open(info, "r") as f:
+                yield from _iter_member_messages(f, info.filename, build, dedup, shard)
+
+
+def list_zip_pages(f: InMemoryFile) -> List[zipfile.ZipInfo]:
+    """
+    Члены архива с сообщениями (см. zip_message_members) для параллельного разбора.
+    """
+    with f.open() as raw, zipfile.ZipFile(raw) as zf:
+        return zip_message_members(zf)
+
+
+def zip_page_file(f: InMemoryFile, info: zipfile.ZipInfo) -> Tuple[InMemoryFile, zipfile.ZipInfo]:
+    """
+    Источник для разбора одного члена архива в рабочем процессе. Файл на диске
+    передаётся как есть (рабочий процесс отобразит его сам), из архива в памяти
+    вырезается только этот член — локальный заголовок и сжатые данные.
+    """
+    if f.path is not None:
+        return f, info
+    start = info.header_offset
+    name_len, extra_len = struct.unpack("<HH", f.data[start + 26:start + _ZIP_LOCAL_HEADER_SIZE])
+    end = start + _ZIP_LOCAL_HEADER_SIZE + name_len + extra_len + info.compress_size
+    page = copy.copy(info)
+    page.header_offset = 0
+    return InMemoryFile(name=f.name, mime=f.mime, data=f.data[start:end]), page
+
+
+def _open_zip_member(raw: BinaryIO, info: zipfile.ZipInfo) -> zipfile.ZipExtFile:
+    # Член открывается по смещению из центрального каталога, без повторного чтения каталога
+    raw.seek(info.header_offset)
+    header = raw.read(_ZIP_LOCAL_HEADER_SIZE)
+    if len(header) != _ZIP_LOCAL_HEADER_SIZE or header[:4] != _ZIP_LOCAL_HEADER:
+        raise zipfile.BadZipFile(f"Повреждён заголовок члена архива {info.filename}")
+    if info.flag_bits & 0x1:
+        raise zipfile.BadZipFile(f"Член архива {info.filename} зашифрован")
+    name_len, extra_len = struct.unpack("<HH", header[26:])
+    raw.seek(name_len + extra_len, io.SEEK_CUR)
+    return zipfile.ZipExtFile(raw, "r", info)
+
+
+def iter_zip_page_records(
+    f: InMemoryFile,
+    info: zipfile.ZipInfo,
+    dedup: Optional[MessageIdFilter] = None,
+) -> Iterator[MessageRecord]:
+    """
+    MessageRecord одного члена архива (страницы messages*.html или result.json),
+    f и info — из zip_page_file.
+    """
+    with f.open() as raw, _open_zip_member(raw, info) as stream:
+        yield from _iter_member_messages(stream, info.filename, make_record, dedup)
+
+
+def iter_telegram_export_messages(
+    files: List[InMemoryFile],
+    projection: bool = False,
+    dedup: Optional[MessageIdFilter] = None,
+    shard: Optional[Tuple[int, int]] = None,
+) -> Iterator[Any]:
     """
-    aggregated: Dict[str, Any] = {"messages": []}
+    Потоковый вариант parse_telegram_export_streams: отдаёт нормализованные
+    сообщения по одному. JSON разбирается инкрементально, без json.loads
+    на весь файл.
 
+    projection=True — режим проекции: вместо dict отдаются компактные
+    MessageRecord без текста (только то, что нужно extract_entities).
+    dedup — фильтр повторов по id сообщения (пересекающиеся выгрузки одного чата).
+    shard=(i, n) — только часть чатов выгрузки аккаунта (см. _iter_json_messages).
+    """
+    build = make_record if projection else make_message
     for f in files:
         name = (f.name or "").lower()
-        if name.endswith(".json"):
-            text = f.data.decode("utf-8")
-            j = _parse_json_text(text)
-            msgs = []
-            for m in j.get("messages", []):
-                author_name = m.get("from")  # имя автора
-                from_id = m.get("from_id", "")
-
-                # username НЕ существует => берем только None
-                author_username = None
-
-                # канал определяется только так:
-                is_channel = from_id.startswith("channel")
-
-                from_obj = {
-                    "name": author_name,
-                    "username": author_username,
-                    "is_channel": is_channel
-                }
-
-                text_content = ""
-                if isinstance(m.get("text"), str):
-                    text_content = m.get("text")
-                elif isinstance(m.get("text"), list):
-                    parts = []
-                    for t in m["text"]:
-                        if isinstance(t, str):
-                            parts.append(t)
-                        elif isinstance(t, dict) and "text" in t:
-                            parts.append(t["text"])
-                    text_content = " ".join(parts)
-
-                mentions = []
-                for e in m.get("entities", []):
-                    if isinstance(e, dict):
-                        url = e.get("url") or ""
-                        if url.startswith("https://t.me/"):
-                            uname = url.split("/")[-1]
-                            if uname and uname not in mentions:
-                                mentions.append(uname)
-                for token in text_content.split():
-                    if token.startswith("@") and len(token) > 1:
-                        uname = token[1:].strip(",.;:!?()[]{}\"'")
-                        if uname and uname not in mentions:
-                            mentions.append(uname)
-
-                msgs.append({"from": from_obj, "text": text_content, "mentions": mentions})
-            aggregated["messages"].extend(msgs)
-        elif name.endswith(".html"):
-            text = f.data.decode("utf-8")
-            parsed_html = _parse_html_text(text)
-            aggregated["messages"].extend(parsed_html.get("messages", []))
-        elif name.endswith(".zip"):
-            parsed_zip = _parse_zip(f.data)
-            aggregated["messages"].extend(parsed_zip.get("messages", []))
-        else:
+        if not name.endswith((".json", ".html", ".zip")):
             # Игнорируем неподдерживаемые (но сюда не попадём, фильтруется ранее)
             continue
+        # Файл с диска (локальный Bot API) читается через mmap, без копии в памяти
+        with f.open() as raw:
+            if name.endswith(".json"):
+                yield from _iter_json_messages(_iter_decoded(raw), build, dedup, shard)
+            elif name.endswith(".html"):
+                if shard is None or shard[0] == 0:
+                    yield from _iter_html_stream(raw, build, dedup)
+            else:
+                yield from _iter_zip_messages(raw, build, dedup, shard)
 
-    return aggregated
\ No newline at end of file
+
+def iter_message_records(
+    files: List[InMemoryFile],
+    dedup: Optional[MessageIdFilter] = None,
+    shard: Optional[Tuple[int, int]] = None,
+) -> Iterator[MessageRecord]:
+    """
+    Сообщения в режиме проекции — для потоковой передачи прямо в extract_entities.
+    """
+    return iter_telegram_export_messages(files, projection=True, dedup=dedup, shard=shard)
+
+
+def parse_telegram_export_streams(files: List[InMemoryFile]) -> Dict[str, Any]:
+    """
+    Принимает несколько файлов экспорта, возвращает объединённую структуру:
+    {"messages": [...]}. Сообщения, повторяющиеся в нескольких файлах
+    (по id внутри чата), попадают в результат один раз.
+
+    Обработка «на лету», без записи на диск.
+    """
+    return {"messages": list(iter_telegram_export_messages(files, dedup=MessageIdFilter()))}
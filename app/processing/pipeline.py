@@ -0,0 +1,96 @@
+import time
+import zipfile
+from typing import Dict, Any, Iterable, List, Optional, Tuple
+
+from app.processing.dedup import MessageIdFilter, MessageIdIndex
+from app.processing.parser import iter_message_records, iter_zip_page_records
+from app.processing.extractor import extract_entities, merge_entities
+from app.utils import limits, metrics
+from app.utils.temp import InMemoryFile
+
+
+def _parse_stage(file_name: str) -> str:
+    lower = file_name.lower()
+    for ext in ("json", "html", "zip"):
+        if lower.endswith("." + ext):
+            return f"parse_{ext}"
+    return "parse"
+
+
+def summarize_upload(
+    f: InMemoryFile,
+    seen: Optional[MessageIdIndex] = None,
+    shard: Optional[Tuple[int, int]] = None,
+) -> Tuple[Dict[str, List[Dict[str, Any]]], MessageIdIndex, int]:
+    """
+    Разбирает один файл экспорта и сразу сводит его к сущностям
+    (участники, упоминания, каналы). Сообщения идут в режиме проекции прямо
+    в извлечение — ни текстов, ни списка сообщений в памяти не остаётся.
+    Выполняется в рабочем процессе пула: обратно в бота передаётся только
+    компактный результат.
+
+    seen — id сообщений из уже загруженных файлов сессии: такие сообщения
+    пропускаются. Возвращает (сущности, id новых сообщений, число пропущенных).
+    shard=(i, n) — только i-я из n частей чатов выгрузки аккаунта: так чаты
+    разбираются в n процессах параллельно, каждый читает файл сам.
+
+    Разбор и извлечение идут вперемешку, поэтому время разбора меряется
+    по выдаче сообщений парсером, а извлечение — как остаток.
+    """
+    dedup = MessageIdFilter(seen)
+    return _summarize(iter_message_records([f], dedup, shard), _parse_stage(f.name), f.size, dedup)
+
+
+def summarize_zip_page(
+    f: InMemoryFile,
+    info: zipfile.ZipInfo,
+    seen: Optional[MessageIdIndex] = None,
+) -> Tuple[Dict[str, List[Dict[str, Any]]], MessageIdIndex, int]:
+    """
+    То же, что summarize_upload, для одного члена ZIP-архива (f и info —
+    из zip_page_file): страницы большого архива разбираются параллельно.
+    """
+    dedup = MessageIdFilter(seen)
+    return _summarize(iter_zip_page_records(f, info, dedup), "parse_zip", info.compress_size, dedup)
+
+
+def _summarize(records: Iterable[Any], stage: str, size: int, dedup: MessageIdFilter):
+    started = time.perf_counter()
+    # Лимиты задания (число сообщений, срок, /cancel) проверяются по ходу разбора и извлечения
+    records = metrics.timed_iter(limits.count_messages(records), stage, bytes_in=size)
+    entities = extract_entities(records)
+    metrics.record("extract", time.perf_counter() - started - records.seconds, messages=records.count)
+    return entities, dedup.new, dedup.skipped
+
+
+def merge_summaries(
+    parts: List[Tuple[Dict[str, List[Dict[str, Any]]], MessageIdIndex, int]],
+) -> Tuple[Dict[str, List[Dict[str, Any]]], MessageIdIndex, int]:
+    """
+    Объединяет итоги страниц архива (или частей выгрузки аккаунта) в их исходном порядке.
+    """
+    message_ids = MessageIdIndex()
+    for _, ids, _ in parts:
+        message_ids.update(ids)
+    return merge_entities([entities for entities, _, _ in parts]), message_ids, sum(skipped for _, _, skipped in parts)
+
+
+def summaries_overlap(parts: List[Tuple[Dict[str, List[Dict[str, Any]]], MessageIdIndex, int]]) -> bool:
+    """
+    Есть ли сообщения, учтённые сразу в нескольких частях (например, одна и та же
+    страница дважды в архиве). Части разбираются независимо, и такие сообщения
+    посчитаны в каждой, поэтому итог надо получать последовательным разбором.
+    """
+    seen = MessageIdIndex()
+    for _, ids, _ in parts:
+        if seen.overlaps(ids):
+            return True
+        seen.update(ids)
+    return False
+
+
+def summarize_file(f: InMemoryFile) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    Сущности одного файла без учёта других файлов сессии.
+    """
+    return summarize_upload(f)[0]
@@ -0,0 +1,141 @@
+import asyncio
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from app.processing.dedup import MessageIdIndex
+from app.processing.extractor import approx_entities_size
+from app.utils.temp import InMemoryFile, MappedFile
+
+logger = logging.getLogger(__name__)
+
+Entities = Dict[str, List[Dict[str, Any]]]
+# Итог разбора файла: сущности и id его сообщений (для фильтра повторов в сессии)
+Summary = Tuple[Entities, MessageIdIndex]
+
+
+def content_key(data: Any) -> str:
+    """
+    Ключ кэша по содержимому файла (bytes или любой буфер, например mmap).
+    hashlib отпускает GIL на больших буферах, поэтому хэш можно считать
+    в отдельном потоке (asyncio.to_thread).
+    """
+    return hashlib.blake2b(data, digest_size=20).hexdigest()
+
+
+def file_key(f: InMemoryFile) -> str:
+    """
+    content_key для загруженного файла; файл на диске хэшируется через mmap без копирования.
+    """
+    if f.path is None:
+        return content_key(f.data)
+    with f.open() as raw:
+        return content_key(raw.mapping if isinstance(raw, MappedFile) else raw.read())
+
+
+class SummaryCache:
+    """
+    LRU-кэш итогов разбора файлов: ключ — хэш содержимого, значение — только
+    сведённые сущности (участники, упоминания, каналы) и диапазоны id сообщений.
+    Сами файлы и тексты сообщений не хранятся. Записи вытесняются по сроку жизни, по суммарному
+    объёму и по числу записей.
+    """
+
+    def __init__(self, max_bytes: int, ttl: float, max_entries: int = 1000):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # key -> (итог разбора, оценка размера, момент истечения)
+        self._entries: "OrderedDict[str, Tuple[Summary, int, float]]" = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0 and self.max_entries > 0
+
+    def get(self, key: str) -> Optional[Summary]:
+        """
+        Итог разбора по ключу или None. Результат нельзя изменять — он общий
+        для всех, кто загрузит тот же файл (EntityAccumulator.add_entities
+        и MessageIdIndex.update его копируют).
+        """
+        entry = self._entries.get(key)
+        if entry is not None and entry[2] < time.monotonic():
+            self._drop(key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key: str, entities: Entities, message_ids: MessageIdIndex):
+        """
+        Кэшировать можно только полный итог файла — без пропуска сообщений,
+        уже встречавшихся в сессии.
+        """
+        if not self.enabled:
+            return
+        size = approx_entities_size(entities) + message_ids.approx_size()
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._drop(key)
+        self._entries[key] = ((entities, message_ids), size, time.monotonic() + self.ttl)
+        self._bytes += size
+        while self._bytes > self.max_bytes or len(self._entries) > self.max_entries:
+            self._drop(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _drop(self, key: str):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def expire(self) -> int:
+        """
+        Удаляет записи с истёкшим сроком. Возвращает число удалённых.
+        """
+        now = time.monotonic()
+        expired = [key for key, (_, _, expires) in self._entries.items() if expires < now]
+        for key in expired:
+            self._drop(key)
+        return len(expired)
+
+    async def run_expirer(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            expired = self.expire()
+            if expired:
+                logger.info("Expired %d cached summaries, %d cached", expired, len(self._entries))
+
+    def used_bytes(self) -> int:
+        return self._bytes
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def render(self) -> List[str]:
+        """
+        Счётчики кэша в формате Prometheus (подключается через metrics.register).
+        """
+        return [
+            "# HELP tgbot_summary_cache_requests_total Summary cache lookups",
+            "# TYPE tgbot_summary_cache_requests_total counter",
+            f'tgbot_summary_cache_requests_total{{result="hit"}} {self.hits}',
+            f'tgbot_summary_cache_requests_total{{result="miss"}} {self.misses}',
+            "# HELP tgbot_summary_cache_evictions_total Entries evicted by size or count",
+            "# TYPE tgbot_summary_cache_evictions_total counter",
+            f"tgbot_summary_cache_evictions_total {self.evictions}",
+            "# HELP tgbot_summary_cache_entries Cached file summaries",
+            "# TYPE tgbot_summary_cache_entries gauge",
+            f"tgbot_summary_cache_entries {len(self._entries)}",
+            "# HELP tgbot_summary_cache_bytes Estimated memory of cached summaries",
+            "# TYPE tgbot_summary_cache_bytes gauge",
+            f"tgbot_summary_cache_bytes {self._bytes}",
+        ]
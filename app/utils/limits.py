@@ -0,0 +1,202 @@
+import contextvars
+import itertools
+import multiprocessing
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Iterable, Iterator, Optional, Tuple
+
+# Как часто (в сообщениях) проверять лимиты в цикле разбора/извлечения
+_CHECK_EVERY = 4096
+# Слоты флагов отмены, общих для бота и рабочих процессов пула: заданию id соответствует
+# слот id % _CANCEL_SLOTS. Одновременных заданий заведомо меньше числа слотов
+_CANCEL_SLOTS = 1024
+
+_job_ids = itertools.count(1)
+_call_ids = itertools.count(1)
+# Лимиты текущего задания: в обработчике бота и внутри вызова в рабочем процессе пула
+_current: contextvars.ContextVar[Optional["JobLimits"]] = contextvars.ContextVar("job_limits", default=None)
+# Флаги отмены: создаются в боте до запуска пула, рабочие процессы получают их при старте (init_worker)
+_cancelled: Optional[Any] = None
+# Начало вызовов в пуле: пары (id вызова, time.time()) в тех же слотах, по id % _CANCEL_SLOTS
+_started: Optional[Any] = None
+
+
+class JobAborted(Exception):
+    """
+    Задание остановлено до завершения. Текст — причина, понятная пользователю.
+    """
+
+
+class LimitExceeded(JobAborted):
+    """
+    Задание превысило лимит (время, объём распаковки, число сообщений).
+    """
+
+
+class JobCancelled(JobAborted):
+    """
+    Задание отменено пользователем (/cancel).
+    """
+
+
+class JobLimits:
+    """
+    Лимиты одного задания (разбор файла или /process). Передаются в рабочий
+    процесс вместе с вызовом; проверки кооперативные — их вызывают циклы
+    разбора, извлечения и записи Excel (check, count_messages, check_unpacked).
+    Нулевое значение лимита — без ограничения.
+    """
+
+    __slots__ = ("job_id", "max_seconds", "deadline", "max_messages", "max_unpacked", "messages")
+
+    def __init__(self, max_seconds: float = 0, max_messages: int = 0, max_unpacked: int = 0):
+        self.job_id = next(_job_ids)
+        self.max_seconds = max_seconds
+        # Абсолютное время (time.time): одинаково в боте и в рабочих процессах
+        self.deadline = time.time() + max_seconds if max_seconds else 0.0
+        self.max_messages = max_messages
+        self.max_unpacked = max_unpacked
+        self.messages = 0
+
+    def remaining(self) -> Optional[float]:
+        if not self.deadline:
+            return None
+        return max(0.0, self.deadline - time.time())
+
+    def check(self):
+        if self.deadline and time.time() > self.deadline:
+            raise LimitExceeded(f"превышено время обработки ({self.max_seconds:g} с)")
+        if is_cancelled(self.job_id):
+            raise JobCancelled("обработка отменена")
+
+    def add_messages(self, n: int):
+        self.messages += n
+        if self.max_messages and self.messages > self.max_messages:
+            raise LimitExceeded(f"слишком много сообщений (больше {self.max_messages})")
+
+
+def init_worker(cancelled: Any, started: Any = None):
+    """
+    Инициализатор рабочего процесса пула: флаги отмены и отметки начала вызовов, общие с ботом.
+    """
+    global _cancelled, _started
+    _cancelled = cancelled
+    _started = started
+
+
+def cancel_flags() -> Any:
+    """
+    Общий массив флагов отмены (создаётся один раз, до запуска пула).
+    """
+    global _cancelled
+    if _cancelled is None:
+        _cancelled = multiprocessing.RawArray("q", _CANCEL_SLOTS)
+    return _cancelled
+
+
+def start_marks() -> Any:
+    """
+    Общий массив отметок начала вызовов (создаётся один раз, до запуска пула).
+    """
+    global _started
+    if _started is None:
+        _started = multiprocessing.RawArray("d", 2 * _CANCEL_SLOTS)
+    return _started
+
+
+def next_call_id() -> int:
+    return next(_call_ids)
+
+
+def started_at(call_id: int) -> Optional[float]:
+    """
+    Когда вызов call_id начал выполняться в пуле (time.time) или None, если ещё ждёт в очереди.
+    """
+    marks = start_marks()
+    slot = 2 * (call_id % _CANCEL_SLOTS)
+    if marks[slot] != call_id:
+        return None
+    return marks[slot + 1]
+
+
+def cancel(job_id: int):
+    """
+    Просит задание остановиться: рабочий процесс увидит флаг при ближайшей проверке.
+    """
+    cancel_flags()[job_id % _CANCEL_SLOTS] = job_id
+
+
+def is_cancelled(job_id: int) -> bool:
+    return _cancelled is not None and _cancelled[job_id % _CANCEL_SLOTS] == job_id
+
+
+def current() -> Optional[JobLimits]:
+    return _current.get()
+
+
+@contextmanager
+def job(limits: Optional[JobLimits]) -> Iterator[Optional[JobLimits]]:
+    """
+    Делает limits лимитами текущего задания (для run_in_pool и проверок в этом процессе).
+    """
+    token = _current.set(limits)
+    try:
+        yield limits
+    finally:
+        _current.reset(token)
+
+
+def run_limited(limits: Optional[JobLimits], fn: Callable[..., Any], args: Tuple[Any, ...], call_id: int = 0) -> Any:
+    """
+    Обёртка вызова в рабочем процессе: лимиты задания действуют на время fn(*args).
+    call_id — id вызова для отметки о начале (см. started_at).
+    """
+    if call_id:
+        marks = start_marks()
+        slot = 2 * (call_id % _CANCEL_SLOTS)
+        marks[slot + 1] = time.time()
+        marks[slot] = call_id
+    if limits is not None:
+        limits.check()
+    with job(limits):
+        return fn(*args)
+
+
+def check():
+    """
+    Кооперативная проверка лимитов текущего задания (дешёвая: вызывать на каждую порцию данных).
+    """
+    limits = _current.get()
+    if limits is not None:
+        limits.check()
+
+
+def check_unpacked(nbytes: int):
+    """
+    Проверка объёма распаковки по размерам из центрального каталога архива — до чтения членов.
+    """
+    limits = _current.get()
+    if limits is not None and limits.max_unpacked and nbytes > limits.max_unpacked:
+        raise LimitExceeded(
+            f"архив распаковывается в {nbytes // (1024 * 1024)} МБ "
+            f"(допускается не больше {limits.max_unpacked // (1024 * 1024)} МБ)"
+        )
+
+
+def count_messages(items: Iterable[Any]) -> Iterator[Any]:
+    """
+    Пропускает сообщения, считая их и проверяя лимиты каждые _CHECK_EVERY сообщений.
+    """
+    limits = _current.get()
+    if limits is None:
+        yield from items
+        return
+    n = 0
+    for item in items:
+        yield item
+        n += 1
+        if n == _CHECK_EVERY:
+            limits.add_messages(n)
+            limits.check()
+            n = 0
+    limits.add_messages(n)
@@ -0,0 +1,347 @@
+import cProfile
+import contextvars
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+import tracemalloc
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм
+_SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+_BYTES_BUCKETS = tuple(2 ** p for p in range(20, 33))  # 1 МБ .. 4 ГБ
+_RATE_BUCKETS = (100, 1_000, 10_000, 50_000, 100_000, 250_000, 500_000, 1_000_000, 5_000_000)
+
+# Сбор замеров внутри рабочего процесса/потока пула (см. run_instrumented)
+_local = threading.local()
+# Текущее задание (загрузка файла или /process) в обработчике бота
+_current_job: contextvars.ContextVar[Optional["Job"]] = contextvars.ContextVar("metrics_job", default=None)
+
+_job_ids = itertools.count(1)
+_trace_memory = False
+_profile_dir: Optional[str] = None
+
+
+def _num(value: float) -> str:
+    # Целые значения (байты, счётчики) без экспоненты, дробные — с полной точностью
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Histogram:
+    """
+    Гистограмма в духе Prometheus: накопительные корзины, сумма и количество.
+    """
+
+    def __init__(self, name: str, help_text: str, buckets: Sequence[float], label: str):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        self.label = label
+        self._series: Dict[str, List[float]] = {}
+
+    def observe(self, label_value: str, value: float):
+        series = self._series.get(label_value)
+        if series is None:
+            # счётчики корзин + «+Inf», сумма
+            series = self._series[label_value] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for label_value, series in sorted(self._series.items()):
+            lbl = f'{self.label}="{label_value}"'
+            total = 0
+            for bound, count in zip(self.buckets, series):
+                total += count
+                lines.append(f'{self.name}_bucket{{{lbl},le="{_num(bound)}"}} {total}')
+            total += series[len(self.buckets)]
+            lines.append(f'{self.name}_bucket{{{lbl},le="+Inf"}} {total}')
+            lines.append(f"{self.name}_sum{{{lbl}}} {_num(series[-1])}")
+            lines.append(f"{self.name}_count{{{lbl}}} {total}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, label: str):
+        self.name = name
+        self.help = help_text
+        self.label = label
+        self._values: Dict[str, float] = {}
+
+    def inc(self, label_value: str, value: float = 1):
+        self._values[label_value] = self._values.get(label_value, 0) + value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for label_value, value in sorted(self._values.items()):
+            lines.append(f'{self.name}{{{self.label}="{label_value}"}} {_num(value)}')
+        return lines
+
+
+STAGE_SECONDS = Histogram("tgbot_stage_seconds", "Wall time of a processing stage", _SECONDS_BUCKETS, "stage")
+STAGE_BYTES = Counter("tgbot_stage_bytes_total", "Input bytes handled by a stage", "stage")
+STAGE_MESSAGES = Counter("tgbot_stage_messages_total", "Messages handled by a stage", "stage")
+STAGE_RATE = Histogram("tgbot_stage_messages_per_second", "Stage throughput", _RATE_BUCKETS, "stage")
+JOB_SECONDS = Histogram("tgbot_job_seconds", "Wall time of a job", _SECONDS_BUCKETS, "kind")
+JOB_PEAK_MEMORY = Histogram("tgbot_job_peak_traced_bytes", "Peak traced memory of a job", _BYTES_BUCKETS, "kind")
+JOBS = Counter("tgbot_jobs_total", "Finished jobs", "status")
+
+_METRICS: List[Any] = [STAGE_SECONDS, STAGE_BYTES, STAGE_MESSAGES, STAGE_RATE, JOB_SECONDS, JOB_PEAK_MEMORY, JOBS]
+
+
+def register(metric: Any):
+    """
+    Добавляет метрику другого модуля в вывод /metrics (объект с методом render()).
+    """
+    _METRICS.append(metric)
+
+
+def render_prometheus() -> str:
+    lines: List[str] = []
+    for metric in _METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+class Job:
+    """
+    Одно задание бота (разбор загруженного файла, /process): собирает замеры
+    этапов из основного процесса и из рабочих процессов пула.
+    """
+
+    def __init__(self, kind: str, user_id: Optional[int] = None):
+        self.id = next(_job_ids)
+        self.kind = kind
+        self.user_id = user_id
+        self.started = time.perf_counter()
+        self.stages: List[Dict[str, Any]] = []
+        self.peak_memory = 0
+        self.profile_dir: Optional[str] = None
+        self.status = "ok"
+
+    def add(self, sample: Dict[str, Any]):
+        self.stages.append(sample)
+        self.peak_memory = max(self.peak_memory, sample.get("peak_memory", 0))
+
+    def profile_path(self, fn: Callable) -> Optional[str]:
+        if not self.profile_dir:
+            return None
+        return os.path.join(self.profile_dir, f"{self.kind}-{self.id}-{fn.__name__}.prof")
+
+
+def configure(trace_memory: bool = False, profile_dir: Optional[str] = None):
+    """
+    trace_memory — замер пиковой памяти заданий через tracemalloc (заметно замедляет разбор);
+    profile_dir — снять cProfile с рабочих вызовов первого следующего задания.
+    """
+    global _trace_memory, _profile_dir
+    _trace_memory = trace_memory
+    _profile_dir = profile_dir
+    if profile_dir:
+        os.makedirs(profile_dir, exist_ok=True)
+
+
+def _record(sample: Dict[str, Any]):
+    collected = getattr(_local, "samples", None)
+    if collected is not None:
+        # Мы в рабочем процессе пула: замер уедет в бота вместе с результатом
+        collected.append(sample)
+        return
+    stage = sample["stage"]
+    STAGE_SECONDS.observe(stage, sample["seconds"])
+    if sample.get("bytes_in"):
+        STAGE_BYTES.inc(stage, sample["bytes_in"])
+    if sample.get("messages"):
+        STAGE_MESSAGES.inc(stage, sample["messages"])
+        if sample["seconds"] > 0:
+            STAGE_RATE.observe(stage, sample["messages"] / sample["seconds"])
+    job = _current_job.get()
+    if job is not None:
+        job.add(sample)
+
+
+def record(name: str, seconds: float, bytes_in: int = 0, messages: int = 0):
+    """
+    Замер этапа, время которого посчитано вызывающим кодом.
+    """
+    _record({"stage": name, "seconds": seconds, "bytes_in": bytes_in, "messages": messages})
+
+
+class _StageTimer:
+    __slots__ = ("bytes_in", "messages")
+
+    def __init__(self, bytes_in: int):
+        self.bytes_in = bytes_in
+        self.messages = 0
+
+
+@contextmanager
+def stage(name: str, bytes_in: int = 0) -> Iterator[_StageTimer]:
+    """
+    Замер этапа. Число обработанных сообщений можно указать через timer.messages.
+    """
+    timer = _StageTimer(bytes_in)
+    started = time.perf_counter()
+    try:
+        yield timer
+    finally:
+        record(name, time.perf_counter() - started, timer.bytes_in, timer.messages)
+
+
+class timed_iter:
+    """
+    Оборачивает потоковый источник (например, генератор сообщений парсера) и меряет
+    только время получения элементов — без времени их обработки потребителем.
+    Замер записывается, когда источник исчерпан или обёртка освобождена
+    (потребитель мог остановиться раньше); seconds и count доступны и после.
+    count_messages=False — элементы не сообщения (например, порции текста).
+    """
+
+    __slots__ = ("_it", "_name", "_bytes_in", "_count_messages", "_done", "seconds", "count")
+
+    def __init__(self, items: Iterable[Any], name: str, bytes_in: int = 0, count_messages: bool = True):
+        self._it = iter(items)
+        self._name = name
+        self._bytes_in = bytes_in
+        self._count_messages = count_messages
+        self._done = False
+        self.seconds = 0.0
+        self.count = 0
+
+    def finish(self):
+        if not self._done:
+            self._done = True
+            record(self._name, self.seconds, self._bytes_in, self.count if self._count_messages else 0)
+
+    def __del__(self):
+        self.finish()
+
+    def __iter__(self) -> "timed_iter":
+        return self
+
+    def __next__(self) -> Any:
+        started = time.perf_counter()
+        try:
+            item = next(self._it)
+        except StopIteration:
+            self.seconds += time.perf_counter() - started
+            self.finish()
+            raise
+        self.seconds += time.perf_counter() - started
+        self.count += 1
+        return item
+
+
+def run_instrumented(fn: Callable[..., Any], args: Tuple[Any, ...], trace_memory: bool,
+                     profile_path: Optional[str]) -> Tuple[Any, List[Dict[str, Any]]]:
+    """
+    Выполняется в рабочем процессе пула: вызывает fn(*args), собирая замеры этапов,
+    пиковую память (tracemalloc) и, при необходимости, профиль cProfile.
+    """
+    _local.samples = samples = []
+    profiler = cProfile.Profile() if profile_path else None
+    if trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    try:
+        if profiler is not None:
+            profiler.enable()
+        result = fn(*args)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile_path)
+        sample = {"stage": f"worker:{fn.__name__}", "seconds": time.perf_counter() - started}
+        if trace_memory:
+            sample["peak_memory"] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        _local.samples = None
+    samples.append(sample)
+    return result, samples
+
+
+def worker_call_options(fn: Callable) -> Tuple[bool, Optional[str]]:
+    """
+    Параметры run_instrumented для вызова из текущего задания.
+    """
+    job = _current_job.get()
+    return _trace_memory, job.profile_path(fn) if job is not None else None
+
+
+def mark_failed(reason: str = "error"):
+    """
+    Помечает текущее задание неуспешным, если ошибка обработана без исключения.
+    """
+    job = _current_job.get()
+    if job is not None:
+        job.status = reason
+
+
+def record_samples(samples: List[Dict[str, Any]]):
+    for sample in samples:
+        _record(sample)
+
+
+@contextmanager
+def job(kind: str, user_id: Optional[int] = None) -> Iterator[Job]:
+    """
+    Контекст задания: по завершении итоги пишутся в структурированный лог
+    и в гистограммы заданий.
+    """
+    global _profile_dir
+    current = Job(kind, user_id)
+    if _profile_dir:
+        # Профилируется только одно задание
+        current.profile_dir, _profile_dir = _profile_dir, None
+    token = _current_job.set(current)
+    try:
+        yield current
+    except BaseException:
+        current.status = "error"
+        raise
+    finally:
+        _current_job.reset(token)
+        status = current.status
+        seconds = time.perf_counter() - current.started
+        JOB_SECONDS.observe(kind, seconds)
+        JOBS.inc(status)
+        if current.peak_memory:
+            JOB_PEAK_MEMORY.observe(kind, current.peak_memory)
+        logger.info(json.dumps({
+            "event": "job",
+            "job_id": current.id,
+            "kind": kind,
+            "user_id": user_id,
+            "status": status,
+            "seconds": round(seconds, 4),
+            "peak_memory": current.peak_memory or None,
+            "stages": [
+                {k: (round(v, 4) if isinstance(v, float) else v) for k, v in s.items() if v}
+                for s in current.stages
+            ],
+        }, ensure_ascii=False))
+
+
+async def start_metrics_server(host: str, port: int):
+    """
+    HTTP-эндпоинт /metrics в формате Prometheus. Возвращает runner для остановки.
+    """
+    from aiohttp import web
+
+    async def handle_metrics(request: web.Request) -> web.Response:
+        return web.Response(text=render_prometheus(), content_type="text/plain", charset="utf-8",
+                            headers={"X-Content-Type-Options": "nosniff"})
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
@@ -0,0 +1,177 @@
+import asyncio
+import logging
+import os
+import time
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from typing import Any, Callable, Iterable, List, Optional, Tuple
+
+from app.utils import limits, metrics
+
+logger = logging.getLogger(__name__)
+
+# Сколько секунд после срока (или /cancel) ждать кооперативной остановки вызова, прежде чем убить пул
+KILL_GRACE = float(os.getenv("JOB_KILL_GRACE", "5"))
+# Как часто проверять, начался ли вызов, стоящий в очереди пула после срока
+_START_POLL = 0.1
+
+_executor: Optional[Executor] = None
+_workers = 0
+
+
+def init_pool(workers: int) -> Executor:
+    """
+    Создаёт пул для CPU-ёмких этапов (разбор, извлечение, Excel).
+    workers > 0 — пул процессов, 0 — один фоновый поток (для отладки/слабых машин).
+    """
+    global _executor, _workers
+    shutdown_pool()
+    _workers = workers
+    if workers > 0:
+        # Флаги отмены заданий общие с рабочими процессами (см. limits.cancel)
+        _executor = ProcessPoolExecutor(
+            max_workers=workers, initializer=limits.init_worker,
+            initargs=(limits.cancel_flags(), limits.start_marks()),
+        )
+    else:
+        _executor = ThreadPoolExecutor(max_workers=1)
+    return _executor
+
+
+def _kill_pool(executor: Executor):
+    """
+    Принудительно останавливает рабочие процессы (вызов не реагирует на лимиты,
+    например застрял в html5lib) и создаёт пул заново. Вызовы других заданий
+    в убитом пуле получат BrokenProcessPool и будут повторены (см. run_in_pool).
+    """
+    global _executor
+    if executor is not _executor or not isinstance(executor, ProcessPoolExecutor):
+        # Пул уже пересоздан; поток из пула-потока убить нельзя — остаются кооперативные проверки
+        return
+    logger.warning("Killing worker pool: a job did not stop within %ss", KILL_GRACE)
+    # У ProcessPoolExecutor нет публичного способа убить процессы
+    for process in list((executor._processes or {}).values()):
+        process.kill()
+    executor.shutdown(wait=False, cancel_futures=True)
+    _executor = None
+    init_pool(_workers)
+
+
+def _consume(fut: asyncio.Future):
+    # Результат брошенного вызова никому не нужен; не оставляем «exception was never retrieved»
+    if not fut.cancelled():
+        fut.exception()
+
+
+async def _await_stop(
+    fut: asyncio.Future,
+    cfut: Future,
+    executor: Executor,
+    call_id: int,
+    since: float,
+):
+    """
+    Ждёт кооперативной остановки вызова после срока или /cancel (since — time.time()
+    этого момента). Вызов, ещё ждущий в очереди пула, снимается с неё; начавшийся
+    получает KILL_GRACE с момента начала (или since, если начался раньше) — затем пул убивается.
+    """
+    fut.add_done_callback(_consume)
+    if cfut.cancel():
+        return
+    while not fut.done():
+        started = limits.started_at(call_id)
+        # Пока вызов не начался (стоит во внутренней очереди процессов), время ожидания не в счёт
+        timeout = _START_POLL if started is None else max(started, since) + KILL_GRACE - time.time()
+        # wait, а не wait_for: не отменяет вызов и не пробрасывает его исключение
+        await asyncio.wait((fut,), timeout=max(0.0, timeout))
+        if started is not None and not fut.done():
+            _kill_pool(executor)
+            return
+
+
+async def _run_once(fn: Callable[..., Any], args: Tuple[Any, ...], job: Optional[limits.JobLimits]) -> Any:
+    executor = get_executor()
+    trace_memory, profile_path = metrics.worker_call_options(fn)
+    call_id = limits.next_call_id()
+    call = partial(limits.run_limited, job, metrics.run_instrumented, (fn, args, trace_memory, profile_path), call_id)
+    cfut = executor.submit(call)
+    fut = asyncio.wrap_future(cfut)
+    if job is None:
+        return await fut
+    remaining = job.remaining()
+    try:
+        # Вызов сам остановится на ближайшей проверке лимитов; если нет — убиваем пул
+        return await asyncio.wait_for(asyncio.shield(fut), remaining)
+    except asyncio.TimeoutError:
+        await _await_stop(fut, cfut, executor, call_id, job.deadline)
+        raise limits.LimitExceeded(f"превышено время обработки ({job.max_seconds:g} с)") from None
+    except asyncio.CancelledError:
+        # /cancel: флаг отмены уже выставлен, даём вызову остановиться самому
+        await _await_stop(fut, cfut, executor, call_id, time.time())
+        raise
+
+
+def get_executor() -> Executor:
+    if _executor is None:
+        return init_pool(os.cpu_count() or 1)
+    return _executor
+
+
+async def run_in_pool(fn: Callable[..., Any], *args: Any) -> Any:
+    """
+    Выполняет fn(*args) в пуле и ожидает результат, не блокируя цикл событий бота.
+    fn и аргументы должны сериализоваться pickle (функции уровня модуля).
+    Замеры этапов из рабочего процесса возвращаются вместе с результатом
+    и попадают в метрики текущего задания.
+
+    Лимиты текущего задания (limits.job) передаются в рабочий процесс и
+    проверяются там кооперативно; если вызов не остановился через KILL_GRACE
+    после срока или /cancel, пул убивается и создаётся заново.
+    """
+    job = limits.current()
+    try:
+        result, samples = await _run_once(fn, args, job)
+    except BrokenProcessPool:
+        # Пул убит из-за чужого задания (или упал процесс): повторяем вызов один раз в новом пуле
+        if job is not None:
+            job.check()
+        logger.warning("Worker pool broken, retrying %s once", getattr(fn, "__name__", fn))
+        if _executor is not None and getattr(_executor, "_broken", False):
+            init_pool(_workers)
+        result, samples = await _run_once(fn, args, job)
+    metrics.record_samples(samples)
+    return result
+
+
+async def map_in_pool(fn: Callable[..., Any], calls: Iterable[Tuple[Any, ...]], limit: int) -> List[Any]:
+    """
+    run_in_pool для каждого набора аргументов из calls, не более limit вызовов
+    одновременно. calls перебирается по мере освобождения мест, поэтому тяжёлые
+    аргументы можно готовить лениво. Результаты — в порядке calls.
+    """
+    sem = asyncio.Semaphore(max(1, limit))
+    tasks: List[asyncio.Future] = []
+
+    async def call(args: Tuple[Any, ...]) -> Any:
+        try:
+            return await run_in_pool(fn, *args)
+        finally:
+            sem.release()
+
+    try:
+        for args in calls:
+            await sem.acquire()
+            tasks.append(asyncio.ensure_future(call(args)))
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+
+
+def shutdown_pool(wait: bool = True):
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=wait, cancel_futures=True)
+        _executor = None
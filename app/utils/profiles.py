@@ -0,0 +1,217 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+
+logger = logging.getLogger(__name__)
+
+# Профиль из getChat: {"bio": описание или None, "has_channel": есть ли канал в профиле}.
+# None — username не найден (или бот не может его видеть)
+Profile = Optional[Dict[str, Any]]
+
+_MISSING = object()
+
+
+def _profile_key(username: str) -> str:
+    # username в Telegram нечувствителен к регистру
+    return username.lstrip("@").lower()
+
+
+class ProfileCache:
+    """
+    TTL-кэш профилей по username, общий для всех заданий процесса: популярные
+    username запрашиваются у Bot API один раз за срок жизни записи. Кэшируются
+    и отрицательные ответы (username не найден), чтобы не повторять заведомо
+    неудачные запросы.
+    """
+
+    def __init__(self, ttl: float, max_entries: int = 100_000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # key -> (профиль, момент истечения)
+        self._entries: "OrderedDict[str, Tuple[Profile, float]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, username: str) -> Any:
+        """
+        Профиль или _MISSING, если записи нет (None — username не найден).
+        """
+        key = _profile_key(username)
+        entry = self._entries.get(key)
+        if entry is not None and entry[1] < time.monotonic():
+            del self._entries[key]
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return _MISSING
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def __contains__(self, username: str) -> bool:
+        entry = self._entries.get(_profile_key(username))
+        return entry is not None and entry[1] >= time.monotonic()
+
+    def put(self, username: str, profile: Profile):
+        key = _profile_key(username)
+        self._entries.pop(key, None)
+        self._entries[key] = (profile, time.monotonic() + self.ttl)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def expire(self) -> int:
+        """
+        Удаляет записи с истёкшим сроком. Возвращает число удалённых.
+        """
+        now = time.monotonic()
+        expired = [key for key, (_, expires) in self._entries.items() if expires < now]
+        for key in expired:
+            del self._entries[key]
+        return len(expired)
+
+    async def run_expirer(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            expired = self.expire()
+            if expired:
+                logger.info("Expired %d cached profiles, %d cached", expired, len(self._entries))
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def render(self) -> List[str]:
+        """
+        Счётчики кэша в формате Prometheus (подключается через metrics.register).
+        """
+        return [
+            "# HELP tgbot_profile_cache_requests_total Profile cache lookups",
+            "# TYPE tgbot_profile_cache_requests_total counter",
+            f'tgbot_profile_cache_requests_total{{result="hit"}} {self.hits}',
+            f'tgbot_profile_cache_requests_total{{result="miss"}} {self.misses}',
+            "# HELP tgbot_profile_cache_entries Cached profiles",
+            "# TYPE tgbot_profile_cache_entries gauge",
+            f"tgbot_profile_cache_entries {len(self._entries)}",
+        ]
+
+
+class ProfileEnricher:
+    """
+    Дополняет участников и упоминания данными профиля из Bot API (getChat по @username):
+    описание (bio) и наличие канала в профиле. Дату регистрации Bot API не отдаёт.
+
+    Число одновременных запросов ограничено для всего процесса (лимиты Telegram
+    действуют на бота, а не на задание). На 429 (TelegramRetryAfter) все запросы
+    приостанавливаются на указанное Telegram время, затем запрос повторяется.
+    Одновременные запросы одного username из разных заданий объединяются.
+    """
+
+    def __init__(self, bot: Bot, cache: ProfileCache, concurrency: int = 5, max_retries: int = 3):
+        self.bot = bot
+        self.cache = cache
+        self.max_retries = max_retries
+        self._semaphore = asyncio.Semaphore(max(1, concurrency))
+        self._resume_at = 0.0
+        self._inflight: Dict[str, "asyncio.Task[Profile]"] = {}
+        self.requests = 0
+        self.flood_waits = 0
+
+    async def _pause(self):
+        # Общая пауза после 429: ждут все, включая запросы, уже стоящие за семафором
+        while True:
+            delay = self._resume_at - time.monotonic()
+            if delay <= 0:
+                return
+            await asyncio.sleep(delay)
+
+    async def _fetch(self, username: str) -> Tuple[Profile, bool]:
+        """
+        Запрос getChat. Возвращает (профиль, можно ли кэшировать ответ).
+        """
+        async with self._semaphore:
+            for attempt in range(self.max_retries + 1):
+                await self._pause()
+                self.requests += 1
+                try:
+                    chat = await self.bot.get_chat(f"@{username.lstrip('@')}")
+                except TelegramRetryAfter as e:
+                    self.flood_waits += 1
+                    self._resume_at = max(self._resume_at, time.monotonic() + e.retry_after)
+                    logger.info("getChat flood wait %ss (attempt %d)", e.retry_after, attempt + 1)
+                    continue
+                except (TelegramBadRequest, TelegramForbiddenError):
+                    # Username не существует или бот не может его видеть
+                    return None, True
+                except (TelegramAPIError, asyncio.TimeoutError, OSError) as e:
+                    logger.warning("getChat @%s failed: %s", username, e)
+                    return None, False
+                return {"bio": chat.bio or chat.description, "has_channel": chat.personal_chat is not None}, True
+        return None, False
+
+    async def _resolve(self, key: str) -> Profile:
+        try:
+            profile, cacheable = await self._fetch(key)
+            if cacheable:
+                self.cache.put(key, profile)
+            return profile
+        finally:
+            del self._inflight[key]
+
+    async def lookup(self, username: str) -> Profile:
+        cached = self.cache.get(username)
+        if cached is not _MISSING:
+            return cached
+        key = _profile_key(username)
+        task = self._inflight.get(key)
+        if task is None:
+            # Запрос — отдельная задача: отмена одного задания не прерывает его для остальных
+            task = self._inflight[key] = asyncio.ensure_future(self._resolve(key))
+        return await asyncio.shield(task)
+
+    async def enrich(self, rows: Iterable[Dict[str, Any]], max_lookups: int = 0) -> int:
+        """
+        Заполняет bio и has_channel у строк (участники, упоминания) с известным username.
+        max_lookups — сколько username не из кэша можно запросить за задание (0 — без ограничения).
+        Возвращает число строк, для которых найден профиль.
+        """
+        by_key: Dict[str, List[Dict[str, Any]]] = {}
+        for row in rows:
+            uname = row.get("username")
+            if uname:
+                by_key.setdefault(_profile_key(uname), []).append(row)
+
+        lookups = []
+        uncached = 0
+        for key in by_key:
+            if key not in self.cache:
+                if max_lookups and uncached >= max_lookups:
+                    continue
+                uncached += 1
+            lookups.append(key)
+        profiles = await asyncio.gather(*(self.lookup(key) for key in lookups))
+
+        found = 0
+        for key, profile in zip(lookups, profiles):
+            if profile is None:
+                continue
+            for row in by_key[key]:
+                if profile.get("bio") and not row.get("bio"):
+                    row["bio"] = profile["bio"]
+                if profile.get("has_channel"):
+                    row["has_channel"] = True
+                found += 1
+        return found
+
+    def render(self) -> List[str]:
+        return [
+            "# HELP tgbot_profile_requests_total getChat requests made for enrichment",
+            "# TYPE tgbot_profile_requests_total counter",
+            f"tgbot_profile_requests_total {self.requests}",
+            "# HELP tgbot_profile_flood_waits_total getChat 429 responses",
+            "# TYPE tgbot_profile_flood_waits_total counter",
+            f"tgbot_profile_flood_waits_total {self.flood_waits}",
+        ]
@@ -0,0 +1,124 @@
+import asyncio
+from typing import Any, List, Optional, Union
+from urllib.parse import unquote, urlparse
+
+
+class RespError(Exception):
+    """
+    Ошибка, которую вернул сервер (ответ RESP вида "-ERR ...").
+    """
+
+
+class RespClient:
+    """
+    Минимальный асинхронный клиент протокола Redis (RESP2) поверх asyncio-потоков:
+    одно соединение, команды выполняются по очереди. Достаточен для хранилища
+    сессий (GET/SET/DEL/EVAL) и совместим с Redis, Valkey, KeyDB и т.п.
+    """
+
+    def __init__(self, url: str, timeout: float = 10.0):
+        parsed = urlparse(url)
+        if parsed.scheme not in ("redis", ""):
+            raise ValueError(f"Неподдерживаемая схема адреса хранилища: {parsed.scheme}")
+        self.host = parsed.hostname or "127.0.0.1"
+        self.port = parsed.port or 6379
+        self.username = unquote(parsed.username) if parsed.username else None
+        self.password = unquote(parsed.password) if parsed.password else None
+        path = (parsed.path or "").lstrip("/")
+        self.db = int(path) if path else 0
+        self.timeout = timeout
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._lock = asyncio.Lock()
+
+    async def _connect(self):
+        self._reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port), self.timeout
+        )
+        if self.password is not None:
+            auth = ["AUTH", self.username, self.password] if self.username else ["AUTH", self.password]
+            await self._roundtrip(auth)
+        if self.db:
+            await self._roundtrip(["SELECT", str(self.db)])
+
+    @staticmethod
+    def _encode(args: List[Union[str, bytes, int]]) -> bytes:
+        out = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            if isinstance(arg, bytes):
+                data = arg
+            else:
+                data = str(arg).encode("utf-8")
+            out.append(b"$%d\r\n%s\r\n" % (len(data), data))
+        return b"".join(out)
+
+    async def _read_reply(self) -> Any:
+        line = await self._reader.readline()
+        if not line.endswith(b"\r\n"):
+            raise ConnectionError("Соединение с хранилищем закрыто")
+        kind, payload = line[:1], line[1:-2]
+        if kind == b"+":
+            return payload.decode("utf-8")
+        if kind == b"-":
+            raise RespError(payload.decode("utf-8", "replace"))
+        if kind == b":":
+            return int(payload)
+        if kind == b"$":
+            size = int(payload)
+            if size < 0:
+                return None
+            data = await self._reader.readexactly(size + 2)
+            return data[:-2]
+        if kind == b"*":
+            size = int(payload)
+            if size < 0:
+                return None
+            return [await self._read_reply() for _ in range(size)]
+        raise ConnectionError(f"Некорректный ответ хранилища: {line[:32]!r}")
+
+    async def _roundtrip(self, args: List[Union[str, bytes, int]]) -> Any:
+        self._writer.write(self._encode(args))
+        await self._writer.drain()
+        return await asyncio.wait_for(self._read_reply(), self.timeout)
+
+    async def execute(self, *args: Union[str, bytes, int], retry: bool = True) -> Any:
+        """
+        Выполняет команду и возвращает ответ: str, int, bytes, list или None.
+        При обрыве соединения переподключается и повторяет команду один раз.
+        retry=False — для неидемпотентных команд (SET NX): после отправки команды
+        повтора нет, ведь сервер мог её уже выполнить; ошибка уходит вызывающему.
+        """
+        async with self._lock:
+            for attempt in (1, 2):
+                sent = False
+                try:
+                    if self._writer is None:
+                        await self._connect()
+                    sent = True
+                    return await self._roundtrip(list(args))
+                except RespError:
+                    raise
+                except (ConnectionError, OSError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+                    self._close()
+                    if attempt == 2 or (sent and not retry):
+                        raise
+                except BaseException:
+                    # Отмена посреди обмена: ответ на команду остался бы в потоке
+                    # и достался бы следующей команде — соединение закрываем
+                    self._close()
+                    raise
+
+    def _close(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+
+    async def close(self):
+        async with self._lock:
+            writer = self._writer
+            self._close()
+            if writer is not None:
+                try:
+                    await writer.wait_closed()
+                except (ConnectionError, OSError):
+                    pass
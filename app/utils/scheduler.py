@@ -0,0 +1,136 @@
+import asyncio
+import itertools
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from app.utils import metrics
+
+QUEUE_WAIT_SECONDS = metrics.Histogram(
+    "tgbot_queue_wait_seconds", "Time a job waited for a free slot",
+    (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800), "kind",
+)
+metrics.register(QUEUE_WAIT_SECONDS)
+
+# Колбэк обновления статуса ожидания: (позиция в очереди, оценка ожидания в секундах или None)
+QueueCallback = Callable[[int, Optional[float]], Awaitable[None]]
+
+
+class _Job:
+    __slots__ = ("user_id", "cost", "seq", "finish_tag", "changed", "started", "started_at")
+
+    def __init__(self, user_id: int, cost: float, seq: int, finish_tag: float):
+        self.user_id = user_id
+        self.cost = cost
+        self.seq = seq
+        self.finish_tag = finish_tag
+        self.changed = asyncio.Event()
+        self.started = False
+        self.started_at = 0.0
+
+
+class JobScheduler:
+    """
+    Ограничивает число одновременно выполняемых заданий /process.
+
+    Очередь справедливая: у каждого пользователя своя FIFO-очередь, а между
+    пользователями задания выбираются по виртуальному времени окончания
+    (weighted fair queuing), где стоимость задания — объём загруженных байт.
+    Поэтому одно огромное задание не задерживает много мелких, но и само
+    не голодает: виртуальное время растёт с каждым запущенным заданием.
+    """
+
+    def __init__(self, max_concurrent: int, base_cost: int = 1024 * 1024, ema_alpha: float = 0.3):
+        self.max_concurrent = max(1, max_concurrent)
+        # Минимальная стоимость: у любого задания есть накладные расходы помимо объёма данных
+        self.base_cost = base_cost
+        self.ema_alpha = ema_alpha
+        self._virtual_time = 0.0
+        self._last_finish: Dict[int, float] = {}
+        self._waiting: List[_Job] = []
+        self._running: Set[_Job] = set()
+        self._seq = itertools.count()
+        # Сглаженная скорость обработки одного задания, байт/с (None — ещё нет замеров)
+        self._rate: Optional[float] = None
+
+    def _enqueue(self, user_id: int, nbytes: int) -> _Job:
+        cost = float(max(nbytes, 0) + self.base_cost)
+        start_tag = max(self._virtual_time, self._last_finish.get(user_id, 0.0))
+        job = _Job(user_id, cost, next(self._seq), start_tag + cost)
+        self._last_finish[user_id] = job.finish_tag
+        self._waiting.append(job)
+        return job
+
+    def _dispatch(self):
+        moved = False
+        while self._waiting and len(self._running) < self.max_concurrent:
+            job = min(self._waiting, key=lambda j: (j.finish_tag, j.seq))
+            self._waiting.remove(job)
+            self._virtual_time = max(self._virtual_time, job.finish_tag - job.cost)
+            job.started = True
+            job.started_at = time.monotonic()
+            self._running.add(job)
+            job.changed.set()
+            moved = True
+        if moved:
+            for job in self._waiting:
+                job.changed.set()
+        # Пользователи без заданий не должны копить «кредит» в виртуальном времени
+        if not self._waiting and not self._running:
+            self._last_finish.clear()
+
+    def _finish(self, job: _Job):
+        if job.started:
+            self._running.discard(job)
+            elapsed = time.monotonic() - job.started_at
+            if elapsed > 0:
+                rate = job.cost / elapsed
+                self._rate = rate if self._rate is None else self.ema_alpha * rate + (1 - self.ema_alpha) * self._rate
+        elif job in self._waiting:
+            self._waiting.remove(job)
+            for other in self._waiting:
+                other.changed.set()
+        self._dispatch()
+
+    def status(self, job: _Job) -> Tuple[int, Optional[float]]:
+        """
+        Позиция задания в очереди (1 — следующее) и оценка ожидания в секундах.
+        """
+        ahead = [j for j in self._waiting if (j.finish_tag, j.seq) < (job.finish_tag, job.seq)]
+        position = len(ahead) + 1
+        if not self._rate:
+            return position, None
+        now = time.monotonic()
+        running_left = sum(max(0.0, j.cost / self._rate - (now - j.started_at)) for j in self._running)
+        # Работу впереди (оставшуюся у выполняемых и ждущие задания) делим на число слотов
+        eta = (running_left + sum(j.cost for j in ahead) / self._rate) / self.max_concurrent
+        return position, eta
+
+    def is_active(self, user_id: int) -> bool:
+        return any(j.user_id == user_id for j in self._waiting) or any(j.user_id == user_id for j in self._running)
+
+    def queued(self) -> int:
+        return len(self._waiting)
+
+    @asynccontextmanager
+    async def slot(self, user_id: int, nbytes: int, on_wait: Optional[QueueCallback] = None) -> AsyncIterator[None]:
+        """
+        Ожидает свободный слот и удерживает его на время блока.
+        Пока задание в очереди, on_wait вызывается при каждом её движении.
+        """
+        job = self._enqueue(user_id, nbytes)
+        queued_at = time.monotonic()
+        self._dispatch()
+        try:
+            while not job.started:
+                job.changed.clear()
+                if on_wait is not None:
+                    await on_wait(*self.status(job))
+                if not job.started:
+                    await job.changed.wait()
+            waited = time.monotonic() - queued_at
+            QUEUE_WAIT_SECONDS.observe("process", waited)
+            metrics.record("queue", waited)
+            yield
+        finally:
+            self._finish(job)
@@ -0,0 +1,214 @@
+import asyncio
+import json
+import secrets
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, Optional, Tuple
+
+from app.utils.resp import RespClient
+
+# Снятие блокировки только владельцем (сравнение токена и удаление атомарно)
+_UNLOCK_SCRIPT = (
+    "if redis.call('get', KEYS[1]) == ARGV[1] then "
+    "return redis.call('del', KEYS[1]) else return 0 end"
+)
+# Срок хранения настроек пользователя (/format) в общем хранилище; продлевается при изменении
+_SETTING_TTL = 90 * 24 * 3600
+# Запись сессии, только если с начала задания не было /cancel (счётчик отмен не изменился)
+_SAVE_SCRIPT = (
+    "if (redis.call('get', KEYS[2]) or '0') ~= ARGV[3] then return 0 end "
+    "redis.call('set', KEYS[1], ARGV[1], 'PX', ARGV[2]) return 1"
+)
+
+
+class SessionBackend:
+    """
+    Хранилище состояния сессий и блокировок. shared=True — состояние общее
+    для нескольких процессов/контейнеров бота и хранится сериализованным.
+    """
+
+    shared = False
+
+    async def load(self, user_id: int) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    async def save(self, user_id: int, state: Dict[str, Any], ttl: float, epoch: Optional[int] = None) -> bool:
+        """
+        epoch — значение cancel_epoch в начале задания: если оно изменилось,
+        состояние не записывается и возвращается False.
+        """
+        raise NotImplementedError
+
+    async def delete(self, user_id: int):
+        raise NotImplementedError
+
+    async def cancel_epoch(self, user_id: int) -> int:
+        """
+        Счётчик /cancel пользователя: задание, начатое при другом значении, сессию не сохраняет.
+        """
+        raise NotImplementedError
+
+    async def bump_cancel_epoch(self, user_id: int):
+        raise NotImplementedError
+
+    async def get_setting(self, user_id: int, name: str) -> Optional[str]:
+        """
+        Настройка пользователя (например, формат результата); живёт дольше сессии.
+        """
+        raise NotImplementedError
+
+    async def set_setting(self, user_id: int, name: str, value: str):
+        raise NotImplementedError
+
+    def lock(self, name: str, ttl: float) -> Any:
+        """
+        Асинхронный контекстный менеджер взаимного исключения по имени.
+        """
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class MemoryBackend(SessionBackend):
+    """
+    Сессии живут в памяти процесса (в SessionStore) без сериализации —
+    подходит для одного процесса бота. Здесь только блокировки.
+    """
+
+    def __init__(self):
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._waiters: Dict[str, int] = {}
+        self._settings: Dict[Tuple[int, str], str] = {}
+        self._cancel_epochs: Dict[int, int] = {}
+
+    async def load(self, user_id: int) -> Optional[Dict[str, Any]]:
+        return None
+
+    async def save(self, user_id: int, state: Dict[str, Any], ttl: float, epoch: Optional[int] = None) -> bool:
+        return True
+
+    async def delete(self, user_id: int):
+        pass
+
+    async def cancel_epoch(self, user_id: int) -> int:
+        return self._cancel_epochs.get(user_id, 0)
+
+    async def bump_cancel_epoch(self, user_id: int):
+        # Задачу, которую /cancel не застал (файл ещё не дошёл до разбора), остановит проверка счётчика
+        self._cancel_epochs[user_id] = self._cancel_epochs.get(user_id, 0) + 1
+
+    async def get_setting(self, user_id: int, name: str) -> Optional[str]:
+        return self._settings.get((user_id, name))
+
+    async def set_setting(self, user_id: int, name: str, value: str):
+        self._settings[(user_id, name)] = value
+
+    @asynccontextmanager
+    async def lock(self, name: str, ttl: float) -> AsyncIterator[None]:
+        lock = self._locks.get(name)
+        if lock is None:
+            lock = self._locks[name] = asyncio.Lock()
+        self._waiters[name] = self._waiters.get(name, 0) + 1
+        try:
+            async with lock:
+                yield
+        finally:
+            # Блокировки без ожидающих удаляем, чтобы словарь не рос с числом пользователей
+            self._waiters[name] -= 1
+            if not self._waiters[name]:
+                del self._waiters[name]
+                del self._locks[name]
+
+
+class RedisBackend(SessionBackend):
+    """
+    Сессии в Redis (или совместимом сервере) в виде JSON с TTL: загрузку
+    может принять один процесс бота, а /process выполнить другой.
+    Блокировка — SET NX PX с токеном владельца.
+    """
+
+    shared = True
+
+    def __init__(self, url: str, prefix: str = "tgbot:"):
+        self._client = RespClient(url)
+        self.prefix = prefix
+
+    def _key(self, user_id: int) -> str:
+        return f"{self.prefix}session:{user_id}"
+
+    def _cancel_key(self, user_id: int) -> str:
+        return f"{self.prefix}cancel:{user_id}"
+
+    async def load(self, user_id: int) -> Optional[Dict[str, Any]]:
+        raw = await self._client.execute("GET", self._key(user_id))
+        return json.loads(raw) if raw is not None else None
+
+    async def save(self, user_id: int, state: Dict[str, Any], ttl: float, epoch: Optional[int] = None) -> bool:
+        data = json.dumps(state, ensure_ascii=False, separators=(",", ":"))
+        px = max(1, int(ttl * 1000))
+        if epoch is None:
+            await self._client.execute("SET", self._key(user_id), data, "PX", px)
+            return True
+        # Проверка счётчика и запись — атомарно: /cancel другого процесса не проскочит между ними
+        saved = await self._client.execute(
+            "EVAL", _SAVE_SCRIPT, 2, self._key(user_id), self._cancel_key(user_id), data, px, epoch
+        )
+        return bool(saved)
+
+    async def delete(self, user_id: int):
+        await self._client.execute("DEL", self._key(user_id))
+
+    async def cancel_epoch(self, user_id: int) -> int:
+        raw = await self._client.execute("GET", self._cancel_key(user_id))
+        return int(raw) if raw is not None else 0
+
+    async def bump_cancel_epoch(self, user_id: int):
+        # /cancel мог прийти в другой процесс: его задания увидят новое значение перед save.
+        # Счётчик без срока жизни: после истечения он читался бы как 0, и задание,
+        # начатое при ненулевом значении, считалось бы отменённым
+        await self._client.execute("INCR", self._cancel_key(user_id))
+
+    async def get_setting(self, user_id: int, name: str) -> Optional[str]:
+        raw = await self._client.execute("GET", f"{self.prefix}setting:{name}:{user_id}")
+        return raw.decode("utf-8") if raw is not None else None
+
+    async def set_setting(self, user_id: int, name: str, value: str):
+        await self._client.execute("SET", f"{self.prefix}setting:{name}:{user_id}", value, "EX", _SETTING_TTL)
+
+    async def _acquire(self, key: str, token: str, ttl: float) -> bool:
+        try:
+            # Без автоматического повтора: после обрыва SET NX мог уже выполниться,
+            # и повтор увидел бы собственную блокировку занятой
+            reply = await self._client.execute("SET", key, token, "NX", "PX", max(1, int(ttl * 1000)), retry=False)
+        except (ConnectionError, OSError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+            # Ответ не получен или оборван на середине. Выполнилась ли команда, узнаём по владельцу ключа
+            return await self._client.execute("GET", key) == token.encode()
+        return reply is not None
+
+    @asynccontextmanager
+    async def lock(self, name: str, ttl: float) -> AsyncIterator[None]:
+        key = f"{self.prefix}lock:{name}"
+        token = secrets.token_hex(16)
+        delay = 0.05
+        while not await self._acquire(key, token, ttl):
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 1.0)
+        try:
+            yield
+        finally:
+            await self._client.execute("EVAL", _UNLOCK_SCRIPT, 1, key, token)
+
+    async def close(self):
+        await self._client.close()
+
+
+def create_backend(kind: str, url: str = "") -> SessionBackend:
+    """
+    Хранилище сессий по имени из настроек: memory или redis.
+    """
+    kind = (kind or "memory").lower()
+    if kind == "memory":
+        return MemoryBackend()
+    if kind == "redis":
+        return RedisBackend(url or "redis://127.0.0.1:6379/0")
+    raise ValueError(f"Неизвестное хранилище сессий: {kind}")
@@ -1,24 +1,384 @@
+import asyncio
+import io
+import logging
+import mmap
+import os
+import time
+from contextlib import contextmanager
 from dataclasses import dataclass, field
-from typing import List
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, Set, Tuple
+
+from app.processing.dedup import MessageIdIndex
+from app.processing.extractor import EntityAccumulator
+from app.utils.limits import JobCancelled
+from app.utils.store import MemoryBackend, SessionBackend
+
+logger = logging.getLogger(__name__)
+
+
+class BudgetExceeded(Exception):
+    """
+    Загрузка не помещается в бюджет памяти (пользователя или общий).
+    Текст исключения предназначен для показа пользователю.
+    """
+
+
+class MappedFile(io.RawIOBase):
+    """
+    Файловый объект только для чтения поверх mmap (у mmap нет seekable(),
+    которого ждёт zipfile). Буфер отображения доступен как mapping.
+    """
+
+    def __init__(self, mapping: mmap.mmap):
+        super().__init__()
+        self.mapping = mapping
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        return self.mapping.read(None if size is None or size < 0 else size)
+
+    def readinto(self, buf) -> int:
+        data = self.mapping.read(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        self.mapping.seek(offset, whence)
+        return self.mapping.tell()
+
+    def tell(self) -> int:
+        return self.mapping.tell()
 
 
 @dataclass
 class InMemoryFile:
+    """
+    Загруженный файл: байты в памяти либо путь к локальному файлу
+    (режим локального Bot API сервера). Читать содержимое — через open().
+    """
     name: str
     mime: str
-    data: bytes
+    data: bytes = b""
+    # Путь к файлу на диске: содержимое отображается в память (mmap), а не копируется в data
+    path: Optional[str] = None
+
+    @property
+    def size(self) -> int:
+        return os.path.getsize(self.path) if self.path is not None else len(self.data)
+
+    @contextmanager
+    def open(self) -> Iterator[BinaryIO]:
+        """
+        Бинарный поток с содержимым. Для файла на диске — mmap: страницы
+        подгружаются по мере чтения и не учитываются как память процесса.
+        """
+        if self.path is None:
+            yield io.BytesIO(self.data)
+            return
+        with open(self.path, "rb") as fh:
+            if os.fstat(fh.fileno()).st_size == 0:
+                # mmap пустого файла невозможен
+                yield io.BytesIO(b"")
+                return
+            with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if hasattr(mm, "madvise"):
+                    mm.madvise(mmap.MADV_SEQUENTIAL)
+                yield MappedFile(mm)
+
+
+class LocalFiles:
+    """
+    Файлы локального сервера Bot API, которые сейчас разбираются. Один и тот же
+    file_id у сервера — один файл на диске, поэтому удалять его можно только
+    после последнего разбора в этом процессе.
+    """
+
+    def __init__(self):
+        self._readers: Dict[str, int] = {}
+
+    def acquire(self, path: str):
+        self._readers[path] = self._readers.get(path, 0) + 1
+
+    def release(self, path: str, delete: bool = False):
+        left = self._readers.get(path, 0) - 1
+        if left > 0:
+            self._readers[path] = left
+            return
+        self._readers.pop(path, None)
+        if delete:
+            try:
+                os.remove(path)
+            except OSError as e:
+                logger.warning("Не удалось удалить файл локального Bot API %s: %s", path, e)
+
+    def __len__(self) -> int:
+        return len(self._readers)
 
 
 @dataclass
 class SessionAccumulator:
-    files: List[InMemoryFile] = field(default_factory=list)
+    """
+    Состояние сессии пользователя до /process. Файлы разбираются сразу при
+    загрузке, здесь хранятся только накопленные сущности — сырые байты
+    освобождаются сразу после разбора.
+    """
+    entities: EntityAccumulator = field(default_factory=EntityAccumulator)
+    # id уже учтённых сообщений по чатам — повторы из пересекающихся выгрузок пропускаются
+    message_ids: MessageIdIndex = field(default_factory=MessageIdIndex)
+    files_count: int = 0
+    # Разборы, ещё выполняющиеся в пуле
+    pending: Set[asyncio.Future] = field(default_factory=set)
+    # Сырые байты загрузок, которые ещё скачиваются/разбираются
+    inflight_bytes: int = 0
+    # Всего загружено байт за сессию — оценка стоимости /process для планировщика
+    uploaded_bytes: int = 0
+    # /process ждёт в очереди или выполняется — сессию нельзя вытеснять
+    processing: bool = False
+    last_seen: float = field(default_factory=time.monotonic)
+
+    def add_entities(self, entities: Dict[str, List[Dict[str, Any]]], message_ids: Optional[MessageIdIndex] = None):
+        self.entities.add_entities(entities)
+        if message_ids:
+            self.message_ids.update(message_ids)
+        self.files_count += 1
+
+    def track(self, fut: asyncio.Future):
+        self.pending.add(fut)
+        fut.add_done_callback(self.pending.discard)
 
-    def add_file(self, f: InMemoryFile):
-        self.files.append(f)
+    async def wait_pending(self):
+        """
+        Дожидается разбора всех файлов, загруженных до вызова /process.
+        """
+        if self.pending:
+            await asyncio.gather(*list(self.pending), return_exceptions=True)
+
+    def result(self) -> Dict[str, List[Dict[str, Any]]]:
+        return self.entities.result()
 
     def count(self) -> int:
-        return len(self.files)
+        return self.files_count
+
+    def size(self) -> int:
+        """
+        Оценка памяти сессии: незавершённые загрузки + накопленные сущности и индекс id.
+        """
+        return self.inflight_bytes + self.entities.approx_size() + self.message_ids.approx_size()
+
+    def to_state(self) -> Dict[str, Any]:
+        """
+        Сериализуемое (JSON) состояние сессии для общего хранилища.
+        Незавершённые загрузки и резервы памяти — локальные и не сохраняются.
+        """
+        return {
+            "entities": self.entities.result(),
+            "message_ids": self.message_ids.to_state(),
+            "files_count": self.files_count,
+            "uploaded_bytes": self.uploaded_bytes,
+        }
+
+    def restore(self, state: Optional[Dict[str, Any]]):
+        """
+        Заменяет накопленные данные состоянием из общего хранилища (None — пустая сессия).
+        """
+        self.clear()
+        if state:
+            self.entities.add_entities(state.get("entities") or {})
+            self.message_ids = MessageIdIndex.from_state(state.get("message_ids") or {})
+            self.files_count = state.get("files_count", 0)
+            self.uploaded_bytes = state.get("uploaded_bytes", 0)
+
+    def touch(self):
+        self.last_seen = time.monotonic()
 
     def clear(self):
-        # Явная очистка буферов
-        self.files.clear()
\ No newline at end of file
+        # Явная очистка накопленных данных
+        self.entities = EntityAccumulator()
+        self.message_ids = MessageIdIndex()
+        self.files_count = 0
+        self.uploaded_bytes = 0
+
+
+class SessionStore:
+    """
+    Сессии по user_id с контролем памяти:
+    - бюджет на пользователя и общий бюджет процесса;
+    - отказ в новых загрузках, когда общий объём близок к пределу;
+    - вытеснение сессий, простаивающих дольше ttl (фоновой задачей run_sweeper).
+
+    С общим хранилищем (backend.shared) накопленное состояние между
+    обращениями живёт в нём, а здесь — только на время загрузки или /process.
+    Изменять сессию нужно под lock(): load() -> изменения -> save().
+    """
+
+    def __init__(
+        self,
+        user_budget: int,
+        global_budget: int,
+        ttl: float,
+        high_watermark: float = 0.9,
+        backend: Optional[SessionBackend] = None,
+        lock_ttl: float = 900,
+    ):
+        self.user_budget = user_budget
+        self.global_budget = global_budget
+        self.ttl = ttl
+        self.high_watermark = high_watermark
+        self.backend = backend or MemoryBackend()
+        # Срок жизни блокировки в общем хранилище — на случай падения процесса, который её держит
+        self.lock_ttl = lock_ttl
+        self._sessions: Dict[int, SessionAccumulator] = {}
+
+    def get(self, user_id: int) -> Optional[SessionAccumulator]:
+        acc = self._sessions.get(user_id)
+        if acc is not None:
+            acc.touch()
+        return acc
+
+    def get_or_create(self, user_id: int) -> SessionAccumulator:
+        acc = self.get(user_id)
+        if acc is None:
+            acc = self._sessions[user_id] = SessionAccumulator()
+        return acc
+
+    def pop(self, user_id: int) -> Optional[SessionAccumulator]:
+        return self._sessions.pop(user_id, None)
+
+    def lock(self, user_id: int) -> Any:
+        """
+        Блокировка сессии на время чтения-изменения-записи. Разбор файла держит
+        её только для снимка индекса id и слияния итога; /process держит её
+        всё время обработки, а незавершённые разборы дожидается через pending.
+        """
+        return self.backend.lock(f"session:{user_id}", self.lock_ttl)
+
+    async def load(self, user_id: int) -> SessionAccumulator:
+        """
+        Сессия с актуальным состоянием (из общего хранилища, если оно используется).
+        """
+        acc = self.get_or_create(user_id)
+        if self.backend.shared:
+            acc.restore(await self.backend.load(user_id))
+        return acc
+
+    async def summary(self, user_id: int) -> Tuple[int, int]:
+        """
+        Без блокировки: (число загруженных и разбираемых сейчас файлов, объём загрузок в байтах).
+        """
+        acc = self.get(user_id)
+        files = acc.count() + len(acc.pending) if acc is not None else 0
+        uploaded = acc.uploaded_bytes if acc is not None else 0
+        if self.backend.shared:
+            state = await self.backend.load(user_id)
+            if state:
+                files = max(files, state.get("files_count", 0))
+                uploaded = max(uploaded, state.get("uploaded_bytes", 0))
+        return files, uploaded
+
+    async def save(self, user_id: int, acc: SessionAccumulator, epoch: Optional[int] = None):
+        """
+        Записывает сессию в общее хранилище. epoch — значение cancel_epoch в начале
+        задания: если с тех пор был /cancel, бросает JobCancelled и ничего не пишет.
+        """
+        if not self.backend.shared:
+            return
+        if not await self.backend.save(user_id, acc.to_state(), self.ttl, epoch):
+            raise JobCancelled("обработка отменена")
+        # Между обращениями состояние хранится только в общем хранилище
+        if not acc.inflight_bytes and not acc.processing and self._sessions.get(user_id) is acc:
+            self._sessions.pop(user_id)
+            acc.clear()
+
+    async def cancel_epoch(self, user_id: int) -> int:
+        """
+        Запоминается в начале задания и передаётся в save(): после /cancel
+        (в том числе принятой другим процессом бота) сохранение отклоняется.
+        """
+        return await self.backend.cancel_epoch(user_id)
+
+    async def check_cancelled(self, user_id: int, epoch: Optional[int]):
+        """
+        Бросает JobCancelled, если после начала задания был /cancel. Вызывается
+        под lock() до изменения сессии: в памяти процесса save() ничего не проверяет.
+        """
+        if epoch is not None and await self.backend.cancel_epoch(user_id) != epoch:
+            raise JobCancelled("обработка отменена")
+
+    async def get_setting(self, user_id: int, name: str) -> Optional[str]:
+        return await self.backend.get_setting(user_id, name)
+
+    async def set_setting(self, user_id: int, name: str, value: str):
+        await self.backend.set_setting(user_id, name, value)
+
+    async def cancel(self, user_id: int):
+        """
+        /cancel: удаляет сессию и отменяет сохранение для заданий, начатых до этого.
+        """
+        await self.backend.bump_cancel_epoch(user_id)
+        await self.drop(user_id)
+
+    async def drop(self, user_id: int):
+        acc = self._sessions.pop(user_id, None)
+        if acc is not None:
+            acc.clear()
+        if self.backend.shared:
+            await self.backend.delete(user_id)
+
+    def used_bytes(self) -> int:
+        return sum(acc.size() for acc in self._sessions.values())
+
+    def reserve(self, user_id: int, nbytes: int) -> SessionAccumulator:
+        """
+        Резервирует nbytes под загрузку пользователя или бросает BudgetExceeded.
+        После разбора резерв нужно вернуть через release().
+        """
+        acc = self.get_or_create(user_id)
+        if acc.size() + nbytes > self.user_budget:
+            raise BudgetExceeded(
+                "Превышен лимит объёма данных на одну сессию "
+                f"({self.user_budget // (1024 * 1024)} МБ). Отправьте /process для уже загруженных файлов."
+            )
+        if self.used_bytes() + nbytes > self.global_budget * self.high_watermark:
+            raise BudgetExceeded(
+                "Бот сейчас перегружен и не может принять файл. Попробуйте отправить его через несколько минут."
+            )
+        acc.inflight_bytes += nbytes
+        return acc
+
+    def release(self, acc: SessionAccumulator, nbytes: int, user_id: Optional[int] = None):
+        acc.inflight_bytes = max(0, acc.inflight_bytes - nbytes)
+        # С общим хранилищем локальная копия больше не нужна: всё сохранено в save()
+        if (
+            self.backend.shared and user_id is not None and not acc.inflight_bytes
+            and not acc.processing and self._sessions.get(user_id) is acc
+        ):
+            self._sessions.pop(user_id).clear()
+
+    def sweep(self) -> int:
+        """
+        Удаляет сессии, простаивающие дольше ttl. Сессии с незавершённой
+        загрузкой, разбором или /process не трогаем. Возвращает число удалённых сессий.
+        """
+        deadline = time.monotonic() - self.ttl
+        idle = [
+            user_id for user_id, acc in self._sessions.items()
+            if acc.last_seen < deadline and not acc.pending and not acc.inflight_bytes and not acc.processing
+        ]
+        for user_id in idle:
+            self._sessions.pop(user_id).clear()
+        return len(idle)
+
+    async def run_sweeper(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            evicted = self.sweep()
+            if evicted:
+                logger.info("Evicted %d idle sessions, %d bytes in use", evicted, self.used_bytes())
+
+    def __len__(self) -> int:
+        return len(self._sessions)
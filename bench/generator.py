@@ -0,0 +1,329 @@
+"""
+Детерминированный генератор синтетических экспортов Telegram Desktop для бенчмарков.
+
+Формирует result.json, постраничные messages*.html (по 1000 сообщений на страницу,
+как Telegram Desktop) и ZIP-архивы с заглушками медиафайлов, а также result.json
+выгрузки всего аккаунта (chats.list). Всё пишется потоково, поэтому можно
+генерировать экспорты на миллионы сообщений.
+
+Пример:
+    python -m bench.generator --messages 100000 --format zip-html --out /tmp/export.zip
+"""
+import argparse
+import html
+import io
+import json
+import os
+import random
+import zipfile
+from dataclasses import dataclass, replace
+from datetime import datetime, timezone
+from typing import IO, Iterator, List, Tuple
+
+# Сообщений на одну HTML-страницу (messages.html, messages2.html, ...)
+HTML_PAGE_SIZE = 1000
+
+_START_TS = 1672531200  # 2023-01-01 00:00:00 UTC
+
+_FIRST_NAMES = ["Алексей", "Мария", "Иван", "Ольга", "John", "Anna", "Дмитрий", "Elena", "Павел", "Kate"]
+_LAST_NAMES = ["Иванов", "Смирнова", "Petrov", "Кузнецова", "Smith", "Соколов", "Lee", "Попова"]
+_WORDS = (
+    "привет как дела сегодня встреча проект задача отчёт ссылка файл посмотри "
+    "hello thanks deadline release review link update meeting tomorrow ok"
+).split()
+
+
+@dataclass
+class ExportSpec:
+    """
+    Параметры синтетического чата.
+    """
+    messages: int = 10_000
+    authors: int = 500
+    mentions: int = 2_000
+    # Доля сообщений с упоминанием и с t.me-ссылкой
+    mention_rate: float = 0.3
+    link_rate: float = 0.05
+    # Доли сообщений от каналов, служебных и с медиа
+    channel_rate: float = 0.02
+    service_rate: float = 0.01
+    media_rate: float = 0.05
+    seed: int = 42
+
+
+# (id, unixtime, автор, from_id, служебное, фото, части текста)
+# часть текста: ("plain", текст) | ("mention", "@username") | ("text_link", текст, href)
+_Message = Tuple[int, int, str, str, bool, str, List[tuple]]
+
+
+def _author_names(spec: ExportSpec, rnd: random.Random) -> List[Tuple[str, str]]:
+    authors = []
+    for i in range(spec.authors):
+        if rnd.random() < spec.channel_rate:
+            authors.append((f"Канал {i}", f"channel{1_000_000 + i}"))
+        else:
+            name = f"{rnd.choice(_FIRST_NAMES)} {rnd.choice(_LAST_NAMES)} {i}"
+            authors.append((name, f"user{5_000_000 + i}"))
+    return authors
+
+
+def iter_messages(spec: ExportSpec) -> Iterator[_Message]:
+    """
+    Поток синтетических сообщений; одинаковый для одинаковых spec.
+    """
+    rnd = random.Random(spec.seed)
+    authors = _author_names(spec, rnd)
+    usernames = [f"user_{i:06d}" for i in range(max(spec.mentions, 1))]
+    ts = _START_TS
+    for msg_id in range(1, spec.messages + 1):
+        ts += rnd.randint(1, 120)
+        name, from_id = authors[int(rnd.paretovariate(1.2)) % len(authors)]
+        service = rnd.random() < spec.service_rate
+        photo = ""
+        if not service and rnd.random() < spec.media_rate:
+            photo = f"photos/photo_{msg_id}@{datetime.fromtimestamp(ts, timezone.utc):%d-%m-%Y_%H-%M-%S}.jpg"
+        parts: List[tuple] = [("plain", " ".join(rnd.choices(_WORDS, k=rnd.randint(2, 12))))]
+        if not service and rnd.random() < spec.mention_rate:
+            parts.append(("plain", " "))
+            parts.append(("mention", "@" + usernames[rnd.randrange(len(usernames))]))
+            parts.append(("plain", ", " + rnd.choice(_WORDS)))
+        if not service and rnd.random() < spec.link_rate:
+            target = usernames[rnd.randrange(len(usernames))]
+            parts.append(("plain", " "))
+            parts.append(("text_link", "ссылка", f"https://t.me/{target}"))
+        yield msg_id, ts, name, from_id, service, photo, parts
+
+
+def _json_message(m: _Message) -> dict:
+    msg_id, ts, name, from_id, service, photo, parts = m
+    dt = datetime.fromtimestamp(ts, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S")
+    if service:
+        return {
+            "id": msg_id, "type": "service", "date": dt, "date_unixtime": str(ts),
+            "actor": name, "actor_id": from_id, "action": "pin_message",
+            "message_id": max(msg_id - 1, 1), "text": "", "text_entities": [],
+        }
+    text: list = []
+    entities = []
+    for p in parts:
+        if p[0] == "plain":
+            text.append(p[1])
+            entities.append({"type": "plain", "text": p[1]})
+        elif p[0] == "mention":
+            text.append({"type": "mention", "text": p[1]})
+            entities.append({"type": "mention", "text": p[1]})
+        else:
+            text.append({"type": "text_link", "text": p[1], "href": p[2]})
+            entities.append({"type": "text_link", "text": p[1], "href": p[2]})
+    msg = {
+        "id": msg_id, "type": "message", "date": dt, "date_unixtime": str(ts),
+        "from": name, "from_id": from_id,
+    }
+    if photo:
+        msg.update({"photo": photo, "width": 1280, "height": 960})
+    msg["text"] = text[0] if len(text) == 1 else text
+    msg["text_entities"] = entities
+    return msg
+
+
+def write_result_json(out: IO[str], spec: ExportSpec):
+    """
+    result.json в формате Telegram Desktop (отступ 1 пробел, как в оригинале).
+    """
+    out.write('{\n "name": "Бенчмарк-чат",\n "type": "private_supergroup",\n "id": 1987654321,\n "messages": [')
+    first = True
+    for m in iter_messages(spec):
+        body = json.dumps(_json_message(m), ensure_ascii=False, indent=1)
+        out.write(("\n  " if first else ",\n  ") + body.replace("\n", "\n  "))
+        first = False
+    out.write("\n ]\n}\n")
+
+
+def write_account_json(out: IO[str], spec: ExportSpec, chats: int):
+    """
+    result.json выгрузки всего аккаунта («Export Telegram data»): сообщения
+    spec делятся между chats чатами в chats.list (первый чат — крупнейший).
+    """
+    out.write(
+        '{\n "about": "Here is the data you requested.",\n'
+        ' "personal_information": {\n  "user_id": 1000001,\n  "first_name": "Бенчмарк",\n  "last_name": "",\n'
+        '  "phone_number": "+0 000 000 0000",\n  "bio": ""\n },\n'
+        ' "contacts": {\n  "about": "",\n  "list": []\n },\n'
+        ' "chats": {\n  "about": "This is the list of all chats.",\n  "list": ['
+    )
+    chats = max(chats, 1)
+    # Размеры чатов убывают как 1/k — как у реальных аккаунтов
+    weights = [1 / k for k in range(1, chats + 1)]
+    total = sum(weights)
+    sizes = [max(1, int(spec.messages * w / total)) for w in weights]
+    for i, size in enumerate(sizes):
+        chat_spec = replace(spec, messages=size, seed=spec.seed + i)
+        out.write(("\n   " if i == 0 else ",\n   ") + "{\n")
+        out.write(f'    "name": "Чат {i + 1}",\n    "type": "private_supergroup",\n    "id": {1_000_000_000 + i},\n    "messages": [')
+        first = True
+        for m in iter_messages(chat_spec):
+            body = json.dumps(_json_message(m), ensure_ascii=False, indent=1)
+            out.write(("\n     " if first else ",\n     ") + body.replace("\n", "\n     "))
+            first = False
+        out.write("\n    ]\n   }")
+    out.write("\n  ]\n },\n \"left_chats\": {\n  \"about\": \"\",\n  \"list\": []\n }\n}\n")
+
+
+_HTML_HEAD = (
+    '<!DOCTYPE html>\n<html>\n <head>\n  <meta charset="utf-8"/>\n  <title>Exported Data</title>\n'
+    '  <meta content="width=device-width, initial-scale=1.0" name="viewport"/>\n'
+    '  <link href="css/style.css" rel="stylesheet"/>\n  <script src="js/script.js" type="text/javascript"></script>\n'
+    ' </head>\n <body onload="CheckLocation();">\n  <div class="page_wrap">\n   <div class="page_header">\n'
+    '    <div class="content">\n     <div class="text bold">\nБенчмарк-чат\n     </div>\n    </div>\n   </div>\n'
+    '   <div class="page_body chat_page">\n    <div class="history">\n'
+)
+_HTML_TAIL = "    </div>\n   </div>\n  </div>\n </body>\n</html>\n"
+
+
+def _html_message(m: _Message, prev_author: str) -> str:
+    msg_id, ts, name, _, service, photo, parts = m
+    if service:
+        return (
+            f'     <div class="message service" id="message{msg_id}">\n      <div class="body details">\n'
+            f"{html.escape(name)} pinned a message\n      </div>\n     </div>\n"
+        )
+    dt = datetime.fromtimestamp(ts, timezone.utc)
+    joined = name == prev_author
+    out = [f'     <div class="message default clearfix{" joined" if joined else ""}" id="message{msg_id}">\n']
+    if not joined:
+        out.append(
+            '      <div class="pull_left userpic_wrap">\n       <div class="userpic userpic3" style="width: 42px; height: 42px">\n'
+            f'        <div class="initials" style="line-height: 42px">\n{html.escape(name[:1])}\n        </div>\n'
+            "       </div>\n      </div>\n"
+        )
+    out.append(
+        '      <div class="body">\n'
+        f'       <div class="pull_right date details" title="{dt:%d.%m.%Y %H:%M:%S} UTC+00:00">\n{dt:%H:%M}\n       </div>\n'
+    )
+    if not joined:
+        out.append(f'       <div class="from_name">\n{html.escape(name)}\n       </div>\n')
+    if photo:
+        out.append(
+            '       <div class="media_wrap clearfix">\n'
+            f'        <a class="photo_wrap clearfix pull_left" href="{photo}">\n'
+            f'         <img class="photo" src="{photo[:-4]}_thumb.jpg" style="width: 260px; height: 195px"/>\n'
+            "        </a>\n       </div>\n"
+        )
+    text = []
+    for p in parts:
+        if p[0] == "plain":
+            text.append(html.escape(p[1]))
+        elif p[0] == "mention":
+            text.append(f'<a href="" onclick="return ShowMentionName()">{html.escape(p[1])}</a>')
+        else:
+            text.append(f'<a href="{html.escape(p[2])}">{html.escape(p[1])}</a>')
+    out.append(f'       <div class="text">\n{"".join(text)}\n       </div>\n      </div>\n     </div>\n')
+    return "".join(out)
+
+
+def iter_html_pages(spec: ExportSpec) -> Iterator[Tuple[str, Iterator[str]]]:
+    """
+    Пары (имя страницы, поток фрагментов HTML): messages.html, messages2.html, ...
+    Каждую страницу нужно дочитать до перехода к следующей.
+    """
+    messages = iter_messages(spec)
+    pages = (spec.messages + HTML_PAGE_SIZE - 1) // HTML_PAGE_SIZE
+    for page in range(1, max(pages, 1) + 1):
+        name = "messages.html" if page == 1 else f"messages{page}.html"
+
+        def page_body() -> Iterator[str]:
+            yield _HTML_HEAD
+            prev = ""
+            for _ in range(HTML_PAGE_SIZE):
+                m = next(messages, None)
+                if m is None:
+                    break
+                yield _html_message(m, prev)
+                prev = "" if m[4] else m[2]
+            yield _HTML_TAIL
+
+        yield name, page_body()
+
+
+def _media_stub(rnd: random.Random) -> bytes:
+    # Заглушка JPEG: сигнатура + случайные (плохо сжимаемые) байты
+    return b"\xff\xd8\xff\xe0" + rnd.randbytes(rnd.randint(2_000, 20_000)) + b"\xff\xd9"
+
+
+def write_zip(path: str, spec: ExportSpec, fmt: str = "json"):
+    """
+    ZIP как у Telegram Desktop: ChatExport_<дата>/result.json или messages*.html,
+    плюс заглушки фотографий (и css/js для HTML).
+    """
+    root = "ChatExport_2024-01-01/"
+    rnd = random.Random(spec.seed + 1)
+    with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        if fmt == "json":
+            with zf.open(root + "result.json", "w", force_zip64=True) as raw:
+                with _text_writer(raw) as out:
+                    write_result_json(out, spec)
+        else:
+            zf.writestr(root + "css/style.css", "body{margin:0}\n" * 200)
+            zf.writestr(root + "js/script.js", "function CheckLocation(){}\n" * 100)
+            for name, body in iter_html_pages(spec):
+                with zf.open(root + name, "w", force_zip64=True) as raw:
+                    with _text_writer(raw) as out:
+                        for piece in body:
+                            out.write(piece)
+        for m in iter_messages(spec):
+            if m[5]:
+                # Медиа хранятся без сжатия, как в реальных экспортах
+                zf.writestr(zipfile.ZipInfo(root + m[5]), _media_stub(rnd), compress_type=zipfile.ZIP_STORED)
+
+
+def _text_writer(raw) -> IO[str]:
+    return io.TextIOWrapper(raw, encoding="utf-8", newline="\n", write_through=False)
+
+
+def generate(out_path: str, spec: ExportSpec, fmt: str, chats: int = 10) -> str:
+    """
+    Генерирует экспорт в out_path. fmt: json | html | zip-json | zip-html | account-json.
+    Для html out_path — каталог со страницами messages*.html.
+    """
+    if fmt == "json":
+        with open(out_path, "w", encoding="utf-8", newline="\n") as out:
+            write_result_json(out, spec)
+    elif fmt == "account-json":
+        with open(out_path, "w", encoding="utf-8", newline="\n") as out:
+            write_account_json(out, spec, chats)
+    elif fmt == "html":
+        os.makedirs(out_path, exist_ok=True)
+        for name, body in iter_html_pages(spec):
+            with open(os.path.join(out_path, name), "w", encoding="utf-8", newline="\n") as out:
+                for piece in body:
+                    out.write(piece)
+    elif fmt in ("zip-json", "zip-html"):
+        write_zip(out_path, spec, fmt.split("-", 1)[1])
+    else:
+        raise ValueError(f"Неизвестный формат: {fmt}")
+    return out_path
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Генератор синтетических экспортов Telegram Desktop")
+    ap.add_argument("--messages", type=int, default=ExportSpec.messages)
+    ap.add_argument("--authors", type=int, default=ExportSpec.authors)
+    ap.add_argument("--mentions", type=int, default=ExportSpec.mentions)
+    ap.add_argument("--mention-rate", type=float, default=ExportSpec.mention_rate)
+    ap.add_argument("--seed", type=int, default=ExportSpec.seed)
+    ap.add_argument("--format", choices=["json", "html", "zip-json", "zip-html", "account-json"], default="json")
+    ap.add_argument("--chats", type=int, default=10, help="число чатов для account-json")
+    ap.add_argument("--out", required=True)
+    args = ap.parse_args()
+    spec = ExportSpec(
+        messages=args.messages,
+        authors=args.authors,
+        mentions=args.mentions,
+        mention_rate=args.mention_rate,
+        seed=args.seed,
+    )
+    print(generate(args.out, spec, args.format, args.chats))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+"""
+Бенчмарки парсера, экстрактора и генерации Excel на синтетических экспортах.
+
+Каждый этап измеряется в отдельном свежем процессе, чтобы пиковый RSS одного
+этапа не влиял на другие. Результат — JSON (stdout или --out) для сравнения сборок.
+
+Пример:
+    python -m bench.run --sizes 10000,100000 --formats json,zip-html --out bench.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, List
+
+from bench.generator import ExportSpec, generate
+
+FORMATS = ["json", "html", "zip-json", "zip-html", "account-json"]
+# parse / extract / excel / csv / jsonl — по отдельности, end_to_end — как в боте (summarize_file + build_excel_bytes)
+STAGES = ["parse", "extract", "excel", "csv", "jsonl", "end_to_end"]
+# Этапы формирования результата (на вход — готовые сущности)
+OUTPUT_STAGES = ("excel", "csv", "jsonl")
+
+
+def _peak_rss_bytes() -> int:
+    # ru_maxrss: КБ в Linux, байты в macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def _load_files(path: str, fmt: str) -> list:
+    from app.utils.temp import InMemoryFile
+
+    if fmt == "html":
+        names = sorted(
+            (n for n in os.listdir(path) if n.startswith("messages") and n.endswith(".html")),
+            key=lambda n: int(n[len("messages"):-len(".html")] or 1),
+        )
+        paths = [os.path.join(path, n) for n in names]
+    else:
+        paths = [path]
+    files = []
+    for p in paths:
+        with open(p, "rb") as f:
+            files.append(InMemoryFile(name=os.path.basename(p), mime="", data=f.read()))
+    return files
+
+
+def _measure(path: str, fmt: str, stage: str) -> Dict[str, Any]:
+    """
+    Выполняется в отдельном процессе. Входные данные для этапа готовятся заранее
+    и в замер не входят; peak_rss_delta — прирост пикового RSS за время этапа.
+    """
+    from app.processing.excel import build_excel_bytes
+    from app.processing.export import build_export_bytes
+    from app.processing.extractor import extract_entities, merge_entities
+    from app.processing.parser import parse_telegram_export_streams
+    from app.processing.pipeline import summarize_file
+
+    files = _load_files(path, fmt)
+    export_date = datetime(2024, 1, 1)
+    parsed = entities = None
+    if stage == "extract" or stage in OUTPUT_STAGES:
+        parsed = parse_telegram_export_streams(files)
+    if stage in OUTPUT_STAGES:
+        entities = extract_entities(parsed)
+        parsed = None
+
+    rss_before = _peak_rss_bytes()
+    started = time.perf_counter()
+    if stage == "parse":
+        parsed = parse_telegram_export_streams(files)
+        messages = len(parsed["messages"])
+    elif stage == "extract":
+        messages = len(parsed["messages"])
+        entities = extract_entities(parsed)
+    elif stage == "excel":
+        data = build_excel_bytes(entities["participants"], entities["mentions"], entities["channels"], export_date,
+                                 entities.get("chats"))
+        messages = 0
+    elif stage in ("csv", "jsonl"):
+        data = build_export_bytes(stage, entities["participants"], entities["mentions"], entities["channels"],
+                                  entities.get("chats"))
+        messages = 0
+    else:
+        entities = merge_entities([summarize_file(f) for f in files])
+        data = build_excel_bytes(entities["participants"], entities["mentions"], entities["channels"], export_date,
+                                 entities.get("chats"))
+        messages = 0
+    seconds = time.perf_counter() - started
+    rss_after = _peak_rss_bytes()
+
+    result = {
+        "seconds": round(seconds, 4),
+        "peak_rss_mb": round(rss_after / 2**20, 1),
+        "peak_rss_delta_mb": round((rss_after - rss_before) / 2**20, 1),
+    }
+    if messages:
+        result["messages_parsed"] = messages
+    if entities is not None:
+        result["rows"] = sum(len(v) for k, v in entities.items() if k != "chats")
+    if stage in OUTPUT_STAGES or stage == "end_to_end":
+        result["output_bytes"] = len(data)
+    return result
+
+
+def _input_bytes(path: str) -> int:
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(path, n)) for n in os.listdir(path))
+    return os.path.getsize(path)
+
+
+def _git_revision() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except Exception:
+        return ""
+
+
+def run(sizes: List[int], formats: List[str], stages: List[str], authors: int, mentions: int,
+        seed: int, workdir: str) -> Dict[str, Any]:
+    ctx = multiprocessing.get_context("spawn")
+    results = []
+    for size in sizes:
+        spec = ExportSpec(messages=size, authors=authors, mentions=mentions, seed=seed)
+        for fmt in formats:
+            suffix = ".zip" if "zip" in fmt else ".json" if fmt.endswith("json") else ""
+            path = os.path.join(workdir, f"export_{size}_{fmt}" + suffix)
+            gen_started = time.perf_counter()
+            generate(path, spec, fmt)
+            size_bytes = _input_bytes(path)
+            print(f"[bench] {fmt} {size} messages: {size_bytes / 2**20:.1f} MB "
+                  f"generated in {time.perf_counter() - gen_started:.1f}s", file=sys.stderr)
+            for stage in stages:
+                with ctx.Pool(1) as pool:
+                    measured = pool.apply(_measure, (path, fmt, stage))
+                row = {
+                    "format": fmt,
+                    "messages": size,
+                    "authors": authors,
+                    "mentions": mentions,
+                    "input_bytes": size_bytes,
+                    "stage": stage,
+                    **measured,
+                }
+                if stage in ("parse", "extract", "end_to_end") and measured["seconds"] > 0:
+                    row["messages_per_sec"] = round(size / measured["seconds"])
+                    row["input_mb_per_sec"] = round(size_bytes / 2**20 / measured["seconds"], 2)
+                print(f"[bench]   {stage}: {measured['seconds']:.3f}s, "
+                      f"peak RSS {measured['peak_rss_mb']} MB", file=sys.stderr)
+                results.append(row)
+            # Большие экспорты удаляем сразу, не дожидаясь конца прогона
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+    return {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "revision": _git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "seed": seed,
+        },
+        "results": results,
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Бенчмарки обработки экспортов Telegram")
+    ap.add_argument("--sizes", default="10000,100000",
+                    help="Число сообщений через запятую (например 10000,100000,1000000,5000000)")
+    ap.add_argument("--formats", default=",".join(FORMATS))
+    ap.add_argument("--stages", default=",".join(STAGES))
+    ap.add_argument("--authors", type=int, default=ExportSpec.authors)
+    ap.add_argument("--mentions", type=int, default=ExportSpec.mentions)
+    ap.add_argument("--seed", type=int, default=ExportSpec.seed)
+    ap.add_argument("--workdir", default=None, help="Каталог для сгенерированных экспортов (по умолчанию временный)")
+    ap.add_argument("--out", default="-", help="Файл для JSON-результата, '-' — stdout")
+    args = ap.parse_args()
+
+    formats = [f for f in args.formats.split(",") if f]
+    stages = [s for s in args.stages.split(",") if s]
+    for f in formats:
+        if f not in FORMATS:
+            ap.error(f"неизвестный формат: {f}")
+    for s in stages:
+        if s not in STAGES:
+            ap.error(f"неизвестный этап: {s}")
+
+    with tempfile.TemporaryDirectory(dir=args.workdir) as workdir:
+        report = run(
+            sizes=[int(s) for s in args.sizes.split(",") if s],
+            formats=formats,
+            stages=stages,
+            authors=args.authors,
+            mentions=args.mentions,
+            seed=args.seed,
+            workdir=workdir,
+        )
+
+    payload = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.out == "-":
+        print(payload)
+    else:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(payload + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,30 @@
+from app.processing.dedup import MessageIdIndex
+
+
+def _index(**chats) -> MessageIdIndex:
+    index = MessageIdIndex()
+    for chat, ids in chats.items():
+        for msg_id in ids:
+            index.add(chat, msg_id)
+    return index
+
+
+def test_covers_and_overlaps():
+    session = _index(a=range(1, 11), b=[5, 7])
+    assert session.covers(_index(a=range(3, 8), b=[7]))
+    assert session.covers(MessageIdIndex())
+    # Часть id за пределами диапазона, дыра между диапазонами, другой чат
+    assert not session.covers(_index(a=range(8, 13)))
+    assert not session.covers(_index(b=[5, 6, 7]))
+    assert not session.covers(_index(c=[1]))
+    assert session.overlaps(_index(a=range(8, 13)))
+    assert not session.overlaps(_index(b=[6], c=[1]))
+
+
+def test_copy_is_independent():
+    session = _index(a=[1, 2, 3])
+    snapshot = session.copy()
+    session.add("a", 4)
+    session.add("b", 1)
+    assert snapshot.to_state() == {"a": [[1], [3]]}
+    assert session.covers(snapshot) and not snapshot.covers(session)
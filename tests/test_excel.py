@@ -0,0 +1,34 @@
+import io
+from datetime import datetime
+
+from openpyxl import load_workbook
+
+from app.processing import excel
+
+
+def _sheets(data: bytes):
+    wb = load_workbook(io.BytesIO(data), read_only=True)
+    return {ws.title: [list(row) for row in ws.iter_rows(values_only=True)] for ws in wb.worksheets}
+
+
+def _participants(n: int):
+    return [{"username": f"user{i}", "name": f"User {i}", "messages": i + 1} for i in range(n)]
+
+
+def test_rows_over_sheet_limit_continue_on_next_sheet(monkeypatch):
+    # Предел Excel — 1 048 576 строк; уменьшаем его: 3 строки данных под заголовком
+    monkeypatch.setattr(excel, "_SHEET_MAX_ROWS", 4)
+    data = excel.build_excel_bytes(_participants(7), [], [], datetime(2024, 1, 1))
+    sheets = _sheets(data)
+    assert list(sheets) == ["Участники", "Участники (2)", "Участники (3)", "Упоминания", "Каналы"]
+    parts = [sheets["Участники"], sheets["Участники (2)"], sheets["Участники (3)"]]
+    assert all(rows[0] == excel.PARTICIPANT_HEADERS for rows in parts)
+    assert [len(rows) for rows in parts] == [4, 4, 2]
+    usernames = [row[1] for rows in parts for row in rows[1:]]
+    assert usernames == [f"user{i}" for i in range(7)]
+
+
+def test_full_sheet_does_not_add_empty_continuation(monkeypatch):
+    monkeypatch.setattr(excel, "_SHEET_MAX_ROWS", 4)
+    data = excel.build_excel_bytes(_participants(6), [], [], datetime(2024, 1, 1))
+    assert list(_sheets(data)) == ["Участники", "Участники (2)", "Упоминания", "Каналы"]
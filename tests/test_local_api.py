@@ -0,0 +1,95 @@
+import asyncio
+from pathlib import Path
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import SimpleFilesPathWrapper, TelegramAPIServer
+from aiohttp import web
+
+from app.processing.pipeline import summarize_upload
+from app.utils.pool import init_pool, run_in_pool, shutdown_pool
+from app.utils.temp import InMemoryFile, LocalFiles
+
+_SERVER_DIR = "/var/lib/telegram-bot-api"
+_EXPORT = (
+    b'{"name": "Chat", "type": "private_group", "id": 7, "messages": ['
+    b'{"id": 1, "type": "message", "date_unixtime": "1672556400", "from": "Alice", "from_id": "user1",'
+    b' "text": ["hi ", {"type": "mention", "text": "@bob_smith"}]},'
+    b'{"id": 2, "type": "message", "date_unixtime": "1672556460", "from": "Bob", "from_id": "user2", "text": "ok"}'
+    b"]}"
+)
+
+
+async def _local_upload(files_dir: Path) -> InMemoryFile:
+    """
+    Как _fetch_upload бота с BOT_API_LOCAL=1: getFile у локального сервера
+    (здесь — aiohttp вместо telegram-bot-api) и путь к файлу на смонтированном диске.
+    """
+    async def get_file(request: web.Request) -> web.Response:
+        data = await request.post()
+        return web.json_response({"ok": True, "result": {
+            "file_id": data["file_id"], "file_unique_id": "u1", "file_size": len(_EXPORT),
+            "file_path": f"{_SERVER_DIR}/1:test/documents/file_1.json",
+        }})
+
+    app = web.Application()
+    app.router.add_post("/bot{token}/getFile", get_file)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    api = TelegramAPIServer.from_base(
+        f"http://127.0.0.1:{port}", is_local=True,
+        wrap_local_file=SimpleFilesPathWrapper(_SERVER_DIR, str(files_dir)),
+    )
+    bot = Bot("1:test", session=AiohttpSession(api=api))
+    try:
+        file = await bot.get_file("doc1")
+        path = str(bot.session.api.wrap_local_file.to_local(file.file_path))
+        return InMemoryFile(name="result.json", mime="application/json", path=path)
+    finally:
+        await bot.session.close()
+        await runner.cleanup()
+
+
+def test_local_server_file_is_parsed_by_path_in_pool(tmp_path):
+    documents = tmp_path / "1:test" / "documents"
+    documents.mkdir(parents=True)
+    (documents / "file_1.json").write_bytes(_EXPORT)
+
+    async def scenario():
+        upload = await _local_upload(tmp_path)
+        init_pool(1)
+        try:
+            # В рабочий процесс передаётся только путь, содержимое читается там через mmap
+            return upload, await run_in_pool(summarize_upload, upload, None)
+        finally:
+            shutdown_pool()
+
+    upload, (entities, message_ids, skipped) = asyncio.run(scenario())
+    assert upload.data == b"" and upload.path == str(documents / "file_1.json")
+    assert upload.size == len(_EXPORT)
+    assert sorted(p["name"] for p in entities["participants"]) == ["Alice", "Bob"]
+    assert [m["username"] for m in entities["mentions"]] == ["bob_smith"]
+    assert message_ids.contains("id:7", 1) and message_ids.contains("id:7", 2) and skipped == 0
+
+
+def test_local_file_is_deleted_after_last_reader(tmp_path):
+    path = tmp_path / "file_1.json"
+    path.write_bytes(_EXPORT)
+    files = LocalFiles()
+    # Один и тот же документ прислан дважды: оба разбора читают один файл сервера
+    files.acquire(str(path))
+    files.acquire(str(path))
+    files.release(str(path), delete=True)
+    assert path.exists()
+    files.release(str(path), delete=True)
+    assert not path.exists()
+    assert len(files) == 0
+
+    kept = tmp_path / "file_2.json"
+    kept.write_bytes(_EXPORT)
+    files.acquire(str(kept))
+    files.release(str(kept), delete=False)
+    assert kept.exists() and len(files) == 0
@@ -0,0 +1,227 @@
+import html
+import io
+import json
+import zipfile
+
+import pytest
+
+from app.processing import parser
+from app.processing.normalize import collect_mentions, username_from_link
+from app.processing.parser import parse_telegram_export_streams
+from app.utils.temp import InMemoryFile
+
+# Один и тот же чат: (id, автор, id автора, время, части текста в формате result.json)
+_MESSAGES = [
+    (1, "Alice", "user1", 1672556400, ["Привет, ", {"type": "mention", "text": "@Bob_smith"}, "!"]),
+    (2, "Bob", "user2", 1672556460, ["почта a@b.com, канал ", {"type": "text_link", "text": "тут", "href": "https://t.me/news_chan/5"}]),
+    (3, "Bob", "user2", 1672556520, ["вход ", {"type": "link", "text": "https://t.me/joinchat/AAAA"}, " и @Tail_name."]),
+    (4, "Новости", "channel9", 1672556580, ["пишите @bob_SMITH и @bob_smith"]),
+]
+
+
+def _json_export() -> bytes:
+    messages = [
+        {
+            "id": msg_id, "type": "message", "date": "2023-01-01T07:00:00", "date_unixtime": str(ts),
+            "from": name, "from_id": from_id, "text": parts,
+        }
+        for msg_id, name, from_id, ts, parts in _MESSAGES
+    ]
+    return json.dumps({"name": "Chat", "type": "private_supergroup", "id": 1, "messages": messages},
+                      ensure_ascii=False).encode()
+
+
+def _html_part(part) -> str:
+    if isinstance(part, str):
+        return html.escape(part)
+    if part["type"] == "mention":
+        return f'<a href="" onclick="return ShowMentionName()">{part["text"]}</a>'
+    href = part.get("href", part["text"])
+    return f'<a href="{html.escape(href)}">{html.escape(part["text"])}</a>'
+
+
+def _html_export() -> bytes:
+    out = ['<html><body><div class="page_header"><div class="text bold">Chat</div></div><div class="history">']
+    prev = None
+    for msg_id, name, from_id, ts, parts in _MESSAGES:
+        joined = name == prev
+        prev = name
+        cls = "message default clearfix" + (" joined" if joined else "")
+        # Дата в HTML — местное время экспортировавшего со смещением
+        local = ts + 3 * 3600
+        title = f"01.01.2023 {local // 3600 % 24:02d}:{local // 60 % 60:02d}:{local % 60:02d} UTC+03:00"
+        out.append(f'<div class="{cls}" id="message{msg_id}"><div class="body">')
+        out.append(f'<div class="pull_right date details" title="{title}">10:00</div>')
+        if not joined:
+            out.append(f'<div class="from_name">{html.escape(name)}</div>')
+        out.append(f'<div class="text">{"".join(map(_html_part, parts))}</div></div></div>')
+    out.append("</div></body></html>")
+    return "".join(out).encode()
+
+
+def _zip_export(members) -> bytes:
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as zf:
+        for name, data in members:
+            zf.writestr(name, data)
+    return buf.getvalue()
+
+
+def _parse(name: str, data: bytes):
+    return parse_telegram_export_streams([InMemoryFile(name, "", data)])["messages"]
+
+
+def _comparable(messages):
+    # Имя, id, время и упоминания одинаковы во всех форматах. В HTML фрагменты текста
+    # склеиваются через перевод строки, а автор-канал определяется иначе (по классу
+    # и ссылке), поэтому text и is_channel не сравниваются
+    return [(m["id"], m["ts"], m["from"]["name"], m["mentions"]) for m in messages]
+
+
+def test_json_and_zip_give_identical_messages():
+    data = _json_export()
+    assert _parse("result.json", data) == _parse("export.zip", _zip_export([("ChatExport/result.json", data)]))
+
+
+def test_zip_with_both_formats_uses_result_json():
+    data = _zip_export([
+        ("ChatExport/result.json", _json_export()),
+        ("ChatExport/messages.html", _html_export()),
+        ("Other/messages.html", _html_export()),
+    ])
+    f = InMemoryFile("export.zip", "", data)
+    # Страницы каталога с result.json не разбираются ни последовательно, ни по отдельности
+    assert [info.filename for info in parser.list_zip_pages(f)] == ["ChatExport/result.json", "Other/messages.html"]
+    # JSON сверяется по id чата, HTML — по названию: страница из другого каталога учитывается отдельно
+    assert len(_parse("export.zip", data)) == 2 * len(_MESSAGES)
+
+
+@pytest.mark.parametrize("engine", ["fast", "bs4"])
+def test_html_matches_json(monkeypatch, engine):
+    monkeypatch.setattr(parser, "HTML_ENGINE", engine)
+    expected = _comparable(_parse("result.json", _json_export()))
+    assert _comparable(_parse("messages.html", _html_export())) == expected
+    zipped = _zip_export([("ChatExport/messages.html", _html_export())])
+    assert _comparable(_parse("export.zip", zipped)) == expected
+
+
+def test_mentions_across_formats():
+    messages = _parse("result.json", _json_export())
+    assert [m["mentions"] for m in messages] == [
+        ["Bob_smith"],
+        ["news_chan"],
+        ["Tail_name"],
+        ["bob_SMITH"],
+    ]
+
+
+def test_fast_engine_falls_back_to_bs4(monkeypatch):
+    expected = _parse("messages.html", _html_export())
+    feed = parser._TelegramHTMLParser.feed
+    calls = []
+
+    def failing_feed(self, data):
+        calls.append(data)
+        # Падение после первой порции: часть сообщений уже выдана
+        if len(calls) == 2:
+            raise ValueError("broken markup")
+        return feed(self, data)
+
+    monkeypatch.setattr(parser, "_CHUNK_SIZE", 256)
+    monkeypatch.setattr(parser._TelegramHTMLParser, "feed", failing_feed)
+    assert _parse("messages.html", _html_export()) == expected
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("пишите на mail@example.com", []),
+    ("a@b.com и @real_user", ["real_user"]),
+    ("@abc слишком короткий, @abcd подходит", ["abcd"]),
+    ("@1digit не username, @_under тоже", []),
+    ("@User_Name, @user_name и @USER_NAME", ["User_Name"]),
+    ("@name@name2", ["name"]),
+])
+def test_collect_mentions_text(text, expected):
+    assert collect_mentions(text) == expected
+
+
+@pytest.mark.parametrize("url, expected", [
+    ("https://t.me/some_user", "some_user"),
+    ("t.me/Some_User/15", "Some_User"),
+    ("https://telegram.me/some_user?start=1", "some_user"),
+    ("https://t.me/joinchat/AAAA", None),
+    ("https://t.me/addstickers/pack", None),
+    ("https://t.me/JoinChat/AAAA", None),
+    ("https://t.me/+AbCdEf", None),
+    ("https://t.me/c/123/45", None),
+    ("https://example.com/t.me/some_user", None),
+])
+def test_username_from_link(url, expected):
+    assert username_from_link(url) == expected
+
+
+def test_collect_mentions_dedup_across_sources():
+    mentions = collect_mentions(
+        "@Some_User и @other_user",
+        links=["https://t.me/some_user", "https://t.me/share/url"],
+        explicit=["OTHER_USER"],
+    )
+    assert mentions == ["some_user", "OTHER_USER"]
+
+
+def test_account_chats_with_same_name_stay_separate():
+    from app.processing.extractor import EntityAccumulator
+
+    chat = json.loads(_json_export())
+    account = {"chats": {"about": "", "list": [dict(chat, id=1), dict(chat, id=2)]}}
+    messages = _parse("result.json", json.dumps(account, ensure_ascii=False).encode())
+    # Одинаковые id сообщений в разных чатах — не повторы
+    assert len(messages) == 2 * len(_MESSAGES)
+    acc = EntityAccumulator()
+    for m in messages:
+        acc.add_message(m)
+    chats = acc.result()["chats"]
+    assert [(c["chat"], c["chat_id"]) for c in chats] == [("Chat", 1), ("Chat", 2)]
+    assert chats[0]["participants"] == chats[1]["participants"]
+
+
+def test_single_chat_exports_with_same_name_stay_separate():
+    chat = json.loads(_json_export())
+    files = [
+        InMemoryFile(f"result{i}.json", "", json.dumps(dict(chat, id=chat_id, name="Work"), ensure_ascii=False).encode())
+        for i, chat_id in enumerate((111, 222))
+    ]
+    # Одинаковые названия и id сообщений, но разные чаты: повторов нет
+    assert len(parse_telegram_export_streams(files)["messages"]) == 2 * len(_MESSAGES)
+    # Та же выгрузка дважды — повторы
+    assert len(parse_telegram_export_streams(files[:1] * 2)["messages"]) == len(_MESSAGES)
+
+
+@pytest.mark.parametrize("indent", [None, 1])
+def test_account_shards_cover_all_chats(monkeypatch, indent):
+    monkeypatch.setattr(parser, "_CHUNK_SIZE", 128)
+    chat = json.loads(_json_export())
+    account = {"chats": {"about": "", "list": [dict(chat, id=i, name=f"Chat {i}") for i in range(5)]}}
+    f = InMemoryFile("result.json", "", json.dumps(account, ensure_ascii=False, indent=indent).encode())
+
+    def records(shard):
+        return [(r.chat_id, r.msg_id, r.name, r.mentions) for r in parser.iter_message_records([f], shard=shard)]
+
+    # Чужие чаты пропускаются (в файле с отступами — без разбора), свои читаются целиком
+    shards = [records((i, 2)) for i in range(2)]
+    assert sorted(shards[0] + shards[1]) == sorted(records(None))
+    assert {chat_id for chat_id, *_ in shards[0]} == {0, 2, 4}
+
+
+@pytest.mark.parametrize("name,make", [
+    ("result.json", _json_export),
+    ("messages.html", _html_export),
+    ("export.zip", lambda: _zip_export([("ChatExport/result.json", _json_export())])),
+])
+def test_path_upload_matches_bytes(tmp_path, name, make):
+    # Файл локального Bot API читается по пути через mmap, а не из байтов в памяти
+    data = make()
+    path = tmp_path / name
+    path.write_bytes(data)
+    from_path = parse_telegram_export_streams([InMemoryFile(name, "", path=str(path))])["messages"]
+    assert from_path == _parse(name, data)
+    assert from_path
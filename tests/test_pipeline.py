@@ -0,0 +1,55 @@
+import io
+import zipfile
+
+from app.processing.parser import list_zip_pages, zip_page_file
+from app.processing.pipeline import merge_summaries, summaries_overlap, summarize_upload, summarize_zip_page
+from app.utils.temp import InMemoryFile
+
+
+def _page(ids) -> str:
+    out = ['<html><body><div class="page_header"><div class="text bold">Chat</div></div><div class="history">']
+    for msg_id in ids:
+        name = "Alice" if msg_id % 2 else "Bob"
+        out.append(
+            f'<div class="message default clearfix" id="message{msg_id}"><div class="body">'
+            f'<div class="pull_right date details" title="01.01.2023 10:00:{msg_id:02d} UTC+03:00">10:00</div>'
+            f'<div class="from_name">{name}</div><div class="text">привет @user{msg_id}</div></div></div>'
+        )
+    out.append("</div></body></html>")
+    return "".join(out)
+
+
+def _archive(*pages) -> InMemoryFile:
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as zf:
+        for i, ids in enumerate(pages):
+            zf.writestr(f"ChatExport/messages{i + 1 if i else ''}.html", _page(ids))
+    return InMemoryFile("export.zip", "", buf.getvalue())
+
+
+def _pages(f: InMemoryFile):
+    # Как при параллельном разборе: каждая страница отдельно, dedup только с сессией
+    return [summarize_zip_page(*zip_page_file(f, info)) for info in list_zip_pages(f)]
+
+
+def _messages(entities):
+    return sorted((p["name"], p["messages"]) for p in entities["participants"])
+
+
+def test_disjoint_pages_merge_like_sequential_parse():
+    f = _archive(range(1, 5), range(5, 9))
+    parts = _pages(f)
+    assert not summaries_overlap(parts)
+    merged, sequential = merge_summaries(parts), summarize_upload(f)
+    assert _messages(merged[0]) == _messages(sequential[0]) == [("Alice", 4), ("Bob", 4)]
+    assert merged[1].to_state() == sequential[1].to_state()
+
+
+def test_overlapping_pages_are_detected():
+    # Одна и та же страница в архиве дважды: независимые части посчитали бы её сообщения дважды
+    f = _archive(range(1, 5), range(3, 7))
+    parts = _pages(f)
+    assert summaries_overlap(parts)
+    entities, _, skipped = summarize_upload(f)
+    assert _messages(entities) == [("Alice", 3), ("Bob", 3)]
+    assert skipped == 2
@@ -0,0 +1,182 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiohttp import web
+
+from app.utils.profiles import ProfileCache, ProfileEnricher
+
+
+class _FakeApi:
+    """
+    Локальный сервер с getChat вместо Bot API: отвечает с задержкой, считает
+    запросы и одновременные запросы. flood — username, на первый запрос которых
+    отвечает 429 с retry_after; missing — username, которых «нет» (400).
+    """
+
+    def __init__(self, flood=(), missing=(), delay: float = 0.02):
+        self.flood = set(flood)
+        self.missing = set(missing)
+        self.delay = delay
+        self.calls: List[str] = []
+        self.times: List[float] = []
+        self.active = 0
+        self.peak = 0
+
+    async def get_chat(self, request: web.Request) -> web.Response:
+        data = await request.post()
+        chat_id = data["chat_id"]
+        self.calls.append(chat_id)
+        self.times.append(time.monotonic())
+        self.active += 1
+        self.peak = max(self.peak, self.active)
+        try:
+            await asyncio.sleep(self.delay)
+            if chat_id in self.flood:
+                self.flood.discard(chat_id)
+                return web.json_response({
+                    "ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                    "parameters": {"retry_after": 1},
+                }, status=429)
+            if chat_id in self.missing:
+                return web.json_response(
+                    {"ok": False, "error_code": 400, "description": "Bad Request: chat not found"}, status=400,
+                )
+            result: Dict[str, Any] = {
+                "id": len(self.calls), "type": "private", "username": chat_id[1:], "bio": f"bio {chat_id}",
+                "accent_color_id": 0, "max_reaction_count": 0,
+            }
+            return web.json_response({"ok": True, "result": result})
+        finally:
+            self.active -= 1
+
+
+@asynccontextmanager
+async def _enricher(api: _FakeApi, concurrency: int = 5):
+    app = web.Application()
+    app.router.add_post("/bot{token}/getChat", api.get_chat)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    bot = Bot("1:test", session=AiohttpSession(api=TelegramAPIServer.from_base(f"http://127.0.0.1:{port}")))
+    try:
+        yield ProfileEnricher(bot, ProfileCache(ttl=60), concurrency=concurrency)
+    finally:
+        await bot.session.close()
+        await runner.cleanup()
+
+
+def test_enrich_fills_bio_and_skips_cached():
+    async def scenario():
+        api = _FakeApi()
+        async with _enricher(api) as enricher:
+            rows = [{"username": "alice"}, {"username": "Alice"}, {"username": "bob"}, {"name": "no username"}]
+            assert await enricher.enrich(rows) == 3
+            assert rows[1]["bio"] == "bio @alice"
+            # Повторное задание берёт профили из кэша
+            await enricher.enrich([{"username": "ALICE"}, {"username": "bob"}])
+        return api
+
+    api = asyncio.run(scenario())
+    assert sorted(api.calls) == ["@alice", "@bob"]
+
+
+def test_retry_after_pauses_all_requests():
+    async def scenario():
+        api = _FakeApi(flood={"@flood"})
+        async with _enricher(api) as enricher:
+            flooded = asyncio.ensure_future(enricher.enrich([{"username": "flood"}]))
+            await asyncio.sleep(0.2)
+            # 429 уже получен: запрос другого задания ждёт общей паузы
+            other = [{"username": "other"}]
+            assert await enricher.enrich(other) == 1
+            assert await flooded == 1
+        return api, enricher, other
+
+    api, enricher, other = asyncio.run(scenario())
+    assert api.calls == ["@flood", "@other", "@flood"] or api.calls == ["@flood", "@flood", "@other"]
+    assert enricher.flood_waits == 1
+    assert other[0]["bio"] == "bio @other"
+    # После 429 (retry_after = 1 с) ни один запрос не уходит раньше паузы
+    assert all(t - api.times[0] >= 1 for t in api.times[1:])
+
+
+def test_concurrency_is_bounded():
+    async def scenario():
+        api = _FakeApi(delay=0.05)
+        async with _enricher(api, concurrency=3) as enricher:
+            await enricher.enrich([{"username": f"user{i}"} for i in range(12)])
+        return api
+
+    api = asyncio.run(scenario())
+    assert len(api.calls) == 12
+    assert api.peak == 3
+
+
+def test_missing_username_is_cached():
+    async def scenario():
+        api = _FakeApi(missing={"@ghost"})
+        async with _enricher(api) as enricher:
+            rows = [{"username": "ghost"}]
+            assert await enricher.enrich(rows) == 0
+            assert await enricher.enrich([{"username": "Ghost"}]) == 0
+            assert "ghost" in enricher.cache
+        return api, rows
+
+    api, rows = asyncio.run(scenario())
+    assert api.calls == ["@ghost"]
+    assert "bio" not in rows[0]
+
+
+def test_concurrent_jobs_share_lookup():
+    async def scenario():
+        api = _FakeApi(delay=0.1)
+        async with _enricher(api) as enricher:
+            first = [{"username": "shared"}, {"username": "one"}]
+            second = [{"username": "SHARED"}]
+            await asyncio.gather(enricher.enrich(first), enricher.enrich(second))
+        return api, first, second
+
+    api, first, second = asyncio.run(scenario())
+    assert sorted(api.calls) == ["@one", "@shared"]
+    assert first[0]["bio"] == second[0]["bio"] == "bio @shared"
+
+
+def test_cancelled_job_does_not_cancel_shared_lookup():
+    async def scenario():
+        api = _FakeApi(delay=0.1)
+        async with _enricher(api) as enricher:
+            other = [{"username": "shared"}]
+            job = asyncio.ensure_future(enricher.enrich([{"username": "shared"}]))
+            await asyncio.sleep(0.02)
+            waiting = asyncio.ensure_future(enricher.enrich(other))
+            await asyncio.sleep(0)
+            job.cancel()
+            await waiting
+        return api, other
+
+    api, other = asyncio.run(scenario())
+    assert api.calls == ["@shared"]
+    assert other[0]["bio"] == "bio @shared"
+
+
+def test_max_lookups_limits_uncached_requests():
+    async def scenario():
+        api = _FakeApi()
+        async with _enricher(api) as enricher:
+            await enricher.enrich([{"username": "cached"}])
+            rows = [{"username": "cached"}] + [{"username": f"user{i}"} for i in range(10)]
+            found = await enricher.enrich(rows, max_lookups=4)
+        return api, rows, found
+
+    api, rows, found = asyncio.run(scenario())
+    # Профиль из кэша не расходует лимит запросов
+    assert len(api.calls) == 1 + 4
+    assert found == 5
+    assert sum(1 for row in rows if row.get("bio")) == 5
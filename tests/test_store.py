@@ -0,0 +1,281 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional, Set
+
+import pytest
+
+from app.utils import store
+from app.utils.limits import JobCancelled
+from app.utils.resp import RespClient
+from app.utils.store import MemoryBackend, RedisBackend
+from app.utils.temp import SessionStore
+
+
+class _FakeRedis:
+    """
+    Локальный сервер RESP вместо Redis: строки со сроком жизни (PX/EX), INCR и оба
+    Lua-скрипта store.py (узнаются по тексту). cut — {команда: начало ответа}:
+    команда выполняется, но клиент получает только начало ответа, и соединение
+    закрывается (один раз). delay — {команда: задержка ответа в секундах}.
+    """
+
+    def __init__(self):
+        self.data: Dict[bytes, bytes] = {}
+        self.expires: Dict[bytes, float] = {}
+        self.calls: List[List[bytes]] = []
+        self.cut: Dict[bytes, bytes] = {}
+        self.delay: Dict[bytes, float] = {}
+        self.connections = 0
+        self._writers: Set[asyncio.StreamWriter] = set()
+
+    def get(self, key: bytes) -> Optional[bytes]:
+        if key in self.expires and self.expires[key] <= time.monotonic():
+            self.data.pop(key, None)
+            self.expires.pop(key)
+        return self.data.get(key)
+
+    def _set(self, key: bytes, value: bytes, px: Optional[int] = None):
+        self.data[key] = value
+        self.expires.pop(key, None)
+        if px is not None:
+            self.expires[key] = time.monotonic() + px / 1000
+
+    @staticmethod
+    def _bulk(value: Optional[bytes]) -> bytes:
+        return b"$-1\r\n" if value is None else b"$%d\r\n%s\r\n" % (len(value), value)
+
+    def _run(self, args: List[bytes]) -> bytes:
+        cmd = args[0].upper()
+        if cmd == b"GET":
+            return self._bulk(self.get(args[1]))
+        if cmd == b"SET":
+            opts = [a.upper() for a in args[3:]]
+            if b"NX" in opts and self.get(args[1]) is not None:
+                return b"$-1\r\n"
+            px = None
+            if b"PX" in opts:
+                px = int(opts[opts.index(b"PX") + 1])
+            elif b"EX" in opts:
+                px = int(opts[opts.index(b"EX") + 1]) * 1000
+            self._set(args[1], args[2], px)
+            return b"+OK\r\n"
+        if cmd == b"DEL":
+            return b":%d\r\n" % sum(1 for k in args[1:] if self.get(k) is not None and self.data.pop(k))
+        if cmd == b"INCR":
+            value = int(self.get(args[1]) or b"0") + 1
+            self.data[args[1]] = b"%d" % value
+            return b":%d\r\n" % value
+        if cmd == b"EVAL":
+            script, keys = args[1].decode(), args[3:3 + int(args[2])]
+            argv = args[3 + int(args[2]):]
+            if script == store._UNLOCK_SCRIPT:
+                if self.get(keys[0]) != argv[0]:
+                    return b":0\r\n"
+                del self.data[keys[0]]
+                return b":1\r\n"
+            if script == store._SAVE_SCRIPT:
+                if (self.get(keys[1]) or b"0") != argv[2]:
+                    return b":0\r\n"
+                self._set(keys[0], argv[0], int(argv[1]))
+                return b":1\r\n"
+        return b"-ERR unknown command\r\n"
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections += 1
+        self._writers.add(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                args = []
+                for _ in range(int(line[1:-2])):
+                    size = int((await reader.readline())[1:-2])
+                    args.append((await reader.readexactly(size + 2))[:-2])
+                self.calls.append(args)
+                reply = self._run(args)
+                cmd = args[0].upper()
+                if cmd in self.delay:
+                    await asyncio.sleep(self.delay[cmd])
+                if cmd in self.cut:
+                    writer.write(self.cut.pop(cmd))
+                    await writer.drain()
+                    break
+                writer.write(reply)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    def drop_connections(self):
+        for writer in list(self._writers):
+            writer.close()
+
+    def count(self, cmd: bytes) -> int:
+        return sum(1 for args in self.calls if args[0].upper() == cmd)
+
+
+@asynccontextmanager
+async def _redis(fake: _FakeRedis):
+    server = await asyncio.start_server(fake.handle, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    backend = RedisBackend(f"redis://127.0.0.1:{port}/0", prefix="t:")
+    try:
+        yield backend
+    finally:
+        await backend.close()
+        server.close()
+        fake.drop_connections()
+        await server.wait_closed()
+
+
+def _store(backend=None) -> SessionStore:
+    return SessionStore(user_budget=1 << 20, global_budget=1 << 30, ttl=60, backend=backend or MemoryBackend())
+
+
+def test_memory_cancel_rejects_jobs_started_before_it():
+    async def scenario():
+        sessions = _store()
+        epoch = await sessions.cancel_epoch(1)
+        await sessions.check_cancelled(1, epoch)
+        # /cancel, не заставший задание (файл ещё скачивается), всё равно его отменяет
+        await sessions.cancel(1)
+        with pytest.raises(JobCancelled):
+            await sessions.check_cancelled(1, epoch)
+        # Новое задание и задания других пользователей не затронуты
+        await sessions.check_cancelled(1, await sessions.cancel_epoch(1))
+        await sessions.check_cancelled(2, epoch)
+
+    asyncio.run(scenario())
+
+
+def test_redis_session_roundtrip_and_ttl():
+    async def scenario():
+        fake = _FakeRedis()
+        async with _redis(fake) as backend:
+            state = {"files_count": 2, "name": "Чат"}
+            assert await backend.save(1, state, ttl=0.1)
+            assert await backend.load(1) == state
+            await backend.set_setting(1, "format", "csv")
+            assert await backend.get_setting(1, "format") == "csv"
+            await asyncio.sleep(0.15)
+            # Сессия истекла, а настройка живёт дольше
+            assert await backend.load(1) is None
+            assert await backend.get_setting(1, "format") == "csv"
+            await backend.save(1, state, ttl=60)
+            await backend.delete(1)
+            assert await backend.load(1) is None
+
+    asyncio.run(scenario())
+
+
+def test_redis_save_script_rejects_after_cancel():
+    async def scenario():
+        fake = _FakeRedis()
+        async with _redis(fake) as backend:
+            sessions = _store(backend)
+            epoch = await backend.cancel_epoch(1)
+            assert await backend.save(1, {"files_count": 1}, ttl=60, epoch=epoch)
+            # /cancel в другом процессе: запись с прежним счётчиком отклоняется
+            await backend.bump_cancel_epoch(1)
+            assert not await backend.save(1, {"files_count": 2}, ttl=60, epoch=epoch)
+            assert await backend.load(1) == {"files_count": 1}
+            with pytest.raises(JobCancelled):
+                await sessions.check_cancelled(1, epoch)
+            assert await backend.save(1, {"files_count": 3}, ttl=60, epoch=await backend.cancel_epoch(1))
+            # Счётчик отмен не истекает: иначе он снова читался бы как 0
+            assert b"t:cancel:1" not in fake.expires
+
+    asyncio.run(scenario())
+
+
+def test_redis_lock_contention():
+    async def scenario():
+        fake = _FakeRedis()
+        async with _redis(fake) as backend:
+            order = []
+
+            async def hold(name: str):
+                async with backend.lock("session:1", ttl=5):
+                    order.append(f"{name} in")
+                    await asyncio.sleep(0.1)
+                    order.append(f"{name} out")
+
+            await asyncio.gather(hold("a"), hold("b"))
+            assert order in (["a in", "a out", "b in", "b out"], ["b in", "b out", "a in", "a out"])
+            assert fake.get(b"t:lock:session:1") is None
+
+            # Блокировку, истёкшую и занятую другим владельцем, выход из lock() не снимает
+            async with backend.lock("session:1", ttl=5):
+                fake.data[b"t:lock:session:1"] = b"other"
+            assert fake.get(b"t:lock:session:1") == b"other"
+
+    asyncio.run(scenario())
+
+
+def test_redis_lock_of_crashed_owner_expires():
+    async def scenario():
+        fake = _FakeRedis()
+        async with _redis(fake) as backend:
+            # Процесс взял блокировку и упал, не сняв её
+            assert await backend._acquire("t:lock:session:1", "crashed", ttl=0.2)
+            start = time.monotonic()
+            async with backend.lock("session:1", ttl=5):
+                waited = time.monotonic() - start
+        return waited
+
+    assert asyncio.run(scenario()) >= 0.15
+
+
+@pytest.mark.parametrize("partial", [b"+O", b"$2\r\nO"])
+def test_redis_lock_with_lost_reply_is_not_retried(partial):
+    async def scenario():
+        fake = _FakeRedis()
+        async with _redis(fake) as backend:
+            # SET NX выполнился, но ответ оборвался: повтор увидел бы собственную блокировку занятой
+            fake.cut[b"SET"] = partial
+            entered = False
+            async with backend.lock("session:1", ttl=5):
+                entered = True
+        return fake, entered
+
+    fake, entered = asyncio.run(asyncio.wait_for(scenario(), 5))
+    assert entered
+    assert fake.count(b"SET") == 1
+    assert fake.get(b"t:lock:session:1") is None
+
+
+def test_resp_cancel_mid_reply_does_not_shift_replies():
+    async def scenario():
+        fake = _FakeRedis()
+        server = await asyncio.start_server(fake.handle, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        client = RespClient(f"redis://127.0.0.1:{port}")
+        try:
+            await client.execute("SET", "a", "1")
+            await client.execute("SET", "b", "2")
+            fake.delay[b"GET"] = 0.2
+            slow = asyncio.ensure_future(client.execute("GET", "a"))
+            await asyncio.sleep(0.05)
+            slow.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await slow
+            del fake.delay[b"GET"]
+            # Ответ на отменённый GET a не достаётся следующей команде
+            assert await client.execute("GET", "b") == b"2"
+            # Соединение, закрытое сервером, восстанавливается, и команда повторяется
+            fake.drop_connections()
+            await asyncio.sleep(0.05)
+            assert await client.execute("GET", "a") == b"1"
+        finally:
+            await client.close()
+            server.close()
+            fake.drop_connections()
+            await server.wait_closed()
+        return fake
+
+    fake = asyncio.run(scenario())
+    assert fake.connections >= 3